@@ -0,0 +1,208 @@
+from dotenv import load_dotenv
+
+load_dotenv("config/.env")
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, HTMLResponse, Response
+from starlette.routing import Route
+from starlette.staticfiles import StaticFiles
+
+from src.service.review_query import parse_review_filters, get_review_logs, get_review_stats, \
+    generate_daily_report, setup_scheduler
+from src.service.webhook_service import WebhookResponse, parse_webhook_body, dispatch_webhook, retry_later
+from src.utils.admission import get_admission_state
+from src.utils.config_checker import check_config
+from src.utils.log import logger
+from src.utils.queue import init_queue, get_queue_stats
+
+push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
+
+
+def ingress_limits() -> dict:
+    return {
+        # 执行 JSON 解析、分发和入队的线程数，事件循环本身不做任何阻塞操作
+        'worker_threads': int(os.getenv('INGRESS_WORKER_THREADS', 16)),
+        # 同时在线程池中处理（含排队）的 webhook 上限，超出时直接返回 503
+        'max_in_flight': int(os.getenv('INGRESS_MAX_IN_FLIGHT', 1000)),
+        # 读取请求体的超时时间（秒），防止慢客户端长期占用连接
+        'body_timeout_seconds': float(os.getenv('INGRESS_BODY_TIMEOUT_SECONDS', 10)),
+        # 请求体大小上限（字节），0 表示不限制
+        'max_body_bytes': int(os.getenv('INGRESS_MAX_BODY_BYTES', 25 * 1024 * 1024)),
+    }
+
+
+class Ingress:
+    """
+    webhook 入口的执行资源：一个固定大小的线程池，以及限制同时处理的 webhook 数量的计数。
+    事件循环只负责读取请求体和返回响应，JSON 解析、日志、去重和入队（可能访问 Redis / SQLite）都在线程池中完成
+    """
+
+    def __init__(self, worker_threads: int, max_in_flight: int):
+        self.executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix='ingress')
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.shed = 0
+
+    def try_acquire(self) -> bool:
+        # 只在事件循环线程中调用，无需加锁
+        if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    async def run(self, function: callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight, 'shed': self.shed}
+
+
+_limits = ingress_limits()
+ingress = Ingress(_limits['worker_threads'], _limits['max_in_flight'])
+
+
+class BodyReadError(Exception):
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+def to_starlette_response(result: WebhookResponse) -> Response:
+    return JSONResponse(result.body, status_code=result.status_code, headers=result.headers)
+
+
+async def read_body(request) -> bytes:
+    """
+    在超时时间内读取完整的请求体，超过大小上限时立即停止读取
+    :return: 请求体；超时、超限或客户端断开时抛出 BodyReadError
+    """
+    max_body_bytes = _limits['max_body_bytes']
+    content_length = request.headers.get('content-length')
+    if max_body_bytes > 0 and content_length and content_length.isdigit() and int(content_length) > max_body_bytes:
+        raise BodyReadError(413, f'Request body exceeds {max_body_bytes} bytes')
+
+    async def _read() -> bytes:
+        chunks = []
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if max_body_bytes > 0 and size > max_body_bytes:
+                raise BodyReadError(413, f'Request body exceeds {max_body_bytes} bytes')
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    try:
+        return await asyncio.wait_for(_read(), timeout=_limits['body_timeout_seconds'])
+    except asyncio.TimeoutError:
+        raise BodyReadError(408, 'Timed out reading request body')
+    except ClientDisconnect:
+        raise BodyReadError(400, 'Client disconnected')
+
+
+def _process_webhook(body: bytes, headers, content_length: int) -> WebhookResponse:
+    data, error = parse_webhook_body(body)
+    if error:
+        return error
+    return dispatch_webhook(data, headers, content_length)
+
+
+async def handle_webhook(request):
+    try:
+        body = await read_body(request)
+    except BodyReadError as e:
+        logger.warn(f'Webhook request rejected: {e.reason}')
+        return JSONResponse({'error': e.reason}, status_code=e.status_code)
+
+    if not ingress.try_acquire():
+        return to_starlette_response(retry_later('Webhook ingress is overloaded, please retry later.', 503))
+    try:
+        return to_starlette_response(await ingress.run(_process_webhook, body, request.headers, len(body)))
+    except Exception as e:
+        logger.error(f'Failed to handle webhook: {e}')
+        return JSONResponse({'error': str(e)}, status_code=500)
+    finally:
+        ingress.release()
+
+
+async def home(request):
+    return HTMLResponse("<h2>The server is running.</h2>")
+
+
+async def review_logs(request):
+    """获取审查日志数据"""
+    try:
+        return JSONResponse(await ingress.run(lambda: get_review_logs(**parse_review_filters(request.query_params))))
+    except Exception as e:
+        logger.error(f"Failed to get review logs: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def review_stats(request):
+    """获取统计数据用于图表"""
+    try:
+        return JSONResponse(await ingress.run(lambda: get_review_stats(**parse_review_filters(request.query_params))))
+    except Exception as e:
+        logger.error(f"Failed to get review stats: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def daily_report(request):
+    try:
+        report_txt = await ingress.run(generate_daily_report, push_review_enabled)
+        if report_txt is None:
+            return JSONResponse({'message': 'No data to process.'})
+        return Response(json.dumps(report_txt, ensure_ascii=False, indent=4), media_type='text/html')
+    except Exception as e:
+        logger.error(f"Failed to generate daily report: {e}")
+        return JSONResponse({'message': f"Failed to generate daily report: {e}"}, status_code=500)
+
+
+async def queue_stats(request):
+    """获取队列状态：积压深度、执行中任务数、拒绝次数等，以及 ASGI 入口的并发情况"""
+    stats = await ingress.run(get_queue_stats)
+    return JSONResponse({**stats, 'ingress': ingress.stats()})
+
+
+async def queue_admission(request):
+    """获取准入控制状态：当前负载、高水位配置、各优先级是否接受新任务"""
+    return JSONResponse(await ingress.run(get_admission_state))
+
+
+routes = [
+    Route('/', home),
+    Route('/review/webhook', handle_webhook, methods=['POST']),
+    Route('/api/review/logs', review_logs, methods=['GET']),
+    Route('/api/review/stats', review_stats, methods=['GET']),
+    Route('/review/daily_report', daily_report, methods=['GET']),
+    Route('/api/queue/stats', queue_stats, methods=['GET']),
+    Route('/api/queue/admission', queue_admission, methods=['GET']),
+]
+
+asgi_app = Starlette(routes=routes)
+# 与 Flask 版本一致，web 目录下的静态文件挂载在根路径
+asgi_app.mount('/', StaticFiles(directory='web', check_dir=False), name='web')
+
+
+if __name__ == '__main__':
+    check_config()
+    # 启动定时任务调度器
+    setup_scheduler(push_review_enabled)
+    # 预热队列（async 驱动下启动常驻进程池）
+    init_queue()
+
+    # 启动 ASGI API 服务，单进程运行，保证 async 驱动的进程池和队列状态只有一份
+    port = int(os.environ.get('SERVER_PORT', 5001))
+    uvicorn.run(asgi_app, host='0.0.0.0', port=port, timeout_keep_alive=int(os.getenv('INGRESS_KEEP_ALIVE_SECONDS', 5)),
+                limit_concurrency=int(os.getenv('INGRESS_MAX_CONNECTIONS', 0)) or None)
@@ -0,0 +1,108 @@
+"""
+Gitea Push 事件获取文件 diff 的压测：在本地启动一个模拟的 Gitea API（每个请求固定延迟），
+分别以串行和并发方式执行 PushHandler.repository_compare，对比耗时并校验结果一致、顺序不变。
+
+用法（在仓库根目录执行）：
+
+    python -m scripts.bench.bench_gitea_diff --files 40 --latency-ms 100 --concurrency 8
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.gitea.webhook_handler import PushHandler
+
+REPO = 'bench/diff'
+BASE_SHA = 'a' * 40
+HEAD_SHA = 'b' * 40
+
+
+def build_full_diff(filenames: list) -> str:
+    parts = []
+    for filename in filenames:
+        parts.append(f'diff --git a/{filename} b/{filename}\n'
+                     f'--- a/{filename}\n+++ b/{filename}\n'
+                     f'@@ -1,2 +1,2 @@\n-old line in {filename}\n+new line in {filename}\n context\n')
+    return ''.join(parts)
+
+
+def make_handler(filenames: list, latency: float, counter: dict):
+    full_diff = build_full_diff(filenames)
+    compare = {
+        'files': [{'filename': filename} for filename in filenames],
+        'commits': [{'sha': HEAD_SHA, 'parents': [{'sha': BASE_SHA}], 'files': []}],
+    }
+    lock = threading.Lock()
+
+    class FakeGiteaHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: str, content_type: str = 'application/json'):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            with lock:
+                counter['requests'] += 1
+            time.sleep(latency)
+            path = self.path.split('?')[0]
+            if path == f'/api/v1/repos/{REPO}/compare/{BASE_SHA}...{HEAD_SHA}':
+                return self._send(200, json.dumps(compare))
+            if re.fullmatch(rf'/api/v1/repos/{REPO}/git/commits/\w+\.diff', path):
+                return self._send(200, full_diff, 'text/plain')
+            return self._send(404, json.dumps({'message': 'not found'}))
+
+    return FakeGiteaHandler
+
+
+def run_compare(gitea_url: str, concurrency: int):
+    os.environ['GITEA_DIFF_CONCURRENCY'] = str(concurrency)
+    handler = PushHandler({'repository': {'full_name': REPO}, 'ref': 'refs/heads/main', 'commits': []},
+                          'bench-token', gitea_url)
+    start = time.perf_counter()
+    diffs = handler.repository_compare(BASE_SHA, HEAD_SHA)
+    return time.perf_counter() - start, diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent per-file diff retrieval against a fake Gitea.')
+    parser.add_argument('--files', type=int, default=40, help='Push 中缺少 patch 的文件数')
+    parser.add_argument('--latency-ms', type=float, default=100, help='模拟 Gitea API 每个请求的延迟（毫秒）')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发获取 diff 的线程数')
+    args = parser.parse_args()
+
+    filenames = [f'src/module_{i:03d}.py' for i in range(args.files)]
+    counter = {'requests': 0}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(filenames, args.latency_ms / 1000, counter))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    gitea_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    try:
+        results = {}
+        for concurrency in [1, args.concurrency]:
+            counter['requests'] = 0
+            elapsed, diffs = run_compare(gitea_url, concurrency)
+            results[concurrency] = diffs
+            print(f'concurrency={concurrency}\tfiles={len(diffs)}\trequests={counter["requests"]}\t'
+                  f'elapsed={elapsed:.2f}s')
+        serial, concurrent = results[1], results[args.concurrency]
+        assert [d['new_path'] for d in concurrent] == filenames, 'file order changed'
+        assert serial == concurrent, 'concurrent results differ from serial results'
+        print('results identical and in the original file order')
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
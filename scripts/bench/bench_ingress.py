@@ -0,0 +1,142 @@
+"""
+webhook 入口的响应延迟压测：对比 Flask 版本（api.py）与 ASGI 版本（api_asgi.py）确认 webhook 的耗时。
+
+用法（在仓库根目录执行，先分别启动两个服务，例如 SERVER_PORT=5001 python api.py 与 SERVER_PORT=5003 python api_asgi.py）：
+
+    python -m scripts.bench.bench_ingress --url http://127.0.0.1:5001 --url http://127.0.0.1:5003 -n 2000 -c 200 --slow-clients 50
+
+默认发送 Gitea issue_comment 事件：会经过完整的请求解析、来源识别和分发，但不会真正入队，
+不会产生 review 任务；加上 --event push 可以把入队耗时也计入（会产生真实的 review 任务）。
+--slow-clients 会额外建立若干个缓慢发送请求体的连接，观察慢客户端对正常请求的影响。
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from urllib.parse import urlparse
+
+import httpx
+
+_PUSH_PAYLOAD = {
+    'ref': 'refs/heads/main',
+    'before': '0' * 40,
+    'after': '1' * 40,
+    'repository': {'full_name': 'bench/ingress', 'html_url': 'http://gitea.bench.local/bench/ingress',
+                   'default_branch': 'main'},
+    'commits': [{'id': f'{i:040x}', 'message': f'commit {i}', 'timestamp': '2024-01-01T00:00:00Z',
+                 'url': f'http://gitea.bench.local/bench/ingress/commit/{i:040x}',
+                 'author': {'name': 'bench', 'email': 'bench@example.com'}} for i in range(20)],
+}
+
+
+def build_request(event: str):
+    payload = dict(_PUSH_PAYLOAD, action='created') if event == 'issue_comment' else _PUSH_PAYLOAD
+    headers = {
+        'Content-Type': 'application/json',
+        'X-Gitea-Event': event,
+        'X-Gitea-Token': 'bench-token',
+        'X-Gitea-Instance': 'http://gitea.bench.local',
+    }
+    return json.dumps(payload).encode('utf-8'), headers
+
+
+async def slow_client(url: str, body: bytes, stop: asyncio.Event):
+    """声明完整的 Content-Length，但每秒只发送一个字节，直到压测结束"""
+    parsed = urlparse(url)
+    try:
+        reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+    except OSError:
+        return
+    try:
+        writer.write((f'POST /review/webhook HTTP/1.1\r\nHost: {parsed.netloc}\r\n'
+                      f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n').encode('ascii'))
+        for i in range(len(body)):
+            if stop.is_set():
+                break
+            writer.write(body[i:i + 1])
+            await writer.drain()
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(url: str, requests_total: int, concurrency: int, event: str, slow_clients: int) -> dict:
+    body, headers = build_request(event)
+    webhook_url = url.rstrip('/') + '/review/webhook'
+    latencies = []
+    statuses = {}
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    slow_tasks = [asyncio.create_task(slow_client(url, body, stop)) for _ in range(slow_clients)]
+    # 给慢客户端一点时间建立连接
+    await asyncio.sleep(0.5 if slow_clients else 0)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                request_headers = dict(headers, **{'X-Gitea-Delivery': str(uuid.uuid4())})
+                start = time.perf_counter()
+                try:
+                    response = await client.post(webhook_url, content=body, headers=request_headers)
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests_total)))
+        elapsed = time.perf_counter() - started
+
+    stop.set()
+    await asyncio.gather(*slow_tasks, return_exceptions=True)
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0
+
+    return {
+        'url': url,
+        'requests': requests_total,
+        'errors': errors,
+        'statuses': statuses,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'mean_ms': round(statistics.mean(latencies), 2) if latencies else 0,
+        'p50_ms': round(percentile(0.50), 2),
+        'p95_ms': round(percentile(0.95), 2),
+        'p99_ms': round(percentile(0.99), 2),
+        'max_ms': round(latencies[-1], 2) if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare webhook ack latency between ingress servers.')
+    parser.add_argument('--url', action='append', required=True, help='服务地址，可指定多次，例如 http://127.0.0.1:5001')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='每个服务发送的请求数')
+    parser.add_argument('-c', '--concurrency', type=int, default=100, help='并发请求数')
+    parser.add_argument('--event', choices=['issue_comment', 'push'], default='issue_comment',
+                        help='Gitea 事件类型，push 会真实入队')
+    parser.add_argument('--slow-clients', type=int, default=0, help='同时保持的慢客户端连接数')
+    args = parser.parse_args()
+
+    results = [asyncio.run(run(url, args.requests, args.concurrency, args.event, args.slow_clients))
+               for url in args.url]
+
+    columns = ['url', 'requests', 'errors', 'throughput_rps', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+    print('\t'.join(columns + ['statuses']))
+    for result in results:
+        print('\t'.join(str(result[column]) for column in columns) + f"\t{result['statuses']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,14 @@
 import os
 import time
 import re
-import requests
 from urllib.parse import urljoin
+from src.gitlab.webhook_handler import slugify_url
+from src.utils import http_client
+from src.utils.diff_index import scan_diff
+from src.utils.git_mirror import mirror_changes
 from src.utils.log import logger
+from src.utils.parallel import map_ordered
+from src.utils.stream_download import read_diff_sections, stream_enabled
 
 
 def filter_changes(changes: list):
@@ -54,24 +59,18 @@ def filter_changes(changes: list):
         if not any(new_path.endswith(ext) for ext in supported_extensions):
             continue
 
-        # estimate additions/deletions
+        # estimate additions/deletions and detect deletions in a single pass over the diff
+        stats = scan_diff(diff)
         additions = item.get('additions', 0)
         deletions = item.get('deletions', 0)
-        if (additions == 0 and deletions == 0) and diff:
-            additions = len(re.findall(r'^\+(?!\+\+)', diff, re.MULTILINE))
-            deletions = len(re.findall(r'^-(?!--)', diff, re.MULTILINE))
+        if additions == 0 and deletions == 0:
+            additions, deletions = stats.additions, stats.deletions
 
         # detect deletions and skip them
         status = (item.get('status') or item.get('changeType') or '').lower()
         deleted_via_status = status == 'removed' or status == 'deleted'
-        deleted_via_diff = False
-        if diff:
-            first = diff.splitlines()[0] if diff.splitlines() else ''
-            if re.match(r'@@ -\d+,\d+ \+0,0 @@', first):
-                # likely a deletion
-                deleted_via_diff = True
-
-        if deleted_via_status or deleted_via_diff:
+
+        if deleted_via_status or stats.deleted_file:
             logger.info(f"Detected deleted file, skipping: {new_path}")
             continue
 
@@ -85,6 +84,94 @@ def filter_changes(changes: list):
     return filtered
 
 
+_EMPTY_SHA = re.compile(r'^0+$')
+# unified diff line prefix of each Bitbucket Server hunk segment type
+_SEGMENT_PREFIX = {'CONTEXT': ' ', 'ADDED': '+', 'REMOVED': '-'}
+
+
+def bitbucket_diff_concurrency() -> int:
+    """Number of concurrent per-commit diff requests of a push, 1 means sequential"""
+    return max(int(os.getenv('BITBUCKET_DIFF_CONCURRENCY', 8)), 1)
+
+
+def _diff_from_hunks(d: dict) -> dict:
+    """Rebuild a unified diff from a Bitbucket Server JSON diff, counting added/removed lines along the way"""
+    dest = d.get('destination') or {}
+    src = d.get('source') or {}
+    new_path = dest.get('toString') or dest.get('name') or dest.get('path') or ''
+    src_path = src.get('toString') or src.get('name') or src.get('path') or new_path
+
+    diff_lines = [f"diff --git a/{src_path} b/{new_path}", f"--- a/{src_path}", f"+++ b/{new_path}"]
+    additions = deletions = 0
+    for h in d.get('hunks') or []:
+        diff_lines.append(f"@@ -{h.get('sourceLine', 0) or 0},{h.get('sourceSpan', 0) or 0} "
+                          f"+{h.get('destinationLine', 0) or 0},{h.get('destinationSpan', 0) or 0} @@")
+        for seg in h.get('segments') or []:
+            prefix = _SEGMENT_PREFIX.get((seg.get('type') or '').upper(), ' ')
+            lines = seg.get('lines') or []
+            diff_lines.extend(prefix + lineobj.get('line', '') for lineobj in lines)
+            if prefix == '+':
+                additions += len(lines)
+            elif prefix == '-':
+                deletions += len(lines)
+    return {'diff': '\n'.join(diff_lines), 'new_path': new_path, 'additions': additions, 'deletions': deletions}
+
+
+def parse_diff_response(r) -> list:
+    """Convert a Bitbucket Server commit / range diff response into the common changes format"""
+    # try to parse JSON-shaped diff response first
+    try:
+        data = r.json()
+    except ValueError:
+        data = None
+
+    # Newer Bitbucket Server responses may include a `diffs` array
+    if isinstance(data, dict) and data.get('diffs'):
+        if data.get('truncated'):
+            logger.warn("Bitbucket diff response is truncated, some files may be missing from the review")
+        return [_diff_from_hunks(d) for d in data.get('diffs', [])]
+
+    # older shape: values array with path/diff fields
+    if isinstance(data, dict) and data.get('values'):
+        return [{
+            'diff': v.get('diff') or '',
+            'new_path': v.get('path', {}).get('toString') if isinstance(v.get('path'), dict) else v.get('path'),
+            'additions': v.get('linesAdded', 0),
+            'deletions': v.get('linesRemoved', 0)
+        } for v in data.get('values', [])]
+
+    # fallback: treat response body as unified diff text
+    changes = []
+    if data is None and r.text:
+        for part in re.split(r"\n(?=diff --git )", r.text):
+            part = part.strip('\n')
+            if not part:
+                continue
+            first_line = part.split('\n', 1)[0]
+            new_path = ''
+            m = re.search(r"diff --git a/(.+?) b/(.+)$", first_line)
+            if m:
+                new_path = m.group(2)
+            else:
+                m2 = re.search(r"\+\+\+ b/(.+)$", part, re.MULTILINE)
+                if m2:
+                    new_path = m2.group(1)
+
+            stats = scan_diff(part)
+            changes.append({'diff': part, 'new_path': new_path,
+                            'additions': stats.additions, 'deletions': stats.deletions})
+    return changes
+
+
+def http_clone_url(repository: dict):
+    """Pick the HTTP clone url from links.clone of a Bitbucket Server repository payload"""
+    links = (repository or {}).get('links') or {}
+    for link in links.get('clone') or [] if isinstance(links, dict) else []:
+        if link.get('name') in ('http', 'https') and link.get('href'):
+            return link['href']
+    return None
+
+
 class PullRequestHandler:
     def __init__(self, webhook_data: dict, bitbucket_token: str, bitbucket_url: str):
         self.webhook_data = webhook_data
@@ -147,6 +234,16 @@ class PullRequestHandler:
             changes = pr.get('changes') or pr.get('properties') or []
             return changes
 
+        # use the local mirror when configured: diff the target branch against the PR head locally
+        pr = self.webhook_data.get('pullRequest') or self.webhook_data.get('pull_request') or {}
+        to_ref = pr.get('toRef') or {}
+        changes = mirror_changes('bitbucket', self.bitbucket_url, slugify_url(self.bitbucket_url), self.repo_full_name,
+                                 self.bitbucket_token, to_ref.get('latestCommit'),
+                                 (pr.get('fromRef') or {}).get('latestCommit'),
+                                 clone_url=http_clone_url(to_ref.get('repository')), merge_base=True)
+        if changes is not None:
+            return changes
+
         changes = []
         try:
             # First try to fetch the unified diff text for the PR (recommended by Bitbucket Server)
@@ -154,16 +251,16 @@ class PullRequestHandler:
             headers = self._auth_headers()
             # request plain text diff
             headers.update({'Accept': 'text/plain'})
-            r = requests.get(diff_url, headers=headers, timeout=20, verify=False)
+            # the diff can be huge: stream it to a spooled file and split it per file (see stream_download)
+            r = http_client.get(diff_url, headers=headers, timeout=20, verify=False, stream=stream_enabled())
             logger.debug(f"Bitbucket get .diff status: {r.status_code} for {diff_url}")
-            if r.status_code == 200 and r.text:
-                full_diff = r.text
-                # split into per-file diffs by 'diff --git' headers
-                parts = re.split(r"\n(?=diff --git )", full_diff)
+            parts = []
+            if r.status_code == 200:
+                parts = read_diff_sections(r, f'URL: {diff_url}')
+            else:
+                r.close()
+            if parts:
                 for part in parts:
-                    part = part.strip('\n')
-                    if not part:
-                        continue
                     # try to extract new file path from the diff header
                     first_line = part.split('\n', 1)[0]
                     new_path = ''
@@ -177,9 +274,9 @@ class PullRequestHandler:
                             new_path = m2.group(1)
 
                     # estimate additions/deletions
-                    additions = len(re.findall(r'^\+(?!\+\+)', part, re.MULTILINE))
-                    deletions = len(re.findall(r'^-(?!--)', part, re.MULTILINE))
-                    changes.append({'diff': part, 'new_path': new_path, 'additions': additions, 'deletions': deletions})
+                    stats = scan_diff(part)
+                    changes.append({'diff': part, 'new_path': new_path,
+                                    'additions': stats.additions, 'deletions': stats.deletions})
                 return changes
 
             # fallback to changes API if .diff not available
@@ -187,7 +284,7 @@ class PullRequestHandler:
             headers = self._auth_headers()
             # retry a few times due to eventual consistency
             for attempt in range(3):
-                r = requests.get(url, headers=headers, timeout=20, verify=False)
+                r = http_client.get(url, headers=headers, timeout=20, verify=False)
                 logger.debug(f"Bitbucket get changes status: {r.status_code} for {url}")
                 if r.status_code == 200:
                     data = r.json()
@@ -218,7 +315,7 @@ class PullRequestHandler:
         try:
             url = f"{self.bitbucket_url}/rest/api/latest/projects/{self.repo_project}/repos/{self.repo_slug}/pull-requests/{self.pull_request_id}/commits?limit=500"
             headers = self._auth_headers()
-            r = requests.get(url, headers=headers, timeout=20, verify=False)
+            r = http_client.get(url, headers=headers, timeout=20, verify=False)
             if r.status_code == 200:
                 commits = r.json().get('values', [])
                 bitbucket_format_commits = []
@@ -246,7 +343,7 @@ class PullRequestHandler:
             url = f"{self.bitbucket_url}/rest/api/latest/projects/{self.repo_project}/repos/{self.repo_slug}/pull-requests/{self.pull_request_id}/comments"
             headers = self._auth_headers()
             data = {'text': review_result}
-            r = requests.post(url, headers=headers, json=data, timeout=20, verify=False)
+            r = http_client.post(url, headers=headers, json=data, timeout=20, verify=False)
             logger.debug(f"Add comment to Bitbucket PR {url}: {r.status_code}, {r.text[:200]}")
             if r.status_code in (200, 201):
                 logger.info("Comment successfully added to pull request.")
@@ -310,96 +407,59 @@ class PushHandler:
         changes = []
         if not (self.repo_project and self.repo_slug) or not self.commit_list:
             return changes
+        # use the local mirror when configured: diff fromHash..toHash of the pushed ref locally
+        ref_changes = self.webhook_data.get('changes')
+        if isinstance(ref_changes, list) and ref_changes:
+            mirrored = mirror_changes('bitbucket', self.bitbucket_url, slugify_url(self.bitbucket_url),
+                                      f'{self.repo_project}/{self.repo_slug}', self.bitbucket_token,
+                                      ref_changes[0].get('fromHash'), ref_changes[0].get('toHash'),
+                                      clone_url=http_clone_url(self.webhook_data.get('repository')))
+            if mirrored is not None:
+                return mirrored
+        # one diff for the whole pushed range (since..until) instead of one request per commit
+        since = ref_changes[0].get('fromHash') if isinstance(ref_changes, list) and ref_changes else None
+        until = ref_changes[0].get('toHash') if isinstance(ref_changes, list) and ref_changes else None
+        if since and until and not _EMPTY_SHA.match(since):
+            range_changes = self._get_range_changes(since, until)
+            if range_changes is not None:
+                return range_changes
+
+        # new branch (no base commit) or range diff unavailable: fetch each commit concurrently
+        commit_ids = [c.get('id') or c.get('hash') for c in self.commit_list]
+        commit_ids = [cid for cid in commit_ids if cid]
+        for commit_changes in map_ordered(self._get_commit_changes, commit_ids, bitbucket_diff_concurrency()):
+            changes.extend(commit_changes)
+        return changes
+
+    def _commit_diff_url(self, commit_id: str) -> str:
+        return f"{self.bitbucket_url}/rest/api/latest/projects/{self.repo_project}/repos/{self.repo_slug}/commits/{commit_id}/diff"
+
+    def _get_range_changes(self, since: str, until: str):
+        """Fetch the diff between since and until in one request; returns None when it cannot be fetched"""
         headers = {'Authorization': f'Bearer {self.bitbucket_token}'}
-        for c in self.commit_list:
-            cid = c.get('id') or c.get('hash')
-            if not cid:
-                continue
-            try:
-                url = f"{self.bitbucket_url}/rest/api/latest/projects/{self.repo_project}/repos/{self.repo_slug}/commits/{cid}/diff"
-                r = requests.get(url, headers=headers, timeout=20, verify=False)
-                if r.status_code == 200:
-                    # try to parse JSON-shaped diff response first
-                    try:
-                        data = r.json()
-                    except ValueError:
-                        data = None
-
-                    # Newer Bitbucket Server responses may include a `diffs` array
-                    if isinstance(data, dict) and data.get('diffs'):
-                        for d in data.get('diffs', []):
-                            dest = d.get('destination') or {}
-                            src = d.get('source') or {}
-                            new_path = dest.get('toString') or dest.get('name') or dest.get('path') or ''
-                            src_path = src.get('toString') or src.get('name') or src.get('path') or new_path
-
-                            # build a unified diff-like text from hunks/segments
-                            diff_lines = []
-                            diff_lines.append(f"diff --git a/{src_path} b/{new_path}")
-                            diff_lines.append(f"--- a/{src_path}")
-                            diff_lines.append(f"+++ b/{new_path}")
-                            for h in d.get('hunks', []) or []:
-                                sl = h.get('sourceLine', 0) or 0
-                                ss = h.get('sourceSpan', 0) or 0
-                                dl = h.get('destinationLine', 0) or 0
-                                ds = h.get('destinationSpan', 0) or 0
-                                diff_lines.append(f"@@ -{sl},{ss} +{dl},{ds} @@")
-                                for seg in h.get('segments', []) or []:
-                                    seg_type = (seg.get('type') or '').upper()
-                                    for lineobj in seg.get('lines', []) or []:
-                                        line_text = lineobj.get('line', '')
-                                        if seg_type == 'CONTEXT':
-                                            prefix = ' '
-                                        elif seg_type == 'ADDED':
-                                            prefix = '+'
-                                        elif seg_type == 'REMOVED':
-                                            prefix = '-'
-                                        else:
-                                            prefix = ' '
-                                        diff_lines.append(prefix + line_text)
-
-                            diff_text = '\n'.join(diff_lines)
-                            additions = len(re.findall(r'^\+(?!\+\+)', diff_text, re.MULTILINE))
-                            deletions = len(re.findall(r'^-(?!--)', diff_text, re.MULTILINE))
-                            changes.append({'diff': diff_text, 'new_path': new_path, 'additions': additions, 'deletions': deletions})
-
-                    # older shape: values array with path/diff fields
-                    elif isinstance(data, dict) and data.get('values'):
-                        for v in data.get('values', []):
-                            change = {
-                                'diff': v.get('diff') or '',
-                                'new_path': v.get('path', {}).get('toString') if isinstance(v.get('path'), dict) else v.get('path'),
-                                'additions': v.get('linesAdded', 0),
-                                'deletions': v.get('linesRemoved', 0)
-                            }
-                            changes.append(change)
-
-                    # fallback: treat response body as unified diff text
-                    else:
-                        text = r.text or ''
-                        if text:
-                            parts = re.split(r"\n(?=diff --git )", text)
-                            for part in parts:
-                                part = part.strip('\n')
-                                if not part:
-                                    continue
-                                first_line = part.split('\n', 1)[0]
-                                new_path = ''
-                                m = re.search(r"diff --git a/(.+?) b/(.+)$", first_line)
-                                if m:
-                                    new_path = m.group(2)
-                                else:
-                                    m2 = re.search(r"\+\+\+ b/(.+)$", part, re.MULTILINE)
-                                    if m2:
-                                        new_path = m2.group(1)
-
-                                additions = len(re.findall(r'^\+(?!\+\+)', part, re.MULTILINE))
-                                deletions = len(re.findall(r'^-(?!--)', part, re.MULTILINE))
-                                changes.append({'diff': part, 'new_path': new_path, 'additions': additions, 'deletions': deletions})
-            except Exception as e:
-                logger.debug(f"Failed to fetch commit changes {cid}: {str(e)}")
+        try:
+            r = http_client.get(self._commit_diff_url(until), headers=headers, params={'since': since},
+                                timeout=20, verify=False)
+        except Exception as e:
+            logger.debug(f"Failed to fetch range diff {since}..{until}: {str(e)}")
+            return None
+        if r.status_code != 200:
+            logger.debug(f"Bitbucket range diff {since}..{until} failed: {r.status_code}, falling back to per-commit diffs")
+            return None
+        changes = parse_diff_response(r)
+        logger.debug(f"Bitbucket range diff {since}..{until} -> {len(changes)} files")
         return changes
 
+    def _get_commit_changes(self, commit_id: str) -> list:
+        headers = {'Authorization': f'Bearer {self.bitbucket_token}'}
+        try:
+            r = http_client.get(self._commit_diff_url(commit_id), headers=headers, timeout=20, verify=False)
+            if r.status_code == 200:
+                return parse_diff_response(r)
+        except Exception as e:
+            logger.debug(f"Failed to fetch commit changes {commit_id}: {str(e)}")
+        return []
+
     def add_push_notes(self, message: str):
         # Post a comment to each commit that exposes an id/hash using Bitbucket Server commit comments API
         if not (self.repo_project and self.repo_slug):
@@ -424,7 +484,7 @@ class PushHandler:
         try:
             url = f"{self.bitbucket_url}/rest/api/latest/projects/{self.repo_project}/repos/{self.repo_slug}/commits/{last_commit_id}/comments"
             data = {'text': message}
-            r = requests.post(url, headers=headers, json=data, timeout=20, verify=False)
+            r = http_client.post(url, headers=headers, json=data, timeout=20, verify=False)
             logger.debug(f"Add comment to commit {last_commit_id} {url}: {r.status_code}, {r.text[:200]}")
             if r.status_code in (200, 201):
                 logger.info(f"Comment successfully added to commit {last_commit_id}.")
@@ -496,7 +556,7 @@ class PushHandler:
         }
 
         try:
-            r = requests.post(url, json=body, headers=headers, timeout=10, verify=False)
+            r = http_client.post(url, json=body, headers=headers, timeout=10, verify=False)
             logger.debug(f"add_memos POST {url}: {r.status_code}, {r.text[:200]}")
             if r.status_code in (200, 201):
                 logger.info('add_memos: memo posted successfully')
@@ -0,0 +1,78 @@
+from src.utils.payload_store import payload_store_enabled, save_payload
+
+# webhook payload 中 worker 实际用到的字段（GitLab / GitHub / Gitea / Bitbucket 的并集）
+# True 表示保留整个字段；dict 表示只保留其中列出的子字段；列表中的每个元素按同一规则裁剪
+_COMMIT_FIELDS = {
+    'id': True, 'message': True, 'title': True, 'timestamp': True, 'url': True, 'author': True,
+    'parent_ids': True, 'hash': True, 'displayId': True, 'commitId': True, 'sha': True, 'web_url': True,
+    'authorTimestamp': True,
+}
+
+_PULL_REQUEST_FIELDS = {
+    'id': True, 'number': True, 'pullRequestId': True, 'title': True, 'state': True, 'html_url': True,
+    'user': True, 'head': {'ref': True, 'sha': True},
+    'base': {'ref': True, 'sha': True, 'repo': {'full_name': True, 'name': True}},
+    'fromRef': True, 'toRef': True, 'author': True, 'links': True, 'changes': True, 'properties': True,
+    'commits': _COMMIT_FIELDS, 'source_branch': True, 'target_branch': True,
+}
+
+WEBHOOK_FIELDS = {
+    'object_kind': True, 'event_name': True, 'event_type': True, 'eventKey': True, 'action': True, 'date': True,
+    'ref': True, 'before': True, 'after': True, 'created': True, 'deleted': True, 'forced': True,
+    'user_username': True, 'user_name': True, 'user': True, 'sender': True, 'pusher': True, 'actor': True,
+    'number': True, 'total_commits_count': True, 'changes': True,
+    'project': {
+        'id': True, 'name': True, 'path_with_namespace': True, 'default_branch': True, 'web_url': True,
+        'homepage': True, 'git_http_url': True,
+    },
+    'repository': {
+        'id': True, 'name': True, 'full_name': True, 'fullName': True, 'html_url': True, 'default_branch': True,
+        'owner': {'login': True, 'name': True}, 'slug': True, 'project': True, 'projectKey': True,
+        'homepage': True, 'url': True, 'web_url': True, 'path_with_namespace': True, 'links': True,
+        'clone_url': True,
+    },
+    'commits': _COMMIT_FIELDS,
+    'object_attributes': {
+        'iid': True, 'id': True, 'target_project_id': True, 'source_project_id': True, 'action': True,
+        'source_branch': True, 'target_branch': True, 'url': True, 'title': True, 'state': True,
+        'last_commit': {'id': True, 'message': True, 'timestamp': True, 'url': True},
+    },
+    'pull_request': _PULL_REQUEST_FIELDS,
+    'pullRequest': _PULL_REQUEST_FIELDS,
+}
+
+RAW_PAYLOAD_ID_KEY = '_raw_payload_id'
+
+
+def _project(value, fields):
+    if fields is True:
+        return value
+    if isinstance(value, list):
+        return [_project(item, fields) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: _project(value[key], sub_fields) for key, sub_fields in fields.items() if key in value}
+
+
+class ReviewEvent:
+    """
+    在 webhook 入口处从原始 payload 中提取一次的精简事件，队列中只传递 worker 用到的字段。
+    精简后的数据保持原 payload 的结构，各平台的 handler 和 worker 无需改动；
+    原始 payload 可按需单独存储（RAW_PAYLOAD_STORE_ENABLED），通过 raw_payload_id 引用。
+    """
+
+    def __init__(self, payload: dict, raw_payload_id: str = None):
+        self.payload = payload
+        self.raw_payload_id = raw_payload_id
+
+    @classmethod
+    def from_webhook(cls, data: dict, store_raw: bool = None):
+        if store_raw is None:
+            store_raw = payload_store_enabled()
+        raw_payload_id = save_payload(data) if store_raw else None
+        return cls(_project(data, WEBHOOK_FIELDS), raw_payload_id)
+
+    def to_webhook_data(self) -> dict:
+        if self.raw_payload_id:
+            return {**self.payload, RAW_PAYLOAD_ID_KEY: self.raw_payload_id}
+        return self.payload
@@ -1,11 +1,81 @@
+import functools
 import os
-import re
-import time
 from urllib.parse import urljoin
-import fnmatch
 import requests
 
+from src.gitlab.webhook_handler import slugify_url
+from src.utils import http_client
+from src.utils.diff_readiness import wait_for_changes
+from src.utils.git_mirror import mirror_changes
+from src.utils.capability_cache import probe_endpoint, ENDPOINT_MISSING_STATUS, PROBE_OK, PROBE_NEXT, PROBE_STOP
 from src.utils.log import logger
+from src.utils.protected_branches import get_protected_branch_matcher, protected_branches_cache_key
+from src.utils.diff_index import DiffIndex, scan_diff
+from src.utils.parallel import map_ordered, OnceCache
+
+
+def _classify_status(ok_status: int):
+    """成功状态码为可用，404 / 405 表示该形式的接口不存在、换下一个，其他错误不再尝试"""
+    def classify(response):
+        if response.status_code == ok_status:
+            return PROBE_OK
+        return PROBE_NEXT if response.status_code in ENDPOINT_MISSING_STATUS else PROBE_STOP
+    return classify
+
+
+def fetch_compare(gitea_url: str, repo_full_name: str, gitea_token: str, base: str, head: str, **kwargs):
+    """
+    调用 compare API：不同 Gitea 版本支持 compare/{base}...{head} 或 compare?base=&head=，
+    每个 Gitea 实例探测一次可用的形式并缓存（SCM_CAPABILITY_TTL_SECONDS）
+    :return: (接口形式 'range' / 'query'，response)；都不可用时形式为 None
+    """
+    headers = {
+        'Authorization': f'token {gitea_token}'
+    }
+    url = urljoin(f"{gitea_url}/", f"api/v1/repos/{repo_full_name}/compare")
+    variants = {
+        'range': lambda: http_client.get(f"{url}/{base}...{head}", headers=headers, verify=False, **kwargs),
+        'query': lambda: http_client.get(url, headers=headers, params={'base': base, 'head': head}, verify=False,
+                                         **kwargs),
+    }
+    # compare 返回 404 也可能只是提交不存在（例如强制推送），不记录为不支持
+    return probe_endpoint(slugify_url(gitea_url), 'gitea_compare', variants, _classify_status(200),
+                          cache_unsupported=False)
+
+
+def fetch_commit_diff(gitea_url: str, repo_full_name: str, gitea_token: str, commit_sha: str):
+    """
+    获取 commit 的完整 diff 文本：不同 Gitea 版本支持 .diff 后缀、Accept: text/plain 或 diff=true 参数，
+    每个 Gitea 实例探测一次可用的形式并缓存；提交不存在（404）或请求失败时不记录为不支持
+    :return: (接口形式，response)；都不可用时形式为 None
+    """
+    url = urljoin(f"{gitea_url}/", f"api/v1/repos/{repo_full_name}/git/commits/{commit_sha}")
+    headers = {
+        'Authorization': f'token {gitea_token}'
+    }
+    plain_headers = {**headers, 'Accept': 'text/plain'}
+    variants = {
+        'diff_suffix': lambda: http_client.get(f"{url}.diff", headers=headers, verify=False),
+        'accept_text': lambda: http_client.get(f"{url}.diff", headers=plain_headers, verify=False),
+        'diff_param': lambda: http_client.get(url, headers=plain_headers, params={'diff': 'true'}, verify=False),
+    }
+
+    def classify(response):
+        if response.status_code == 200:
+            # 确保返回的是纯文本 diff，而不是 JSON（不支持该形式的版本会忽略后缀 / 参数，返回提交的 JSON）
+            if response.text and not response.text.strip().startswith('{'):
+                return PROBE_OK
+            return PROBE_NEXT
+        # 404 / 405 换下一个形式；5xx 等可能只是暂时故障，不再尝试，由调用方回退到逐个文件获取
+        return PROBE_NEXT if response.status_code in ENDPOINT_MISSING_STATUS else PROBE_STOP
+
+    # 失败可能只是个别提交或一次故障导致的，不记录为不支持
+    return probe_endpoint(slugify_url(gitea_url), 'gitea_commit_diff', variants, classify, cache_unsupported=False)
+
+
+def gitea_diff_concurrency() -> int:
+    """Push 事件中单独获取文件 diff 的并发数，1 表示串行"""
+    return max(int(os.getenv('GITEA_DIFF_CONCURRENCY', 8)), 1)
 
 
 def filter_changes(changes: list):
@@ -29,15 +99,17 @@ def filter_changes(changes: list):
         if not any(new_path.endswith(ext) for ext in supported_extensions):
             continue
         
-        # 优先使用已有的 additions 和 deletions 值（如果存在）
+        # 一次遍历 diff 得到增删行数和删除标记
+        diff_content = item.get('diff', '')
+        stats = scan_diff(diff_content)
+        if stats.deleted_file:
+            continue
+
+        # 优先使用已有的 additions 和 deletions 值（如果存在），没有提供时使用从 diff 中计算的值
         additions = item.get('additions', 0)
         deletions = item.get('deletions', 0)
-        
-        # 如果没有提供，尝试从 diff 中计算
-        diff_content = item.get('diff', '')
-        if additions == 0 and deletions == 0 and diff_content:
-            additions = len(re.findall(r'^\+(?!\+\+)', diff_content, re.MULTILINE))
-            deletions = len(re.findall(r'^-(?!--)', diff_content, re.MULTILINE))
+        if additions == 0 and deletions == 0:
+            additions, deletions = stats.additions, stats.deletions
         
         filtered_changes.append({
             'diff': diff_content,
@@ -59,6 +131,8 @@ class PushHandler:
         self.repo_full_name = None
         self.branch_name = None
         self.commit_list = []
+        # 当前任务内已获取的 API 响应与 diff 索引，避免每个文件重复请求
+        self._fetch_cache = OnceCache()
         self.parse_event_type()
 
     def parse_event_type(self):
@@ -122,12 +196,12 @@ class PushHandler:
 
         # Gitea commit comments API 路径可能需要确认
         # 注意：Gitea 可能不支持在 commit 上直接添加评论
-        # 尝试多种可能的路径
-        possible_urls = [
-            f"api/v1/repos/{self.repo_full_name}/commits/{last_commit_id}/comments",
-            f"api/v1/repos/{self.repo_full_name}/git/commits/{last_commit_id}/comments",
+        # 尝试多种可能的路径，可用的路径（或都不支持的结论）按 Gitea 实例缓存，之后不再逐个尝试
+        possible_urls = {
+            'commits': f"api/v1/repos/{self.repo_full_name}/commits/{last_commit_id}/comments",
+            'git_commits': f"api/v1/repos/{self.repo_full_name}/git/commits/{last_commit_id}/comments",
             # 某些 Gitea 版本可能使用不同的路径
-        ]
+        }
         
         headers = {
             'Authorization': f'token {self.gitea_token}',
@@ -136,30 +210,31 @@ class PushHandler:
         data = {
             'body': message
         }
-        
-        for url_path in possible_urls:
+
+        def post_comment(url_path: str):
             url = urljoin(f"{self.gitea_url}/", url_path)
-            response = requests.post(url, headers=headers, json=data, verify=False)
+            response = http_client.post(url, headers=headers, json=data, verify=False)
             logger.debug(f"Add comment to commit {last_commit_id} (trying {url_path}): {response.status_code}, {response.text[:200] if response.text else 'No response'}")
-            if response.status_code == 201:
-                logger.info("Comment successfully added to push commit.")
-                return
-            elif response.status_code == 404:
-                # 继续尝试下一个路径
-                logger.debug(f"Path {url_path} returned 404, trying next...")
-                continue
-            elif response.status_code == 403:
-                # 权限不足，不继续尝试
-                logger.error(f"Permission denied when adding comment to commit: {response.status_code}")
-                logger.error(response.text[:500] if response.text else 'No response')
-                return
-            else:
-                # 其他错误，记录并返回
-                logger.error(f"Failed to add comment: {response.status_code}")
-                logger.error(response.text[:500] if response.text else 'No response')
-                return
-        
-        # 所有路径都失败
+            return response
+
+        variants = {name: functools.partial(post_comment, url_path) for name, url_path in possible_urls.items()}
+        variant, response = probe_endpoint(slugify_url(self.gitea_url), 'gitea_commit_comments', variants,
+                                           _classify_status(201))
+        if variant:
+            logger.info("Comment successfully added to push commit.")
+            return
+        if response is not None and response.status_code == 403:
+            # 权限不足，不继续尝试
+            logger.error(f"Permission denied when adding comment to commit: {response.status_code}")
+            logger.error(response.text[:500] if response.text else 'No response')
+            return
+        if response is not None and response.status_code != 404:
+            # 其他错误，记录并返回
+            logger.error(f"Failed to add comment: {response.status_code}")
+            logger.error(response.text[:500] if response.text else 'No response')
+            return
+
+        # 所有路径都失败（或已缓存为不支持）
         logger.warn(f"All commit comment API paths failed for commit {last_commit_id}. "
                    f"Gitea may not support commit comments in this version. "
                    f"Review results will still be saved to database and sent via IM notification.")
@@ -175,53 +250,19 @@ class PushHandler:
         try:
             logger.debug(f"_get_file_diff called for {filename}, commit_sha={commit_sha}, parent_sha={parent_sha}")
             
-            # 方法1: 优先尝试使用 commit diff API（最直接、最可靠的方法，不需要 parent_sha）
-            # 注意：Gitea API 可能不支持 .diff 扩展名，需要尝试不同的格式
-            # 尝试格式1: GET /api/v1/repos/{owner}/{repo}/git/commits/{sha}.diff
-            url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_sha}.diff")
-            headers = {
-                'Authorization': f'token {self.gitea_token}'
-            }
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(f"Getting diff from git/commits/{commit_sha}.diff API: {response.status_code}, URL: {url}")
-            
-            # 如果 .diff 格式失败，尝试使用 Accept header 指定格式
-            if response.status_code != 200:
-                # 尝试格式2: 使用 Accept: text/plain header
-                headers['Accept'] = 'text/plain'
-                response = requests.get(url, headers=headers, verify=False)
-                logger.debug(f"Retrying with Accept: text/plain header: {response.status_code}")
-            
-            # 如果还是失败，尝试格式3: 使用 patch 参数
-            if response.status_code != 200:
-                url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_sha}")
-                params = {'diff': 'true'}
-                response = requests.get(url, headers=headers, params=params, verify=False)
-                logger.debug(f"Trying with diff=true parameter: {response.status_code}, URL: {url}")
-            
-            if response.status_code == 200:
-                # diff API 返回的是纯文本 diff 格式
-                diff_text = response.text
-                logger.debug(f"Got diff text from commit diff API, length: {len(diff_text)}, first 500 chars: {diff_text[:500] if diff_text else 'empty'}")
-                if diff_text and not diff_text.strip().startswith('{'):
-                    # 确保不是 JSON 错误响应
-                    # 从完整的 diff 中提取特定文件的部分
-                    file_diff = self._extract_file_diff_from_full_diff(diff_text, filename)
-                    if file_diff:
-                        logger.info(f"✅ Extracted diff for {filename} from commit diff API, length: {len(file_diff)}")
-                        return file_diff
-                    else:
-                        logger.warn(f"Could not extract diff for {filename} from full diff (diff text exists but extraction failed)")
-                        # 如果提取失败，尝试直接返回完整 diff（如果只有一个文件或 diff 不太大）
-                        if len(diff_text) < 50000:  # 如果 diff 不太大，直接返回
-                            logger.debug(f"Returning full diff as fallback for {filename} (extraction failed)")
-                            return diff_text
-                else:
-                    logger.warn(f"Diff API returned empty or invalid text for commit {commit_sha}")
-            elif response.status_code == 404:
-                logger.warn(f"Commit diff API returned 404 for {commit_sha}, API endpoint may not exist or commit not found")
-            else:
-                logger.warn(f"Commit diff API returned {response.status_code} for {commit_sha}: {response.text[:200] if response.text else 'No response'}")
+            # 方法1: 优先使用 commit diff API（最直接、最可靠的方法，不需要 parent_sha）
+            # 整个 commit 的 diff 每个任务只下载一次，拆分为 {路径: patch} 索引后供所有文件使用
+            diff_index = self._get_commit_diff_index(commit_sha)
+            if diff_index is not None:
+                file_diff = diff_index.get(filename)
+                if file_diff:
+                    logger.info(f"✅ Extracted diff for {filename} from commit diff API, length: {len(file_diff)}")
+                    return file_diff
+                logger.warn(f"Could not extract diff for {filename} from full diff (diff text exists but extraction failed)")
+                # 如果提取失败，尝试直接返回完整 diff（如果只有一个文件或 diff 不太大）
+                if len(diff_index.full_diff) < 50000:  # 如果 diff 不太大，直接返回
+                    logger.debug(f"Returning full diff as fallback for {filename} (extraction failed)")
+                    return diff_index.full_diff
             
             # 方法2: 如果 commit diff API 失败，尝试使用 compare API（需要 parent_sha）
             # 如果没有提供 parent_sha，尝试获取
@@ -232,14 +273,8 @@ class PushHandler:
             
             if parent_sha:
                 logger.debug(f"Trying compare API with parent_sha={parent_sha} to get diff for {filename}")
-                url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/compare/{parent_sha}...{commit_sha}")
-                headers = {
-                    'Authorization': f'token {self.gitea_token}'
-                }
-                response = requests.get(url, headers=headers, verify=False)
-                logger.debug(f"Getting diff from compare API: {response.status_code}, URL: {url}")
-                if response.status_code == 200:
-                    compare_data = response.json()
+                compare_data = self._get_compare(parent_sha, commit_sha)
+                if compare_data is not None:
                     # 检查是否有完整的 diff 信息
                     commits = compare_data.get('commits', [])
                     if commits:
@@ -253,14 +288,9 @@ class PushHandler:
                                         return patch
             
             # 方法2: 尝试从 commit 的详细信息中获取（使用 git/commits API）
-            url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_sha}")
-            headers = {
-                'Authorization': f'token {self.gitea_token}'
-            }
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(f"Getting file diff for {filename} from git/commits API: {response.status_code}")
-            if response.status_code == 200:
-                commit_data = response.json()
+            commit_data = self._get_json(f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_sha}")
+            logger.debug(f"Getting file diff for {filename} from git/commits API: {commit_data is not None}")
+            if commit_data is not None:
                 # 查找文件
                 files = commit_data.get('files', [])
                 logger.debug(f"Found {len(files)} files in git/commits response, checking for patch field")
@@ -274,11 +304,9 @@ class PushHandler:
                             logger.debug(f"No patch field in file object, file keys: {list(file.keys())}")
             
             # 方法3: 尝试使用 commits API（不是 git/commits）
-            url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/commits/{commit_sha}")
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(f"Getting file diff for {filename} from commits API: {response.status_code}")
-            if response.status_code == 200:
-                commit_data = response.json()
+            commit_data = self._get_json(f"api/v1/repos/{self.repo_full_name}/commits/{commit_sha}")
+            logger.debug(f"Getting file diff for {filename} from commits API: {commit_data is not None}")
+            if commit_data is not None:
                 files = commit_data.get('files', [])
                 logger.debug(f"Found {len(files)} files in commits response")
                 for file in files:
@@ -309,47 +337,57 @@ class PushHandler:
             logger.debug(traceback.format_exc())
         return ""
     
-    def _extract_file_diff_from_full_diff(self, full_diff: str, filename: str) -> str:
+    def _get_commit_diff_index(self, commit_sha: str):
         """
-        从完整的 diff 文本中提取特定文件的 diff
+        下载 commit 的完整 diff 并建立 {路径: patch} 索引，同一个任务内每个 commit 只下载一次
+        :return: DiffIndex；接口不可用或返回内容无效时返回 None
         """
-        try:
-            lines = full_diff.split('\n')
-            file_diff_lines = []
-            in_target_file = False
-            
-            logger.debug(f"Extracting diff for {filename} from full diff ({len(lines)} lines)")
-            
-            for i, line in enumerate(lines):
-                # 检查是否是目标文件的 diff 开始
-                # diff --git a/path/to/file b/path/to/file
-                if line.startswith('diff --git'):
-                    # 检查是否包含目标文件名（支持 a/ 和 b/ 前缀）
-                    # 例如：diff --git a/2.js b/2.js 或 diff --git a/src/2.js b/src/2.js
-                    if f"a/{filename}" in line or f"b/{filename}" in line or f"/{filename}" in line:
-                        in_target_file = True
-                        file_diff_lines.append(line)
-                        logger.debug(f"Found diff start for {filename} at line {i}: {line[:100]}")
-                    elif in_target_file:
-                        # 如果已经在目标文件中，遇到下一个文件的 diff 开始，停止
-                        logger.debug(f"Found next file diff at line {i}, stopping extraction")
-                        break
-                elif in_target_file:
-                    # 收集目标文件的所有 diff 行
-                    file_diff_lines.append(line)
-            
-            if file_diff_lines:
-                result = '\n'.join(file_diff_lines)
-                logger.debug(f"Extracted {len(file_diff_lines)} lines for {filename}, total length: {len(result)}")
-                return result
-            else:
-                logger.warn(f"No diff lines extracted for {filename} from full diff")
-        except Exception as e:
-            logger.error(f"Failed to extract file diff for {filename}: {str(e)}")
-            import traceback
-            logger.debug(traceback.format_exc())
-        return ""
-    
+        return self._fetch_cache.get(('commit_diff', commit_sha), lambda: self._fetch_commit_diff_index(commit_sha))
+
+    def _fetch_commit_diff_index(self, commit_sha: str):
+        variant, response = fetch_commit_diff(self.gitea_url, self.repo_full_name, self.gitea_token, commit_sha)
+        if variant:
+            # diff API 返回的是纯文本 diff 格式
+            diff_index = DiffIndex(response.text)
+            logger.debug(f"Indexed {len(diff_index)} file diffs for commit {commit_sha} (via {variant})")
+            return diff_index
+        if response is None:
+            logger.debug(f"Commit diff API is not supported by {self.gitea_url}, skipped.")
+        elif response.status_code == 200:
+            logger.warn(f"Diff API returned empty or invalid text for commit {commit_sha}")
+        elif response.status_code == 404:
+            logger.warn(f"Commit diff API returned 404 for {commit_sha}, API endpoint may not exist or commit not found")
+        else:
+            logger.warn(f"Commit diff API returned {response.status_code} for {commit_sha}: {response.text[:200] if response.text else 'No response'}")
+        return None
+
+    def _get_compare(self, base: str, head: str):
+        """
+        获取 compare 响应的 JSON，同一个任务内相同的 base / head 只请求一次
+        :return: 请求失败时返回 None
+        """
+        def fetch():
+            variant, response = fetch_compare(self.gitea_url, self.repo_full_name, self.gitea_token, base, head)
+            return response.json() if variant else None
+
+        return self._fetch_cache.get(('compare', base, head), fetch)
+
+    def _get_json(self, url_path: str):
+        """
+        GET 一个 Gitea API 并返回 JSON，同一个任务内相同的请求只发送一次
+        :return: 状态码非 200 时返回 None
+        """
+        def fetch():
+            url = urljoin(f"{self.gitea_url}/", url_path)
+            headers = {
+                'Authorization': f'token {self.gitea_token}'
+            }
+            response = http_client.conditional_get(url, headers=headers, verify=False)
+            logger.debug(f"GET {url}: {response.status_code}")
+            return response.json() if response.status_code == 200 else None
+
+        return self._fetch_cache.get(('json', url_path), fetch)
+
     def _get_file_content(self, filename: str, commit_sha: str) -> str:
         """
         获取文件在特定提交中的内容
@@ -364,7 +402,7 @@ class PushHandler:
                 'Authorization': f'token {self.gitea_token}'
             }
             params = {'ref': commit_sha}
-            response = requests.get(url, headers=headers, params=params, verify=False)
+            response = http_client.get(url, headers=headers, params=params, verify=False)
             logger.debug(f"Getting file content for {filename} at {commit_sha}: {response.status_code}, URL: {url}")
             
             if response.status_code == 200:
@@ -422,16 +460,8 @@ class PushHandler:
     def get_parent_commit_id(self, commit_id: str) -> str:
         # 获取提交的父提交ID
         # 使用 git/commits API（不是 commits API）
-        url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_id}")
-        headers = {
-            'Authorization': f'token {self.gitea_token}'
-        }
-        response = requests.get(url, headers=headers, verify=False)
-        logger.debug(
-            f"Get commit response from Gitea: {response.status_code}, URL: {url}")
-
-        if response.status_code == 200:
-            commit_data = response.json()
+        commit_data = self._get_json(f"api/v1/repos/{self.repo_full_name}/git/commits/{commit_id}")
+        if commit_data is not None:
             parents = commit_data.get('parents', [])
             if parents:
                 parent_sha = parents[0].get('sha', '')
@@ -440,26 +470,91 @@ class PushHandler:
             else:
                 logger.debug("No parents found for commit")
         else:
-            logger.warn(f"Failed to get parent commit: {response.status_code}")
+            logger.warn(f"Failed to get parent commit {commit_id}")
         return ""
 
+    def _patch_from_compare(self, file: dict, filename: str, commits: list) -> str:
+        """
+        从 compare 响应中获取文件的 patch：优先使用文件对象自带的 patch / diff，其次在各 commit 的文件列表中查找
+        """
+        logger.debug(f"Processing file: {filename}")
+
+        # Gitea 可能不直接返回 patch，需要单独获取
+        patch = file.get('patch', '')
+        # 如果没有 patch，尝试从其他字段获取
+        if not patch:
+            patch = file.get('diff', '')
+
+        logger.debug(f"File {filename}: patch from file object: {len(patch) if patch else 0}")
+
+        # 如果还是没有 patch，尝试从 commit 的 diff 中获取
+        if not patch and commits:
+            logger.debug(f"Trying to get patch from commits for {filename}")
+            # 尝试从 commit 数据中获取
+            for commit in commits:
+                commit_files = commit.get('files', [])
+                for cf in commit_files:
+                    if cf.get('filename') == filename:
+                        patch = cf.get('patch', '') or cf.get('diff', '')
+                        if patch:
+                            logger.debug(f"Found patch in commit data for {filename}, length: {len(patch)}")
+                            break
+                if patch:
+                    break
+        return patch
+
+    def _resolve_file_patch(self, filename: str, base: str, head: str, commits: list) -> str:
+        """
+        compare 响应中没有 patch 时单独获取文件的 diff，会在线程池中并发调用，只读取实例属性
+        """
+        patch = ''
+        # 优先使用已有的 base 和 head SHA（最可靠的方法）
+        logger.debug(f"No patch found yet for {filename}, base={base}, head={head}")
+        if base and head:
+            logger.debug(f"Attempting to get diff for {filename} using base={base}, head={head}")
+            patch = self._get_file_diff(filename, head, parent_sha=base)
+            if patch:
+                logger.info(f"✅ Successfully retrieved patch for {filename} via _get_file_diff with base/head, length: {len(patch)}")
+            else:
+                logger.warn(f"Could not retrieve patch for {filename} using base/head")
+        else:
+            logger.warn(f"Cannot get diff for {filename}: base={base}, head={head} (one or both are missing)")
+
+        # 如果还是没有 patch，尝试从最后一个 commit 中获取
+        if not patch and commits:
+            last_commit_sha = commits[-1].get('sha', '')
+            if last_commit_sha:
+                # 尝试从 commit 的 parents 中获取
+                commit_parents = commits[-1].get('parents', [])
+                commit_parent_sha = commit_parents[0].get('sha', '') if commit_parents else None
+                if commit_parent_sha:
+                    patch = self._get_file_diff(filename, last_commit_sha, parent_sha=commit_parent_sha)
+                else:
+                    patch = self._get_file_diff(filename, last_commit_sha)
+
+        # 如果还是没有 patch，尝试从 head commit 获取（使用默认的 parent 获取逻辑）
+        if not patch and head:
+            logger.debug(f"Attempting to get diff for {filename} from head commit {head} (auto-detect parent)")
+            patch = self._get_file_diff(filename, head)
+            if patch:
+                logger.info(f"Successfully retrieved patch for {filename} via _get_file_diff, length: {len(patch)}")
+            else:
+                logger.warn(f"Could not retrieve patch for {filename} even after trying all methods")
+        return patch
+
     def repository_compare(self, base: str, head: str):
         """
         比较两个提交之间的差异
         :param base: 基础提交 SHA（before）
         :param head: 目标提交 SHA（after）
         """
-        # 比较两个提交之间的差异
-        # 尝试使用 {base}...{head} 格式
-        url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/compare/{base}...{head}")
-        headers = {
-            'Authorization': f'token {self.gitea_token}'
-        }
-        response = requests.get(url, headers=headers, verify=False)
+        # 比较两个提交之间的差异，{base}...{head} 与查询参数两种形式由 fetch_compare 按 Gitea 实例探测
+        variant, response = fetch_compare(self.gitea_url, self.repo_full_name, self.gitea_token, base, head)
         logger.debug(
-            f"Get changes response from Gitea for repository_compare: {response.status_code}, {response.text}, URL: {url}")
+            f"Get changes response from Gitea for repository_compare ({variant}): "
+            f"{response.status_code if response is not None else '-'}, {response.text if response is not None else ''}")
 
-        if response.status_code == 200:
+        if variant == 'range':
             # Gitea 返回的格式可能不同，需要转换为统一格式
             compare_data = response.json()
             logger.debug(f"Compare data structure: {list(compare_data.keys())}")
@@ -505,73 +600,25 @@ class PushHandler:
                 logger.warn("No files found in compare response")
                 return []
             
-            diffs = []
             logger.debug(f"Processing {len(files)} files, base={base}, head={head}")
+            # 先从 compare 响应中取出已有的 patch，缺少 patch 的文件再并发单独获取
+            entries = []
             for file in files:
                 filename = file.get('filename', '')
                 if not filename:
                     continue
-                
-                logger.debug(f"Processing file: {filename}")
-                
-                # Gitea 可能不直接返回 patch，需要单独获取
-                patch = file.get('patch', '')
-                # 如果没有 patch，尝试从其他字段获取
-                if not patch:
-                    patch = file.get('diff', '')
-                
-                logger.debug(f"File {filename}: patch from file object: {len(patch) if patch else 0}")
-                
-                # 如果还是没有 patch，尝试从 commit 的 diff 中获取
-                if not patch and commits:
-                    logger.debug(f"Trying to get patch from commits for {filename}")
-                    # 尝试从 commit 数据中获取
-                    for commit in commits:
-                        commit_files = commit.get('files', [])
-                        for cf in commit_files:
-                            if cf.get('filename') == filename:
-                                patch = cf.get('patch', '') or cf.get('diff', '')
-                                if patch:
-                                    logger.debug(f"Found patch in commit data for {filename}, length: {len(patch)}")
-                                    break
-                        if patch:
-                            break
-                
-                # 如果仍然没有 patch，尝试单独获取文件的 diff
-                # 优先使用已有的 base 和 head SHA（最可靠的方法）
-                if not patch:
-                    logger.debug(f"No patch found yet for {filename}, base={base}, head={head}")
-                    if base and head:
-                        logger.debug(f"Attempting to get diff for {filename} using base={base}, head={head}")
-                        patch = self._get_file_diff(filename, head, parent_sha=base)
-                        if patch:
-                            logger.info(f"✅ Successfully retrieved patch for {filename} via _get_file_diff with base/head, length: {len(patch)}")
-                        else:
-                            logger.warn(f"Could not retrieve patch for {filename} using base/head")
-                    else:
-                        logger.warn(f"Cannot get diff for {filename}: base={base}, head={head} (one or both are missing)")
-                
-                # 如果还是没有 patch，尝试从最后一个 commit 中获取
-                if not patch and commits:
-                    last_commit_sha = commits[-1].get('sha', '')
-                    if last_commit_sha:
-                        # 尝试从 commit 的 parents 中获取
-                        commit_parents = commits[-1].get('parents', [])
-                        commit_parent_sha = commit_parents[0].get('sha', '') if commit_parents else None
-                        if commit_parent_sha:
-                            patch = self._get_file_diff(filename, last_commit_sha, parent_sha=commit_parent_sha)
-                        else:
-                            patch = self._get_file_diff(filename, last_commit_sha)
-                
-                # 如果还是没有 patch，尝试从 head commit 获取（使用默认的 parent 获取逻辑）
-                if not patch and head:
-                    logger.debug(f"Attempting to get diff for {filename} from head commit {head} (auto-detect parent)")
-                    patch = self._get_file_diff(filename, head)
-                    if patch:
-                        logger.info(f"Successfully retrieved patch for {filename} via _get_file_diff, length: {len(patch)}")
-                    else:
-                        logger.warn(f"Could not retrieve patch for {filename} even after trying all methods")
-                
+                entries.append((file, filename, self._patch_from_compare(file, filename, commits)))
+
+            missing = [filename for _, filename, patch in entries if not patch]
+            if missing:
+                logger.debug(f"Fetching patches for {len(missing)} files with concurrency {gitea_diff_concurrency()}")
+                fetched = dict(zip(missing, map_ordered(
+                    lambda filename: self._resolve_file_patch(filename, base, head, commits), missing,
+                    gitea_diff_concurrency())))
+                entries = [(file, filename, patch or fetched.get(filename, '')) for file, filename, patch in entries]
+
+            diffs = []
+            for file, filename, patch in entries:
                 # 从 stats 中获取 additions 和 deletions（如果文件对象中没有）
                 additions = file.get('additions', 0)
                 deletions = file.get('deletions', 0)
@@ -635,67 +682,60 @@ class PushHandler:
             if not diffs:
                 logger.warn("No diffs extracted, this might indicate an issue with the API response format")
             return diffs
-        elif response.status_code == 404:
-            # 如果 {base}...{head} 格式不工作，尝试查询参数格式
-            logger.info("Trying query parameter format for compare API")
-            url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/compare")
-            params = {'base': base, 'head': head}
-            response = requests.get(url, headers=headers, params=params, verify=False)
-            logger.debug(
-                f"Get changes response from Gitea (query params): {response.status_code}, {response.text}, URL: {url}")
-            if response.status_code == 200:
-                compare_data = response.json()
-                logger.debug(f"Compare data structure (query params): {list(compare_data.keys())}")
-                
-                # Gitea compare API 可能返回 files 在 commits 中，或者直接在根级别
-                files = compare_data.get('files', [])
-                # 如果没有 files，尝试从 commits 中获取
-                if not files:
-                    commits = compare_data.get('commits', [])
-                    if commits:
-                        # 从最后一个 commit 中获取 files
-                        last_commit = commits[-1]
-                        files = last_commit.get('files', [])
-                        logger.debug(f"Found {len(files)} files in last commit (query params)")
-                
-                if not files:
-                    logger.warn("No files found in compare response (query params)")
-                    return []
-                
-                diffs = []
-                for file in files:
-                    filename = file.get('filename', '')
-                    if not filename:
-                        continue
-                    
-                    patch = file.get('patch', '') or file.get('diff', '')
-                    # 如果还是没有 patch，尝试单独获取
-                    if not patch and head:
-                        patch = self._get_file_diff(filename, head)
-                    
-                    additions = file.get('additions', 0)
-                    deletions = file.get('deletions', 0)
-                    if additions == 0 and deletions == 0:
-                        stats = file.get('stats', {})
-                        if stats:
-                            additions = stats.get('additions', 0)
-                            deletions = stats.get('deletions', 0)
-                    
-                    diff = {
-                        'old_path': filename,
-                        'new_path': filename,
-                        'diff': patch,
-                        'additions': additions,
-                        'deletions': deletions,
-                    }
-                    diffs.append(diff)
-                    logger.debug(f"Added file {filename} with patch length: {len(patch) if patch else 0}")
+        elif variant == 'query':
+            compare_data = response.json()
+            logger.debug(f"Compare data structure (query params): {list(compare_data.keys())}")
+            
+            # Gitea compare API 可能返回 files 在 commits 中，或者直接在根级别
+            files = compare_data.get('files', [])
+            # 如果没有 files，尝试从 commits 中获取
+            if not files:
+                commits = compare_data.get('commits', [])
+                if commits:
+                    # 从最后一个 commit 中获取 files
+                    last_commit = commits[-1]
+                    files = last_commit.get('files', [])
+                    logger.debug(f"Found {len(files)} files in last commit (query params)")
+            
+            if not files:
+                logger.warn("No files found in compare response (query params)")
+                return []
+            
+            entries = [(file, file.get('filename', ''), file.get('patch', '') or file.get('diff', ''))
+                       for file in files if file.get('filename', '')]
+            # 如果还是没有 patch，尝试单独获取（并发获取，结果保持文件顺序）
+            missing = [filename for _, filename, patch in entries if not patch] if head else []
+            fetched = dict(zip(missing, map_ordered(lambda filename: self._get_file_diff(filename, head), missing,
+                                                    gitea_diff_concurrency())))
+
+            diffs = []
+            for file, filename, patch in entries:
+                patch = patch or fetched.get(filename, '')
+
+                additions = file.get('additions', 0)
+                deletions = file.get('deletions', 0)
+                if additions == 0 and deletions == 0:
+                    stats = file.get('stats', {})
+                    if stats:
+                        additions = stats.get('additions', 0)
+                        deletions = stats.get('deletions', 0)
                 
-                logger.info(f"Extracted {len(diffs)} files from compare response (query params)")
-                return diffs
+                diff = {
+                    'old_path': filename,
+                    'new_path': filename,
+                    'diff': patch,
+                    'additions': additions,
+                    'deletions': deletions,
+                }
+                diffs.append(diff)
+                logger.debug(f"Added file {filename} with patch length: {len(patch) if patch else 0}")
+            
+            logger.info(f"Extracted {len(diffs)} files from compare response (query params)")
+            return diffs
         else:
             logger.warn(
-                f"Failed to get changes for repository_compare: {response.status_code}, {response.text}")
+                f"Failed to get changes for repository_compare: {response.status_code if response is not None else '-'}, "
+                f"{response.text if response is not None else ''}")
             return []
 
     def get_push_changes(self) -> list:
@@ -735,8 +775,12 @@ class PushHandler:
                     else:
                         logger.warn("Could not get parent commit for new branch.")
                         return []
-            
-            changes = self.repository_compare(before, after)
+
+            changes = mirror_changes('gitea', self.gitea_url, slugify_url(self.gitea_url), self.repo_full_name,
+                                     self.gitea_token, before, after,
+                                     clone_url=self.webhook_data.get('repository', {}).get('clone_url'))
+            if changes is None:
+                changes = self.repository_compare(before, after)
             if not changes:
                 logger.info("No changes found in push event after repository_compare.")
                 # 即使没有 changes，也记录一下，方便调试
@@ -816,7 +860,7 @@ class PushHandler:
         logger.info(f"Attempting to add comment to issue #{issue_number} in {self.repo_full_name}")
         
         try:
-            response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
+            response = http_client.post(url, headers=headers, json=data, verify=False, timeout=30)
             if response.status_code == 201:
                 logger.info(f"✅ Comment successfully added to issue #{issue_number}")
             else:
@@ -851,7 +895,7 @@ class PushHandler:
         }
         
         try:
-            response = requests.get(url, headers=headers, params=params, verify=False, timeout=30)
+            response = http_client.conditional_get(url, headers=headers, params=params, verify=False, timeout=30)
             if response.status_code == 200:
                 issues = response.json()
                 for issue in issues:
@@ -897,7 +941,7 @@ class PushHandler:
             data['labels'] = labels
         
         try:
-            response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
+            response = http_client.post(url, headers=headers, json=data, verify=False, timeout=30)
             if response.status_code == 201:
                 issue = response.json()
                 issue_number = issue.get('number')
@@ -961,6 +1005,8 @@ class PullRequestHandler:
         self.event_type = None
         self.repo_full_name = None
         self.action = None
+        # 当前任务内已获取的 compare 响应与 diff 索引，避免每个文件重复请求
+        self._fetch_cache = OnceCache()
         self.parse_event_type()
 
     def parse_event_type(self):
@@ -1002,65 +1048,65 @@ class PullRequestHandler:
             logger.warn(f"Invalid event type: {self.event_type}. Only 'pull_request' event is supported now.")
             return []
 
-        # Gitea pull request changes API可能存在延迟，多次尝试
-        max_retries = 3  # 最大重试次数
-        retry_delay = 10  # 重试间隔时间（秒）
-        for attempt in range(max_retries):
-            # 调用 Gitea API 获取 Pull Request 的 files（变更）
-            url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/files")
-            headers = {
-                'Authorization': f'token {self.gitea_token}',
-                'Content-Type': 'application/json'
-            }
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(
-                f"Get changes response from Gitea (attempt {attempt + 1}): {response.status_code}, {response.text}, URL: {url}")
+        # 配置了本地镜像时直接在本地计算 base 与 head 之间的 diff
+        pull_request = self.webhook_data.get('pull_request', {})
+        changes = mirror_changes('gitea', self.gitea_url, slugify_url(self.gitea_url), self.repo_full_name,
+                                 self.gitea_token, pull_request.get('base', {}).get('sha'),
+                                 pull_request.get('head', {}).get('sha'),
+                                 clone_url=self.webhook_data.get('repository', {}).get('clone_url'), merge_base=True)
+        if changes is not None:
+            return changes
+
+        # Gitea pull request changes API可能存在延迟，diff 为空时按指数退避重试（见 wait_for_changes）
+        url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/files")
+        headers = {
+            'Authorization': f'token {self.gitea_token}',
+            'Content-Type': 'application/json'
+        }
 
+        def fetch_changes():
+            # 调用 Gitea API 获取 Pull Request 的 files（变更）
+            response = http_client.get(url, headers=headers, verify=False)
+            logger.debug(f"Get changes response from Gitea: {response.status_code}, {response.text}, URL: {url}")
             # 检查请求是否成功
-            if response.status_code == 200:
-                files = response.json()
-                if files:
-                    # 获取 PR 的 base 和 head 信息用于获取 diff
-                    pull_request = self.webhook_data.get('pull_request', {})
-                    base = pull_request.get('base', {})
-                    head = pull_request.get('head', {})
-                    base_sha = base.get('sha', '')
-                    head_sha = head.get('sha', '')
-                    
-                    # 转换成统一格式的changes
-                    changes = []
-                    for file in files:
-                        filename = file.get('filename', '')
-                        patch = file.get('patch', '')
-                        
-                        # 如果 patch 为空，尝试从 compare API 获取
-                        if not patch and base_sha and head_sha:
-                            logger.debug(f"No patch in file object for {filename}, trying to get from compare API")
-                            patch = self._get_file_diff_from_pr(filename, base_sha, head_sha)
-                        
-                        change = {
-                            'old_path': filename,
-                            'new_path': filename,
-                            'diff': patch,
-                            'additions': file.get('additions', 0),
-                            'deletions': file.get('deletions', 0)
-                        }
-                        changes.append(change)
-                    return changes
-                else:
-                    logger.info(
-                        f"Changes is empty, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries}), URL: {url}")
-                    time.sleep(retry_delay)
-            else:
+            if response.status_code != 200:
                 logger.warn(f"Failed to get changes from Gitea (URL: {url}): {response.status_code}, {response.text}")
-                return []
+                return None
+            return response.json()
+
+        files = wait_for_changes('gitea', fetch_changes, f'URL: {url}')
 
-        logger.warning(f"Max retries ({max_retries}) reached. Changes is still empty.")
-        return []  # 达到最大重试次数后返回空列表
+        # 获取 PR 的 base 和 head 信息用于获取 diff
+        pull_request = self.webhook_data.get('pull_request', {})
+        base = pull_request.get('base', {})
+        head = pull_request.get('head', {})
+        base_sha = base.get('sha', '')
+        head_sha = head.get('sha', '')
+
+        # 转换成统一格式的changes
+        changes = []
+        for file in files:
+            filename = file.get('filename', '')
+            patch = file.get('patch', '')
+
+            # 如果 patch 为空，尝试从 compare API 获取
+            if not patch and base_sha and head_sha:
+                logger.debug(f"No patch in file object for {filename}, trying to get from compare API")
+                patch = self._get_file_diff_from_pr(filename, base_sha, head_sha)
+
+            change = {
+                'old_path': filename,
+                'new_path': filename,
+                'diff': patch,
+                'additions': file.get('additions', 0),
+                'deletions': file.get('deletions', 0)
+            }
+            changes.append(change)
+        return changes
 
     def _get_file_diff_from_pr(self, filename: str, base_sha: str, head_sha: str) -> str:
         """
-        从 PR 的 base 和 head 获取特定文件的 diff
+        从 PR 的 base 和 head 获取特定文件的 diff；compare 响应和 head commit 的完整 diff 每个任务只获取一次
         :param filename: 文件名
         :param base_sha: base 分支的 SHA
         :param head_sha: head 分支的 SHA
@@ -1068,15 +1114,9 @@ class PullRequestHandler:
         """
         try:
             # 使用 compare API 获取 diff
-            url = urljoin(f"{self.gitea_url}/", 
-                          f"api/v1/repos/{self.repo_full_name}/compare/{base_sha}...{head_sha}")
-            headers = {
-                'Authorization': f'token {self.gitea_token}'
-            }
-            response = requests.get(url, headers=headers, verify=False, timeout=30)
-            
-            if response.status_code == 200:
-                compare_data = response.json()
+            compare_data = self._fetch_cache.get(('compare', base_sha, head_sha),
+                                                 lambda: self._fetch_compare(base_sha, head_sha))
+            if compare_data is not None:
                 commits = compare_data.get('commits', [])
                 
                 # 从 commits 中查找文件
@@ -1098,59 +1138,36 @@ class PullRequestHandler:
                             logger.debug(f"Got patch for {filename} from compare API files, length: {len(patch)}")
                             return patch
                 
-                # 如果还是没有，尝试使用 commit diff API
+                # 如果还是没有，从 head commit 的完整 diff 索引中获取
                 logger.debug(f"Trying commit diff API for {filename}")
-                diff_url = urljoin(f"{self.gitea_url}/", 
-                                   f"api/v1/repos/{self.repo_full_name}/git/commits/{head_sha}.diff")
-                diff_response = requests.get(diff_url, headers=headers, verify=False, timeout=30)
-                if diff_response.status_code == 200:
-                    full_diff = diff_response.text
-                    # 提取特定文件的 diff
-                    from src.gitea.webhook_handler import PushHandler
-                    # 创建一个临时的 PushHandler 实例来使用 _extract_file_diff_from_full_diff 方法
-                    # 或者直接在这里实现提取逻辑
-                    file_diff = self._extract_file_diff_from_full_diff(full_diff, filename)
-                    if file_diff:
-                        logger.debug(f"Extracted diff for {filename} from commit diff, length: {len(file_diff)}")
-                        return file_diff
-            else:
-                logger.warn(f"Compare API returned {response.status_code} for {filename}")
+                diff_index = self._fetch_cache.get(('commit_diff', head_sha),
+                                                   lambda: self._fetch_commit_diff_index(head_sha))
+                file_diff = diff_index.get(filename) if diff_index is not None else ''
+                if file_diff:
+                    logger.debug(f"Extracted diff for {filename} from commit diff, length: {len(file_diff)}")
+                    return file_diff
         except Exception as e:
             logger.error(f"Exception when getting file diff for {filename}: {str(e)}")
             import traceback
             logger.debug(traceback.format_exc())
         return ""
 
-    def _extract_file_diff_from_full_diff(self, full_diff: str, filename: str) -> str:
-        """
-        从完整的 diff 文本中提取特定文件的 diff
-        """
-        try:
-            lines = full_diff.split('\n')
-            file_diff_lines = []
-            in_target_file = False
-            
-            for i, line in enumerate(lines):
-                # 检查是否是目标文件的 diff 开始
-                if line.startswith('diff --git'):
-                    # 检查是否包含目标文件名
-                    if f"a/{filename}" in line or f"b/{filename}" in line or f"/{filename}" in line:
-                        in_target_file = True
-                        file_diff_lines.append(line)
-                    elif in_target_file:
-                        # 如果已经在目标文件中，遇到下一个文件的 diff 开始，停止
-                        break
-                elif in_target_file:
-                    # 收集目标文件的所有 diff 行
-                    file_diff_lines.append(line)
-            
-            if file_diff_lines:
-                result = '\n'.join(file_diff_lines)
-                logger.debug(f"Extracted {len(file_diff_lines)} lines for {filename}")
-                return result
-        except Exception as e:
-            logger.error(f"Failed to extract file diff for {filename}: {str(e)}")
-        return ""
+    def _fetch_compare(self, base_sha: str, head_sha: str):
+        variant, response = fetch_compare(self.gitea_url, self.repo_full_name, self.gitea_token, base_sha, head_sha,
+                                          timeout=30)
+        if variant:
+            return response.json()
+        logger.warn(f"Compare API returned {response.status_code if response is not None else '-'} "
+                    f"for {base_sha}...{head_sha}")
+        return None
+
+    def _fetch_commit_diff_index(self, commit_sha: str):
+        variant, response = fetch_commit_diff(self.gitea_url, self.repo_full_name, self.gitea_token, commit_sha)
+        if variant:
+            diff_index = DiffIndex(response.text)
+            logger.debug(f"Indexed {len(diff_index)} file diffs for commit {commit_sha} (via {variant})")
+            return diff_index
+        return None
 
     def get_pull_request_commits(self) -> list:
         # 检查是否为 Pull Request Hook 事件
@@ -1163,7 +1180,7 @@ class PullRequestHandler:
             'Authorization': f'token {self.gitea_token}',
             'Content-Type': 'application/json'
         }
-        response = requests.get(url, headers=headers, verify=False)
+        response = http_client.conditional_get(url, headers=headers, verify=False)
         logger.debug(f"Get commits response from Gitea: {response.status_code}, {response.text}")
         
         # 检查请求是否成功
@@ -1223,49 +1240,57 @@ class PullRequestHandler:
         logger.info(f"Attempting to add comment to Gitea PR #{self.pull_request_number} in {self.repo_full_name}")
         logger.debug(f"Comment length: {len(review_result)} characters")
         
-        # 尝试多个可能的 API 端点（Gitea 不同版本可能使用不同的端点）
-        possible_urls = [
-            f"api/v1/repos/{self.repo_full_name}/issues/{self.pull_request_number}/comments",
-            f"api/v1/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/comments",
-        ]
-        
-        for url_path in possible_urls:
+        # 尝试多个可能的 API 端点（Gitea 不同版本可能使用不同的端点），可用的端点按 Gitea 实例缓存
+        possible_urls = {
+            'issues': f"api/v1/repos/{self.repo_full_name}/issues/{self.pull_request_number}/comments",
+            'pulls': f"api/v1/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/comments",
+        }
+
+        def post_comment(url_path: str):
             url = urljoin(f"{self.gitea_url}/", url_path)
             logger.debug(f"Trying API endpoint: {url}")
-            
             try:
-                response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
-                logger.info(f"Add comment to Gitea PR {url}: status_code={response.status_code}")
-                
-                if response.status_code == 201:
-                    logger.info("✅ Comment successfully added to pull request.")
-                    return
-                elif response.status_code == 404:
-                    # 404 可能表示端点不存在，尝试下一个
-                    logger.debug(f"Endpoint {url_path} returned 404, trying next endpoint...")
-                    continue
-                else:
-                    logger.error(f"❌ Failed to add comment: status_code={response.status_code}")
-                    logger.error(f"Response text: {response.text[:500] if response.text else 'No response text'}")
-                    
-                    # 尝试提供更详细的错误信息
-                    if response.status_code == 403:
-                        logger.error("403 Forbidden - Check if token has write permissions to the repository")
-                        # 权限问题，不继续尝试其他端点
-                        return
-                    elif response.status_code == 401:
-                        logger.error("401 Unauthorized - Check if token is valid")
-                        # 认证问题，不继续尝试其他端点
-                        return
-                    else:
-                        # 其他错误，尝试下一个端点
-                        logger.debug(f"Error {response.status_code} with endpoint {url_path}, trying next...")
-                        continue
+                response = http_client.post(url, headers=headers, json=data, verify=False, timeout=30)
             except requests.exceptions.RequestException as e:
                 logger.error(f"Request exception when adding comment to {url_path}: {str(e)}")
-                # 网络错误，尝试下一个端点
-                continue
-        
+                # 网络错误，评论可能已经发布，不再尝试其他端点
+                return None
+            logger.info(f"Add comment to Gitea PR {url}: status_code={response.status_code}")
+            return response
+
+        def classify(response):
+            if response is None:
+                return PROBE_STOP
+            if response.status_code == 201:
+                return PROBE_OK
+            if response.status_code in ENDPOINT_MISSING_STATUS:
+                # 端点不存在，评论没有发布，尝试下一个
+                logger.debug(f"Endpoint returned {response.status_code}, trying next endpoint...")
+                return PROBE_NEXT
+            logger.error(f"❌ Failed to add comment: status_code={response.status_code}")
+            logger.error(f"Response text: {response.text[:500] if response.text else 'No response text'}")
+            # 尝试提供更详细的错误信息
+            if response.status_code == 403:
+                logger.error("403 Forbidden - Check if token has write permissions to the repository")
+                # 权限问题，不继续尝试其他端点
+                return PROBE_STOP
+            if response.status_code == 401:
+                logger.error("401 Unauthorized - Check if token is valid")
+                # 认证问题，不继续尝试其他端点
+                return PROBE_STOP
+            # 其他错误（例如 5xx）时评论可能已经发布，不再尝试其他端点，避免重复发布
+            return PROBE_STOP
+
+        variants = {name: functools.partial(post_comment, url_path) for name, url_path in possible_urls.items()}
+        # 失败可能是网络错误或单个 PR 的问题，不记录为不支持
+        variant, response = probe_endpoint(slugify_url(self.gitea_url), 'gitea_pr_comments', variants, classify,
+                                           cache_unsupported=False)
+        if variant:
+            logger.info("✅ Comment successfully added to pull request.")
+            return
+        if response is not None and response.status_code in (401, 403):
+            return
+
         # 所有端点都失败了
         logger.error(f"❌ All API endpoints failed. Could not add comment to PR #{self.pull_request_number}")
         import traceback
@@ -1334,7 +1359,7 @@ class PullRequestHandler:
         logger.info(f"Attempting to add comment to issue #{issue_number} in {self.repo_full_name}")
         
         try:
-            response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
+            response = http_client.post(url, headers=headers, json=data, verify=False, timeout=30)
             if response.status_code == 201:
                 logger.info(f"✅ Comment successfully added to issue #{issue_number}")
             else:
@@ -1370,7 +1395,7 @@ class PullRequestHandler:
         }
         
         try:
-            response = requests.get(url, headers=headers, params=params, verify=False, timeout=30)
+            response = http_client.conditional_get(url, headers=headers, params=params, verify=False, timeout=30)
             if response.status_code == 200:
                 issues = response.json()
                 # 精确匹配标题
@@ -1419,7 +1444,7 @@ class PullRequestHandler:
             data['labels'] = labels
         
         try:
-            response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
+            response = http_client.post(url, headers=headers, json=data, verify=False, timeout=30)
             if response.status_code == 201:
                 issue = response.json()
                 issue_number = issue.get('number')
@@ -1477,6 +1502,17 @@ class PullRequestHandler:
         return "\n".join(body_lines)
 
     def target_branch_protected(self) -> bool:
+        # 受保护分支列表很少变化，按仓库缓存（见 src/utils/protected_branches.py）
+        matcher = get_protected_branch_matcher(
+            protected_branches_cache_key('gitea', self.gitea_url, self.repo_full_name), self._fetch_protected_branches)
+        if matcher is None:
+            return False
+        pull_request = self.webhook_data.get('pull_request', {})
+        target_branch = pull_request.get('base', {}).get('ref', '')
+        # 受保护分支列表中的名称支持通配符，由预编译的匹配器一次匹配
+        return matcher.matches(target_branch)
+
+    def _fetch_protected_branches(self):
         # 获取受保护的分支列表
         url = urljoin(f"{self.gitea_url}/", f"api/v1/repos/{self.repo_full_name}/branches")
         params = {'protected': 'true'}
@@ -1485,14 +1521,10 @@ class PullRequestHandler:
             'Content-Type': 'application/json'
         }
 
-        response = requests.get(url, headers=headers, params=params, verify=False)
+        response = http_client.conditional_get(url, headers=headers, params=params, verify=False)
         if response.status_code == 200:
-            data = response.json()
-            pull_request = self.webhook_data.get('pull_request', {})
-            target_branch = pull_request.get('base', {}).get('ref', '')
-            # 遍历受保护分支列表，使用 fnmatch 匹配（支持通配符）
-            return any(fnmatch.fnmatch(target_branch, item.get('name', '')) for item in data)
+            return [item.get('name', '') for item in response.json()]
         else:
             logger.warn(f"Failed to get protected branches: {response.status_code}, {response.text}")
-            return False
+            return None
 
@@ -1,10 +1,17 @@
 import os
-import re
 import time
+from urllib.parse import parse_qs, urlparse
 
-import requests
-import fnmatch
+from src.utils import http_client
+from src.gitlab.webhook_handler import slugify_url
+from src.utils.diff_index import scan_diff
+from src.utils.diff_readiness import FilteredChanges, backoff_delay, wait_for_changes
+from src.utils.git_mirror import mirror_changes
 from src.utils.log import logger
+from src.utils.parallel import map_ordered
+from src.utils.payload_log import BoundedRepr
+from src.utils.stream_download import read_json_array, stream_enabled
+from src.utils.protected_branches import get_protected_branch_matcher, protected_branches_cache_key
 
 
 
@@ -24,37 +31,143 @@ def filter_changes(changes: list):
             logger.info(f"Detected file deletion via status field: {change.get('new_path')}")
             continue
             
-        # 如果没有status字段或status不为"removed"，继续检查diff模式
-        diff = change.get('diff', '')
-        if diff:
-            diff_header_match = re.match(r'@@ -\d+,\d+ \+0,0 @@', diff)
-            if diff_header_match:
-                # 检查除了diff头部外的所有行是否都以减号开头
-                diff_lines = diff.split('\n')[1:]  # 跳过diff头部
-                if all(line.startswith('-') or not line for line in diff_lines):
-                    logger.info(f"Detected file deletion via diff pattern: {change.get('new_path')}")
-                    continue
-                    
-        not_deleted_changes.append(change)
+        # 如果没有status字段或status不为"removed"，继续检查diff模式（新文件一侧为空且没有新增行）
+        stats = scan_diff(change.get('diff', ''))
+        if stats.deleted_file:
+            logger.info(f"Detected file deletion via diff pattern: {change.get('new_path')}")
+            continue
+
+        not_deleted_changes.append((change, stats))
     
-    logger.info(f"SUPPORTED_EXTENSIONS: {supported_extensions}")
-    logger.info(f"After filtering deleted files: {not_deleted_changes}")
+    logger.debug('SUPPORTED_EXTENSIONS: %s', supported_extensions)
+    logger.info('After filtering deleted files: %d of %d changes', len(not_deleted_changes), len(changes))
     
-    # 过滤 `new_path` 以支持的扩展名结尾的元素, 仅保留diff和new_path字段
+    # 过滤 `new_path` 以支持的扩展名结尾的元素, 仅保留diff和new_path字段；
+    # API 没有返回增删行数时（例如 commit 的 diff）使用扫描 diff 得到的值
     filtered_changes = [
         {
             'diff': item.get('diff', ''),
             'new_path': item['new_path'],
-            'additions': item.get('additions', 0),
-            'deletions': item.get('deletions', 0),
+            'additions': item.get('additions') or stats.additions,
+            'deletions': item.get('deletions') or stats.deletions,
         }
-        for item in not_deleted_changes
+        for item, stats in not_deleted_changes
         if any(item.get('new_path', '').endswith(ext) for ext in supported_extensions)
     ]
-    logger.info(f"After filtering by extension: {filtered_changes}")
+    logger.info('After filtering by extension: %d files %s', len(filtered_changes),
+                BoundedRepr([item['new_path'] for item in filtered_changes]))
     return filtered_changes
 
 
+# 列表接口每页的条数（GitHub 允许的最大值）
+PER_PAGE = 100
+# 单个分页最多请求的次数，仅对 429 / 5xx 重试
+PAGE_ATTEMPTS = 3
+
+
+def github_diff_concurrency() -> int:
+    """逐个 commit 获取变更、并发获取列表分页时的并发数，1 表示串行"""
+    return max(int(os.getenv('GITHUB_DIFF_CONCURRENCY', 8)), 1)
+
+
+def fetch_all_pages(fetch_page: callable, read_page: callable, first_response, description: str = '',
+                    filter_page: callable = None) -> list:
+    '''
+    读取列表接口的所有分页：第 1 页的 Link 头中有 rel="last" 时，其余分页并发获取；只有 rel="next" 时逐页获取
+    :param fetch_page: fetch_page(page) 发起请求并返回 response
+    :param read_page: read_page(response) 返回该页的元素列表
+    :param first_response: 第 1 页的 200 响应
+    :param filter_page: filter_page(items) 在每一页读取后立即过滤该页的元素，只有过滤后的元素会保留到最后
+    :return: 按分页顺序合并的元素，指定 filter_page 时返回 FilteredChanges（total 为过滤前的元素数）；
+             任何一页重试后仍获取失败时返回 None，不返回不完整的列表
+    '''
+    last = first_response.links.get('last', {}).get('url')
+    has_next = 'next' in first_response.links
+
+    def read_items(response):
+        items = read_page(response)
+        if filter_page is None:
+            return items, len(items), response
+        return filter_page(items), len(items), response
+
+    first = read_items(first_response)
+
+    def read(page):
+        for attempt in range(PAGE_ATTEMPTS):
+            response = fetch_page(page)
+            if response.status_code == 200:
+                return read_items(response)
+            logger.warn('Failed to get page %s from GitHub (attempt %d/%d): %s, %s %s', page, attempt + 1,
+                        PAGE_ATTEMPTS, response.status_code, response.text[:200], description)
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt + 1 < PAGE_ATTEMPTS:
+                time.sleep(backoff_delay(attempt, 1, 5))
+        return None
+
+    if last:
+        last_page = int(parse_qs(urlparse(last).query).get('page', ['1'])[0])
+        pages = list(range(2, last_page + 1))
+        logger.debug(f"Fetching {len(pages)} more pages with concurrency {github_diff_concurrency()} {description}")
+        results = map_ordered(read, pages, github_diff_concurrency())
+    else:
+        results = []
+        page = 1
+        while has_next:
+            page += 1
+            result = read(page)
+            results.append(result)
+            has_next = result is not None and 'next' in result[2].links
+
+    if any(result is None for result in results):
+        logger.error(f"Some pages could not be fetched, the list is incomplete and not used. {description}")
+        return None
+    results.insert(0, first)
+    items = [] if filter_page is None else FilteredChanges([], sum(result[1] for result in results))
+    for result in results:
+        items.extend(result[0])
+    return items
+
+
+def files_to_changes(files: list) -> list:
+    """把 compare / commit API 返回的 files 转换为GitLab格式的diffs"""
+    return [
+        {
+            'old_path': file.get('previous_filename') or file.get('filename'),
+            'new_path': file.get('filename'),
+            'diff': file.get('patch', ''),
+            'status': file.get('status', ''),
+            'additions': file.get('additions', 0),
+            'deletions': file.get('deletions', 0),
+        }
+        for file in files
+    ]
+
+
+def merge_changes_by_path(changes: list) -> list:
+    '''
+    合并多个 commit 中同一文件的变更：diff 按 commit 顺序拼接，增删行数累加；
+    先新增后删除的文件保留 removed 状态（由 filter_changes 过滤），重命名的文件合并到新路径下
+    '''
+    merged = {}
+    for change in changes:
+        path = change.get('new_path')
+        old_path = change.get('old_path')
+        existing = merged.pop(old_path, None) if old_path and old_path != path else None
+        existing = existing or merged.get(path)
+        if existing is None:
+            merged[path] = dict(change)
+            continue
+        existing['diff'] = '\n'.join(diff for diff in (existing.get('diff'), change.get('diff')) if diff)
+        existing['additions'] = existing.get('additions', 0) + change.get('additions', 0)
+        existing['deletions'] = existing.get('deletions', 0) + change.get('deletions', 0)
+        if change.get('status') == 'removed' or existing.get('status') != 'added':
+            existing['status'] = change.get('status', '')
+        existing['new_path'] = path
+        merged[path] = existing
+    return list(merged.values())
+
+
 class PullRequestHandler:
     def __init__(self, webhook_data: dict, github_token: str, github_url: str):
         self.pull_request_number = None
@@ -78,51 +191,58 @@ class PullRequestHandler:
         self.action = self.webhook_data.get('action')
 
     def get_pull_request_changes(self) -> list:
+        # 返回经过 filter_changes 过滤的 changes
         # 检查是否为 Pull Request Hook 事件
         if self.event_type != 'pull_request':
             logger.warn(f"Invalid event type: {self.event_type}. Only 'pull_request' event is supported now.")
             return []
 
-        # GitHub pull request changes API可能存在延迟，多次尝试
-        max_retries = 3  # 最大重试次数
-        retry_delay = 10  # 重试间隔时间（秒）
-        for attempt in range(max_retries):
-            # 调用 GitHub API 获取 Pull Request 的 files（变更）
-            url = f"https://api.github.com/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/files"
-            headers = {
-                'Authorization': f'token {self.github_token}',
-                'Accept': 'application/vnd.github.v3+json'
-            }
-            response = requests.get(url, headers=headers)
-            logger.debug(
-                f"Get changes response from GitHub (attempt {attempt + 1}): {response.status_code}, {response.text}, URL: {url}")
+        # 配置了本地镜像时直接在本地计算 base 与 head 之间的 diff
+        pull_request = self.webhook_data.get('pull_request', {})
+        changes = mirror_changes('github', self.github_url, slugify_url(self.github_url), self.repo_full_name,
+                                 self.github_token, pull_request.get('base', {}).get('sha'),
+                                 pull_request.get('head', {}).get('sha'),
+                                 clone_url=self.webhook_data.get('repository', {}).get('clone_url'), merge_base=True)
+        if changes is not None:
+            return filter_changes(changes)
+
+        # GitHub pull request changes API可能存在延迟，diff 为空时按指数退避重试（见 wait_for_changes）
+        url = f"https://api.github.com/repos/{self.repo_full_name}/pulls/{self.pull_request_number}/files"
+        headers = {
+            'Authorization': f'token {self.github_token}',
+            'Accept': 'application/vnd.github.v3+json'
+        }
 
+        def fetch_page(page):
+            return http_client.get(url, headers=headers, stream=stream_enabled(),
+                                   params={'per_page': PER_PAGE, 'page': page})
+
+        def read_page(response):
+            # 转换成GitLab格式的changes
+            return [
+                {
+                    'old_path': file.get('filename'),
+                    'new_path': file.get('filename'),
+                    'diff': file.get('patch', ''),
+                    'additions': file.get('additions', 0),
+                    'deletions': file.get('deletions', 0)
+                }
+                for file in read_json_array(response, description=f'URL: {response.url}')
+            ]
+
+        def fetch_changes():
+            # 调用 GitHub API 获取 Pull Request 的 files（变更），默认每页只有 30 个文件，需要获取所有分页；
+            # 响应可能很大，流式下载并逐个解析（见 stream_download）
+            response = fetch_page(1)
+            logger.debug(f"Get changes response from GitHub: {response.status_code}, URL: {url}")
             # 检查请求是否成功
-            if response.status_code == 200:
-                files = response.json()
-                if files:
-                    # 转换成GitLab格式的changes
-                    changes = []
-                    for file in files:
-                        change = {
-                            'old_path': file.get('filename'),
-                            'new_path': file.get('filename'),
-                            'diff': file.get('patch', ''),
-                            'additions': file.get('additions', 0),
-                            'deletions': file.get('deletions', 0)
-                        }
-                        changes.append(change)
-                    return changes
-                else:
-                    logger.info(
-                        f"Changes is empty, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries}), URL: {url}")
-                    time.sleep(retry_delay)
-            else:
+            if response.status_code != 200:
                 logger.warn(f"Failed to get changes from GitHub (URL: {url}): {response.status_code}, {response.text}")
-                return []
+                return None
+            # 每一页到达后立即过滤，只保留需要 review 的文件；分页获取失败时返回 None，不 review 不完整的文件列表
+            return fetch_all_pages(fetch_page, read_page, response, f'URL: {url}', filter_page=filter_changes)
 
-        logger.warning(f"Max retries ({max_retries}) reached. Changes is still empty.")
-        return []  # 达到最大重试次数后返回空列表
+        return wait_for_changes('github', fetch_changes, f'URL: {url}')
 
     def get_pull_request_commits(self) -> list:
         # 检查是否为 Pull Request Hook 事件
@@ -135,13 +255,20 @@ class PullRequestHandler:
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
-        response = requests.get(url, headers=headers)
-        logger.debug(f"Get commits response from GitHub: {response.status_code}, {response.text}")
+
+        def fetch_page(page):
+            return http_client.conditional_get(url, headers=headers, params={'per_page': PER_PAGE, 'page': page})
+
+        response = fetch_page(1)
+        logger.debug('Get commits response from GitHub: %s, %d bytes', response.status_code, len(response.content))
         
         # 检查请求是否成功
         if response.status_code == 200:
             # 将GitHub的commits转换为GitLab格式的commits
-            github_commits = response.json()
+            github_commits = fetch_all_pages(fetch_page, lambda page_response: page_response.json(), response,
+                                             f'URL: {url}')
+            if github_commits is None:
+                return []
             gitlab_format_commits = []
             for commit in github_commits:
                 gitlab_commit = {
@@ -168,7 +295,7 @@ class PullRequestHandler:
         data = {
             'body': review_result
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = http_client.post(url, headers=headers, json=data)
         logger.debug(f"Add comment to GitHub PR {url}: {response.status_code}, {response.text}")
         if response.status_code == 201:
             logger.info("Comment successfully added to pull request.")
@@ -177,20 +304,27 @@ class PullRequestHandler:
             logger.error(response.text)
 
     def target_branch_protected(self) -> bool:
+        # 受保护分支列表很少变化，按仓库缓存，收到 branch_protection_rule 事件时清除（见 src/utils/protected_branches.py）
+        matcher = get_protected_branch_matcher(
+            protected_branches_cache_key('github', self.github_url, self.repo_full_name), self._fetch_protected_branches)
+        if matcher is None:
+            return False
+        target_branch = self.webhook_data['pull_request']['base']['ref']
+        return matcher.matches(target_branch)
+
+    def _fetch_protected_branches(self):
         url = f"https://api.github.com/repos/{self.repo_full_name}/branches?protected=true"
         headers = {
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
 
-        response = requests.get(url, headers=headers)
+        response = http_client.conditional_get(url, headers=headers)
         if response.status_code == 200:
-            data = response.json()
-            target_branch = self.webhook_data['pull_request']['base']['ref']
-            return any(fnmatch.fnmatch(target_branch, item['name']) for item in data)
+            return [item['name'] for item in response.json()]
         else:
             logger.warn(f"Failed to get protected branches: {response.status_code}, {response.text}")
-            return False
+            return None
 
 
 class PushHandler:
@@ -255,7 +389,7 @@ class PushHandler:
         data = {
             'body': message
         }
-        response = requests.post(url, headers=headers, json=data)
+        response = http_client.post(url, headers=headers, json=data)
         logger.debug(f"Add comment to commit {last_commit_id}: {response.status_code}, {response.text}")
         if response.status_code == 201:
             logger.info("Comment successfully added to push commit.")
@@ -270,9 +404,9 @@ class PushHandler:
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
-        response = requests.get(url, headers=headers)
-        logger.debug(
-            f"Get commits response from GitHub for repository_commits: {response.status_code}, {response.text}, URL: {url}")
+        response = http_client.get(url, headers=headers)
+        logger.debug('Get commits response from GitHub for repository_commits: %s, %d bytes, URL: %s',
+                     response.status_code, len(response.content), url)
 
         if response.status_code == 200:
             return response.json()
@@ -287,44 +421,44 @@ class PushHandler:
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
-        response = requests.get(url, headers=headers)
-        logger.debug(
-            f"Get commit response from GitHub: {response.status_code}, {response.text}, URL: {url}")
+        response = http_client.conditional_get(url, headers=headers)
+        logger.debug('Get commit response from GitHub: %s, %d bytes, URL: %s',
+                     response.status_code, len(response.content), url)
 
         if response.status_code == 200 and response.json().get('parents'):
             return response.json().get('parents')[0].get('sha', '')
         return ""
 
-    def repository_compare(self, base: str, head: str):
-        # 比较两个提交之间的差异
+    def repository_compare(self, base: str, head: str, strict: bool = False):
+        # 比较两个提交之间的差异，strict 为 True 时请求失败返回 None，便于调用方区分失败与没有变更
         url = f"https://api.github.com/repos/{self.repo_full_name}/compare/{base}...{head}"
         headers = {
             'Authorization': f'token {self.github_token}',
             'Accept': 'application/vnd.github.v3+json'
         }
-        response = requests.get(url, headers=headers)
-        logger.debug(
-            f"Get changes response from GitHub for repository_compare: {response.status_code}, {response.text}, URL: {url}")
+        response = http_client.get(url, headers=headers)
+        logger.debug('Get changes response from GitHub for repository_compare: %s, %d bytes, URL: %s',
+                     response.status_code, len(response.content), url)
 
         if response.status_code == 200:
-            # 转换为GitLab格式的diffs
-            files = response.json().get('files', [])
-            diffs = []
-            for file in files:
-                diff = {
-                    'old_path': file.get('filename'),
-                    'new_path': file.get('filename'),
-                    'diff': file.get('patch', ''),
-                    'status': file.get('status', ''),
-                    'additions': file.get('additions', 0),
-                    'deletions': file.get('deletions', 0),
-                }
-                diffs.append(diff)
-            return diffs
+            return files_to_changes(response.json().get('files', []))
         else:
             logger.warn(
                 f"Failed to get changes for repository_compare: {response.status_code}, {response.text}")
-            return []
+            return None if strict else []
+
+    def get_commit_changes(self, commit_id: str) -> list:
+        # 单个 commit 的详情中直接包含文件变更，不需要先查询父提交再 compare
+        url = f"https://api.github.com/repos/{self.repo_full_name}/commits/{commit_id}"
+        headers = {
+            'Authorization': f'token {self.github_token}',
+            'Accept': 'application/vnd.github.v3+json'
+        }
+        response = http_client.conditional_get(url, headers=headers)
+        if response.status_code == 200:
+            return files_to_changes(response.json().get('files', []))
+        logger.warn(f"Failed to get changes of commit {commit_id}: {response.status_code}, {response.text}")
+        return []
 
     def get_push_changes(self) -> list:
         # 检查是否为 Push 事件
@@ -352,19 +486,30 @@ class PushHandler:
             elif self.webhook_data.get('deleted', False):
                 # 删除分支处理
                 return []
-            
+
+            changes = mirror_changes('github', self.github_url, slugify_url(self.github_url), self.repo_full_name,
+                                     self.github_token, before, after,
+                                     clone_url=self.webhook_data.get('repository', {}).get('clone_url'))
+            if changes is not None:
+                return changes
             return self.repository_compare(before, after)
         else:
             # 如果before和after不存在，尝试通过commits获取
             logger.info("before or after not found in webhook data, trying to get changes from commits.")
             
+            commit_ids = [commit.get('id') for commit in self.commit_list if commit.get('id')]
+            if not commit_ids:
+                return []
+
+            # 优先以第一个提交的父提交为起点，对整个范围做一次 compare
+            parent_id = self.get_parent_commit_id(commit_ids[0])
+            if parent_id:
+                changes = self.repository_compare(parent_id, commit_ids[-1], strict=True)
+                if changes is not None:
+                    return changes
+
+            # 第一个提交没有父提交或 compare 失败时，并发获取每个提交的变更，再按文件路径合并去重
             changes = []
-            for commit in self.commit_list:
-                commit_id = commit.get('id')
-                if commit_id:
-                    parent_id = self.get_parent_commit_id(commit_id)
-                    if parent_id:
-                        commit_changes = self.repository_compare(parent_id, commit_id)
-                        changes.extend(commit_changes)
-            
-            return changes 
\ No newline at end of file
+            for commit_changes in map_ordered(self.get_commit_changes, commit_ids, github_diff_concurrency()):
+                changes.extend(commit_changes)
+            return merge_changes_by_path(changes) 
\ No newline at end of file
@@ -1,11 +1,20 @@
+import functools
 import os
 import re
-import time
 from urllib.parse import urljoin
-import fnmatch
-import requests
 
+from src.utils import http_client
+from src.utils.capability_cache import probe_endpoint, ENDPOINT_MISSING_STATUS, PROBE_OK, PROBE_NEXT, PROBE_STOP
+from src.utils.diff_index import scan_diff
+from src.utils.diff_readiness import FilteredChanges, wait_for_changes
+from src.utils.git_mirror import mirror_changes
 from src.utils.log import logger
+from src.utils.parallel import map_ordered
+from src.utils.protected_branches import get_protected_branch_matcher, protected_branches_cache_key
+from src.utils.stream_download import read_json_array, stream_enabled
+
+# /merge_requests/:iid/diffs 每页的文件数（GitLab 允许的最大值）
+DIFFS_PER_PAGE = 100
 
 
 def filter_changes(changes: list):
@@ -18,16 +27,19 @@ def filter_changes(changes: list):
     filter_deleted_files_changes = [change for change in changes if not change.get("deleted_file")]
 
     # 过滤 `new_path` 以支持的扩展名结尾的元素, 仅保留diff和new_path字段
-    filtered_changes = [
-        {
+    filtered_changes = []
+    for item in filter_deleted_files_changes:
+        if not any(item.get('new_path', '').endswith(ext) for ext in supported_extensions):
+            continue
+        # 删除文件以 API 返回的 deleted_file 为准（上面已过滤），清空内容但仍保留的文件照常 review；
+        # 这里只用 scan_diff 统计增删行数
+        stats = scan_diff(item.get('diff', ''))
+        filtered_changes.append({
             'diff': item.get('diff', ''),
             'new_path': item['new_path'],
-            'additions': len(re.findall(r'^\+(?!\+\+)', item.get('diff', ''), re.MULTILINE)),
-            'deletions': len(re.findall(r'^-(?!--)', item.get('diff', ''), re.MULTILINE))
-        }
-        for item in filter_deleted_files_changes
-        if any(item.get('new_path', '').endswith(ext) for ext in supported_extensions)
-    ]
+            'additions': stats.additions,
+            'deletions': stats.deletions
+        })
     return filtered_changes
 
 
@@ -49,6 +61,21 @@ def slugify_url(original_url: str) -> str:
     return target
 
 
+def gitlab_diff_concurrency() -> int:
+    """分页获取 MR diffs 时的并发数，1 表示串行"""
+    return max(int(os.getenv('GITLAB_DIFF_CONCURRENCY', 8)), 1)
+
+
+def _classify_diffs_response(response):
+    # 旧版本 GitLab（15.7 之前）没有 /diffs 接口，返回 404；换下一个接口前关闭流式响应以归还连接
+    if response.status_code == 200:
+        return PROBE_OK
+    if response.status_code in ENDPOINT_MISSING_STATUS:
+        response.close()
+        return PROBE_NEXT
+    return PROBE_STOP
+
+
 class MergeRequestHandler:
     def __init__(self, webhook_data: dict, gitlab_token: str, gitlab_url: str):
         self.merge_request_iid = None
@@ -74,40 +101,105 @@ class MergeRequestHandler:
         self.action = merge_request.get('action')
 
     def get_merge_request_changes(self) -> list:
+        # 返回经过 filter_changes 过滤的 changes：分页获取时每一页到达后立即过滤，不在内存中保留不需要 review 的 diff
         # 检查是否为 Merge Request Hook 事件
         if self.event_type != 'merge_request':
             logger.warn(f"Invalid event type: {self.event_type}. Only 'merge_request' event is supported now.")
             return []
 
-        # Gitlab merge request changes API可能存在延迟，多次尝试
-        max_retries = 3  # 最大重试次数
-        retry_delay = 10  # 重试间隔时间（秒）
-        for attempt in range(max_retries):
-            # 调用 GitLab API 获取 Merge Request 的 changes
-            url = urljoin(f"{self.gitlab_url}/",
-                          f"api/v4/projects/{self.project_id}/merge_requests/{self.merge_request_iid}/changes")
-            headers = {
-                'Private-Token': self.gitlab_token
+        # 配置了本地镜像时直接在本地计算目标分支与 MR head 之间的 diff
+        merge_request = self.webhook_data.get('object_attributes', {})
+        project = self.webhook_data.get('project', {})
+        changes = mirror_changes('gitlab', self.gitlab_url, slugify_url(self.gitlab_url),
+                                 project.get('path_with_namespace'), self.gitlab_token,
+                                 merge_request.get('target_branch'), merge_request.get('last_commit', {}).get('id'),
+                                 clone_url=project.get('git_http_url'), merge_base=True)
+        if changes is not None:
+            return filter_changes(changes)
+
+        # Gitlab merge request changes API可能存在延迟，diff 为空时按指数退避重试（见 wait_for_changes）
+        url = urljoin(f"{self.gitlab_url}/",
+                      f"api/v4/projects/{self.project_id}/merge_requests/{self.merge_request_iid}")
+        headers = {
+            'Private-Token': self.gitlab_token
+        }
+
+        def fetch_changes():
+            # 优先使用分页的 /diffs 接口（不会像 /changes 那样在服务端截断大 MR），旧版本 GitLab 回退到 /changes；
+            # 响应可能很大，流式下载并逐个解析（见 stream_download）
+            def get_changes():
+                return http_client.get(f"{url}/changes", headers=headers, verify=False, stream=stream_enabled())
+
+            variants = {
+                'diffs': functools.partial(self._get_diffs_page, url, headers, 1),
+                'changes': get_changes,
             }
-            response = requests.get(url, headers=headers, verify=False)
-            logger.debug(
-                f"Get changes response from GitLab (attempt {attempt + 1}): {response.status_code}, {response.text}, URL: {url}")
-
-            # 检查请求是否成功
-            if response.status_code == 200:
-                changes = response.json().get('changes', [])
-                if changes:
+            variant, response = probe_endpoint(slugify_url(self.gitlab_url), 'gitlab_mr_diffs', variants,
+                                               _classify_diffs_response, cache_unsupported=False)
+            if variant == 'diffs':
+                changes = self._read_diffs_pages(url, headers, response)
+                if changes is not None:
                     return changes
-                else:
-                    logger.info(
-                        f"Changes is empty, retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries}), URL: {url}")
-                    time.sleep(retry_delay)
-            else:
-                logger.warn(f"Failed to get changes from GitLab (URL: {url}): {response.status_code}, {response.text}")
-                return []
-
-        logger.warning(f"Max retries ({max_retries}) reached. Changes is still empty.")
-        return []  # 达到最大重试次数后返回空列表
+                # 个别分页获取失败时不 review 不完整的文件列表，改为从 /changes 一次性获取（/diffs 仍然可用，不清除缓存）
+                logger.warn(f"Falling back to {url}/changes because some diffs pages could not be fetched.")
+                response = get_changes()
+                variant = 'changes' if response.status_code == 200 else None
+            if variant == 'changes':
+                changes = read_json_array(response, 'changes', f'URL: {url}/changes')
+                return FilteredChanges(filter_changes(changes), len(changes))
+            logger.warn(f"Failed to get changes from GitLab (URL: {url}): "
+                        f"{response.status_code if response is not None else None}, "
+                        f"{response.text if response is not None else ''}")
+            return None
+
+        return wait_for_changes('gitlab', fetch_changes, f'URL: {url}')
+
+    def _get_diffs_page(self, url: str, headers: dict, page: int):
+        response = http_client.get(f"{url}/diffs", headers=headers, verify=False, stream=stream_enabled(),
+                                   params={'page': page, 'per_page': DIFFS_PER_PAGE})
+        logger.debug(f"Get diffs page {page} response from GitLab: {response.status_code}, URL: {url}/diffs")
+        return response
+
+    def _read_diffs_page(self, url: str, headers: dict, page: int, response=None):
+        """读取并过滤一页 diffs，返回 (过滤前的文件数, 过滤后的 changes, response)；获取失败时返回 None"""
+        if response is None:
+            response = self._get_diffs_page(url, headers, page)
+        if response.status_code == 200:
+            changes = read_json_array(response, description=f'URL: {url}/diffs?page={page}')
+            return len(changes), filter_changes(changes), response
+        logger.warn(f"Failed to get diffs page {page} from GitLab (URL: {url}): {response.status_code}, {response.text}")
+        return None
+
+    def _read_diffs_pages(self, url: str, headers: dict, first_response) -> list:
+        """
+        读取 /diffs 的所有分页：响应头带有 X-Total-Pages 时其余分页并发获取，
+        文件数过多时 GitLab 不返回总页数，按 X-Next-Page 逐页获取
+        每一页到达后立即经过 filter_changes 过滤，只保留需要 review 的文件，峰值内存不随 MR 的文件总数增长
+        :return: 所有分页过滤后的 changes（FilteredChanges）；任何一页获取失败时返回 None，不返回不完整的列表
+        """
+        total_pages = int(first_response.headers.get('X-Total-Pages') or 0)
+        results = [self._read_diffs_page(url, headers, 1, first_response)]
+        if total_pages > 1:
+            pages = list(range(2, total_pages + 1))
+            logger.debug(f"Fetching {len(pages)} more diffs pages with concurrency {gitlab_diff_concurrency()}")
+            results += map_ordered(functools.partial(self._read_diffs_page, url, headers), pages,
+                                   gitlab_diff_concurrency())
+        else:
+            next_page = first_response.headers.get('X-Next-Page')
+            while next_page:
+                result = self._read_diffs_page(url, headers, int(next_page))
+                results.append(result)
+                if result is None:
+                    break
+                next_page = result[2].headers.get('X-Next-Page')
+
+        if any(result is None for result in results):
+            logger.warn(f"Some diffs pages of {url} could not be fetched.")
+            return None
+        changes = FilteredChanges([], sum(result[0] for result in results))
+        for result in results:
+            changes.extend(result[1])
+        return changes
 
     def get_merge_request_commits(self) -> list:
         # 检查是否为 Merge Request Hook 事件
@@ -120,7 +212,7 @@ class MergeRequestHandler:
         headers = {
             'Private-Token': self.gitlab_token
         }
-        response = requests.get(url, headers=headers, verify=False)
+        response = http_client.conditional_get(url, headers=headers, verify=False)
         logger.debug(f"Get commits response from gitlab: {response.status_code}, {response.text}")
         # 检查请求是否成功
         if response.status_code == 200:
@@ -139,7 +231,7 @@ class MergeRequestHandler:
         data = {
             'body': review_result
         }
-        response = requests.post(url, headers=headers, json=data, verify=False)
+        response = http_client.post(url, headers=headers, json=data, verify=False)
         logger.debug(f"Add notes to gitlab {url}: {response.status_code}, {response.text}")
         if response.status_code == 201:
             logger.info("Note successfully added to merge request.")
@@ -148,22 +240,29 @@ class MergeRequestHandler:
             logger.error(response.text)
 
     def target_branch_protected(self) -> bool:
+        # 受保护分支列表很少变化，按项目缓存（见 src/utils/protected_branches.py）
+        matcher = get_protected_branch_matcher(
+            protected_branches_cache_key('gitlab', self.gitlab_url, self.project_id), self._fetch_protected_branches)
+        if matcher is None:
+            return False
+        target_branch = self.webhook_data['object_attributes']['target_branch']
+        return matcher.matches(target_branch)
+
+    def _fetch_protected_branches(self):
         url = urljoin(f"{self.gitlab_url}/",
                       f"api/v4/projects/{self.project_id}/protected_branches")
         headers = {
             'Private-Token': self.gitlab_token,
             'Content-Type': 'application/json'
         }
-        response = requests.get(url, headers=headers, verify=False)
+        response = http_client.conditional_get(url, headers=headers, verify=False)
         logger.debug(f"Get protected branches response from gitlab: {response.status_code}, {response.text}")
         # 检查请求是否成功
         if response.status_code == 200:
-            data = response.json()
-            target_branch = self.webhook_data['object_attributes']['target_branch']
-            return any(fnmatch.fnmatch(target_branch, item['name']) for item in data)
+            return [item['name'] for item in response.json()]
         else:
             logger.warn(f"Failed to get protected branches: {response.status_code}, {response.text}")
-            return False
+            return None
 
 
 class PushHandler:
@@ -230,7 +329,7 @@ class PushHandler:
         data = {
             'note': message
         }
-        response = requests.post(url, headers=headers, json=data, verify=False)
+        response = http_client.post(url, headers=headers, json=data, verify=False)
         logger.debug(f"Add comment to commit {last_commit_id}: {response.status_code}, {response.text}")
         if response.status_code == 201:
             logger.info("Comment successfully added to push commit.")
@@ -245,7 +344,7 @@ class PushHandler:
         headers = {
             'Private-Token': self.gitlab_token
         }
-        response = requests.get(url, headers=headers, verify=False)
+        response = http_client.conditional_get(url, headers=headers, verify=False)
         logger.debug(
             f"Get commits response from GitLab for repository_commits: {response.status_code}, {response.text}, URL: {url}")
 
@@ -268,7 +367,7 @@ class PushHandler:
         headers = {
             'Private-Token': self.gitlab_token
         }
-        response = requests.get(url, headers=headers, verify=False)
+        response = http_client.get(url, headers=headers, verify=False)
         logger.debug(
             f"Get changes response from GitLab for repository_compare: {response.status_code}, {response.text}, URL: {url}")
 
@@ -306,6 +405,12 @@ class PushHandler:
                 parent_commit_id = self.get_parent_commit_id(first_commit_id)
                 if parent_commit_id:
                     before = parent_commit_id
+            project = self.webhook_data.get('project', {})
+            changes = mirror_changes('gitlab', self.gitlab_url, slugify_url(self.gitlab_url),
+                                     project.get('path_with_namespace'), self.gitlab_token, before, after,
+                                     clone_url=project.get('git_http_url'))
+            if changes is not None:
+                return changes
             return self.repository_compare(before, after)
         else:
             return []
@@ -0,0 +1,84 @@
+from dotenv import load_dotenv
+
+load_dotenv("config/.env")
+
+import argparse
+import os
+import signal
+import socket
+import threading
+import traceback
+
+from src.utils.diff_readiness import RetryLater
+from src.utils.log import logger
+from src.utils.queue import fair_scheduling_options
+from src.utils.sqlite_queue import SqliteJobQueue, resolve_function
+
+
+class SqliteQueueWorker:
+    """
+    QUEUE_DRIVER=sqlite 时使用的 worker 进程：循环领取任务并执行，执行期间定期续约。
+    可以同时启动多个进程，任务领取在数据库事务中完成，不会被重复执行。
+    """
+
+    def __init__(self, queue: SqliteJobQueue, queue_names: list = None, poll_interval: float = 1.0):
+        self.queue = queue
+        self.queue_names = queue_names or None
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self._stopping = threading.Event()
+
+    def stop(self, *_):
+        # 收到退出信号时执行完当前任务再退出
+        logger.info(f'SQLite queue worker {self.worker_id} stopping...')
+        self._stopping.set()
+
+    def _heartbeat(self, job_id: int, done: threading.Event):
+        interval = max(1, self.queue.lease_seconds // 3)
+        while not done.wait(interval):
+            if not self.queue.heartbeat(job_id, self.worker_id):
+                logger.warning(f'SQLite queue job {job_id} lease lost, it may be executed by another worker.')
+                return
+
+    def run_job(self, job: dict):
+        logger.info(f"SQLite queue worker {self.worker_id} running job {job['id']} "
+                    f"({job['function']}, attempt {job['attempts']}/{job['max_attempts']})")
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job['id'], done), daemon=True)
+        heartbeat.start()
+        try:
+            function = resolve_function(job['function'])
+            result = function(*job['args'])
+        except Exception:
+            self.queue.fail(job['id'], self.worker_id, traceback.format_exc())
+        else:
+            if isinstance(result, RetryLater):
+                self.queue.reschedule(job['id'], self.worker_id, result.args, result.delay)
+            else:
+                self.queue.complete(job['id'], self.worker_id)
+        finally:
+            done.set()
+            heartbeat.join()
+
+    def work(self):
+        logger.info(f'SQLite queue worker {self.worker_id} started, db={self.queue.db_file}, '
+                    f'queues={self.queue_names or "*"}')
+        while not self._stopping.is_set():
+            job = self.queue.claim(self.worker_id, self.queue_names)
+            if job is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+        logger.info(f'SQLite queue worker {self.worker_id} stopped.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SQLite 队列 worker')
+    parser.add_argument('queues', nargs='*', help='只消费指定的队列（url_slug），默认消费全部队列')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='队列为空时的轮询间隔（秒）')
+    args = parser.parse_args()
+
+    worker = SqliteQueueWorker(SqliteJobQueue(**fair_scheduling_options()), args.queues, args.poll_interval)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.work()
@@ -10,11 +10,15 @@ from src.gitea.webhook_handler import filter_changes as filter_gitea_changes, Pu
 from src.gitea.webhook_handler import filter_changes as filter_gitea_changes, PullRequestHandler as GiteaPullRequestHandler, PushHandler as GiteaPushHandler
 from src.bitbucket.webhook_handler import filter_changes as filter_bitbucket_changes, PullRequestHandler as BitbucketPullRequestHandler, PushHandler as BitbucketPushHandler
 from src.utils.code_reviewer import CodeReviewer
+from src.utils.http_client import track_connection_stats
 from src.utils.messaging import notifier
+from src.utils.review_supersede import is_current_review_superseded
 from src.utils.log import logger
+from src.utils.payload_log import BoundedRepr
 
 
 
+@track_connection_stats
 def handle_push_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gitlab_url_slug: str):
     push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
     try:
@@ -32,7 +36,7 @@ def handle_push_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gi
         if push_review_enabled:
             # 获取PUSH的changes
             changes = handler.get_push_changes()
-            logger.info('changes: %s', changes)
+            logger.info('changes: %s', BoundedRepr(changes))
             changes = filter_changes(changes)
             if not changes:
                 logger.info('未检测到PUSH代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
@@ -68,6 +72,7 @@ def handle_push_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gi
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url: str, gitlab_url_slug: str):
     '''
     处理Merge Request Hook事件
@@ -92,10 +97,9 @@ def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url
             return
 
         # 仅仅在MR创建或更新时进行Code Review
-        # 获取Merge Request的changes
+        # 获取Merge Request的changes（已经过 filter_changes 过滤）
         changes = handler.get_merge_request_changes()
-        logger.info('changes: %s', changes)
-        changes = filter_changes(changes)
+        logger.info('changes: %s', BoundedRepr(changes))
         if not changes:
             logger.info('未检测到有关代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
             return
@@ -112,10 +116,18 @@ def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url
             logger.error('Failed to get commits')
             return
 
+        if is_current_review_superseded():
+            logger.info('Merge Request has newer updates, review skipped.')
+            return
+
         # review 代码
         commits_text = ';'.join(commit['title'] for commit in commits)
         review_result = CodeReviewer().review_and_strip_code(changes, commits_text, changes)
 
+        if is_current_review_superseded():
+            logger.info('Merge Request has newer updates, review result discarded.')
+            return
+
         # 将review结果提交到Gitlab的 notes
         handler.add_merge_request_notes(f'Auto Review Result: \n{review_result}')
 
@@ -143,6 +155,7 @@ def handle_merge_request_event(webhook_data: dict, gitlab_token: str, gitlab_url
         notifier.send_notification(content=error_message)
         logger.error('出现未知错误: %s', error_message)
 
+@track_connection_stats
 def handle_github_push_event(webhook_data: dict, github_token: str, github_url: str, github_url_slug: str):
     push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
     try:
@@ -160,7 +173,7 @@ def handle_github_push_event(webhook_data: dict, github_token: str, github_url:
         if push_review_enabled:
             # 获取PUSH的changes
             changes = handler.get_push_changes()
-            logger.info('changes: %s', changes)
+            logger.info('changes: %s', BoundedRepr(changes))
             changes = filter_github_changes(changes)
             if not changes:
                 logger.info('未检测到PUSH代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
@@ -196,6 +209,7 @@ def handle_github_push_event(webhook_data: dict, github_token: str, github_url:
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_github_pull_request_event(webhook_data: dict, github_token: str, github_url: str, github_url_slug: str):
     '''
     处理GitHub Pull Request 事件
@@ -220,10 +234,9 @@ def handle_github_pull_request_event(webhook_data: dict, github_token: str, gith
             return
 
         # 仅仅在PR创建或更新时进行Code Review
-        # 获取Pull Request的changes
+        # 获取Pull Request的changes（已经过 filter_changes 过滤）
         changes = handler.get_pull_request_changes()
-        logger.info('changes: %s', changes)
-        changes = filter_github_changes(changes)
+        logger.info('changes: %s', BoundedRepr(changes))
         if not changes:
             logger.info('未检测到有关代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
             return
@@ -240,10 +253,18 @@ def handle_github_pull_request_event(webhook_data: dict, github_token: str, gith
             logger.error('Failed to get commits')
             return
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review skipped.')
+            return
+
         # review 代码
         commits_text = ';'.join(commit['title'] for commit in commits)
         review_result = CodeReviewer().review_and_strip_code(changes, commits_text, changes)
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review result discarded.')
+            return
+
         # 将review结果提交到GitHub的 notes
         handler.add_pull_request_notes(f'Auto Review Result: \n{review_result}')
 
@@ -271,6 +292,7 @@ def handle_github_pull_request_event(webhook_data: dict, github_token: str, gith
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_gitea_push_event(webhook_data: dict, gitea_token: str, gitea_url: str, gitea_url_slug: str):
     push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
     try:
@@ -300,7 +322,7 @@ def handle_gitea_push_event(webhook_data: dict, gitea_token: str, gitea_url: str
         if push_review_enabled:
             # 获取PUSH的changes
             changes = handler.get_push_changes()
-            logger.info('changes: %s', changes)
+            logger.info('changes: %s', BoundedRepr(changes))
             changes = filter_gitea_changes(changes)
             if not changes:
                 logger.info('未检测到PUSH代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
@@ -369,6 +391,7 @@ def handle_gitea_push_event(webhook_data: dict, gitea_token: str, gitea_url: str
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_gitea_pull_request_event(webhook_data: dict, gitea_token: str, gitea_url: str, gitea_url_slug: str):
     '''
     处理Gitea Pull Request 事件
@@ -407,7 +430,7 @@ def handle_gitea_pull_request_event(webhook_data: dict, gitea_token: str, gitea_
         # 仅仅在PR创建或更新时进行Code Review
         # 获取Pull Request的changes
         changes = handler.get_pull_request_changes()
-        logger.info('changes: %s', changes)
+        logger.info('changes: %s', BoundedRepr(changes))
         changes = filter_gitea_changes(changes)
         if not changes:
             logger.info('未检测到有关代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
@@ -425,10 +448,18 @@ def handle_gitea_pull_request_event(webhook_data: dict, gitea_token: str, gitea_
             logger.error('Failed to get commits')
             return
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review skipped.')
+            return
+
         # review 代码
         commits_text = ';'.join(commit.get('title', commit.get('message', '')).split('\n')[0] for commit in commits)
         review_result = CodeReviewer().review_and_strip_code(changes, commits_text, changes)
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review result discarded.')
+            return
+
         # 检查是否启用 Issue 模式（默认开启）
         use_issue_mode = os.environ.get('GITEA_USE_ISSUE_MODE', '1') == '1'
         
@@ -502,6 +533,7 @@ def handle_gitea_pull_request_event(webhook_data: dict, gitea_token: str, gitea_
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_bitbucket_push_event(webhook_data: dict, bitbucket_token: str, bitbucket_url: str, bitbucket_url_slug: str):
     push_review_enabled = os.environ.get('PUSH_REVIEW_ENABLED', '0') == '1'
     try:
@@ -518,7 +550,7 @@ def handle_bitbucket_push_event(webhook_data: dict, bitbucket_token: str, bitbuc
         deletions = 0
         if push_review_enabled:
             changes = handler.get_push_changes()
-            logger.info('changes: %s', changes)
+            logger.info('changes: %s', BoundedRepr(changes))
             changes = filter_bitbucket_changes(changes)
             if not changes:
                 logger.info('未检测到PUSH代码的修改,修改文件可能不满足SUPPORTED_EXTENSIONS。')
@@ -562,6 +594,7 @@ def handle_bitbucket_push_event(webhook_data: dict, bitbucket_token: str, bitbuc
         logger.error('出现未知错误: %s', error_message)
 
 
+@track_connection_stats
 def handle_bitbucket_pull_request_event(webhook_data: dict, bitbucket_token: str, bitbucket_url: str, bitbucket_url_slug: str):
     merge_review_only_protected_branches = os.environ.get('MERGE_REVIEW_ONLY_PROTECTED_BRANCHES_ENABLED', '0') == '1'
     try:
@@ -576,7 +609,7 @@ def handle_bitbucket_pull_request_event(webhook_data: dict, bitbucket_token: str
             return
 
         changes = handler.get_pull_request_changes()
-        logger.info('changes: %s', changes)
+        logger.info('changes: %s', BoundedRepr(changes))
         changes = filter_bitbucket_changes(changes)
         if not changes:
             logger.info('未检测到有关代码的修改，修改文件可能不满足 SUPPORTED_EXTENSIONS。')
@@ -593,10 +626,18 @@ def handle_bitbucket_pull_request_event(webhook_data: dict, bitbucket_token: str
             logger.error('Failed to get commits')
             return
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review skipped.')
+            return
+
         from src.utils.code_reviewer import CodeReviewer
         commits_text = ';'.join(commit.get('title', commit.get('message', '')).split('\n')[0] for commit in commits)
         review_result = CodeReviewer().review_and_strip_code(changes, commits_text, changes)
 
+        if is_current_review_superseded():
+            logger.info('Pull Request has newer updates, review result discarded.')
+            return
+
         handler.add_pull_request_notes(f'Auto Review Result: \n{review_result}')
 
         pull_request = webhook_data.get('pullRequest') or webhook_data.get('pull_request') or {}
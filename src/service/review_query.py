@@ -0,0 +1,200 @@
+import atexit
+import json
+import os
+import traceback
+from datetime import datetime
+
+import pandas as pd
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+from src.service.review_service import ReviewService
+from src.utils.log import logger
+from src.utils.messaging import notifier
+from src.utils.reporter import Reporter
+
+
+def parse_review_filters(args) -> dict:
+    """
+    解析 /api/review/* 的查询参数
+    :param args: 支持 get / getlist 的查询参数对象（Flask 的 request.args 或 Starlette 的 request.query_params）
+    """
+    updated_at_gte = args.get('updated_at_gte')
+    updated_at_lte = args.get('updated_at_lte')
+    return {
+        'review_type': args.get('type', 'mr'),  # 'mr' 或 'push'
+        'authors': args.getlist('authors') if args.get('authors') else None,
+        'project_names': args.getlist('project_names') if args.get('project_names') else None,
+        'updated_at_gte': int(updated_at_gte) if updated_at_gte else None,
+        'updated_at_lte': int(updated_at_lte) if updated_at_lte else None,
+    }
+
+
+def _load_review_logs(review_type: str, authors, project_names, updated_at_gte, updated_at_lte) -> pd.DataFrame:
+    if review_type == 'push':
+        return ReviewService().get_push_review_logs(
+            authors=authors,
+            project_names=project_names,
+            updated_at_gte=updated_at_gte,
+            updated_at_lte=updated_at_lte
+        )
+    return ReviewService().get_mr_review_logs(
+        authors=authors,
+        project_names=project_names,
+        updated_at_gte=updated_at_gte,
+        updated_at_lte=updated_at_lte
+    )
+
+
+def get_review_logs(review_type: str = 'mr', authors=None, project_names=None, updated_at_gte=None,
+                    updated_at_lte=None) -> dict:
+    """获取审查日志数据"""
+    df = _load_review_logs(review_type, authors, project_names, updated_at_gte, updated_at_lte)
+
+    # 转换数据格式
+    if df.empty:
+        return {
+            'data': [],
+            'total': 0,
+            'average_score': 0
+        }
+
+    # 格式化时间戳
+    if 'updated_at' in df.columns:
+        df['updated_at'] = df['updated_at'].apply(
+            lambda ts: datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            if isinstance(ts, (int, float)) else ts
+        )
+
+    # 格式化代码变更
+    if 'additions' in df.columns and 'deletions' in df.columns:
+        df['delta'] = df.apply(
+            lambda row: f"+{int(row['additions'])}  -{int(row['deletions'])}"
+            if not pd.isna(row['additions']) and not pd.isna(row['deletions'])
+            else "",
+            axis=1
+        )
+
+    # 转换为字典列表
+    records = df.to_dict(orient='records')
+
+    # 计算统计信息
+    total = len(records)
+    average_score = df['score'].mean() if 'score' in df.columns and not df.empty else 0
+
+    return {
+        'data': records,
+        'total': total,
+        'average_score': float(average_score) if not pd.isna(average_score) else 0
+    }
+
+
+def get_review_stats(review_type: str = 'mr', authors=None, project_names=None, updated_at_gte=None,
+                     updated_at_lte=None) -> dict:
+    """获取统计数据用于图表"""
+    df = _load_review_logs(review_type, authors, project_names, updated_at_gte, updated_at_lte)
+
+    if df.empty:
+        return {
+            'project_counts': [],
+            'project_scores': [],
+            'author_counts': [],
+            'author_scores': [],
+            'author_code_lines': []
+        }
+
+    # 项目提交次数
+    project_counts = df['project_name'].value_counts().reset_index()
+    project_counts.columns = ['name', 'count']
+
+    # 项目平均分数
+    project_scores = df.groupby('project_name')['score'].mean().reset_index()
+    project_scores.columns = ['name', 'average_score']
+
+    # 人员提交次数
+    author_counts = df['author'].value_counts().reset_index()
+    author_counts.columns = ['name', 'count']
+
+    # 人员平均分数
+    author_scores = df.groupby('author')['score'].mean().reset_index()
+    author_scores.columns = ['name', 'average_score']
+
+    # 人员代码行数
+    author_code_lines = []
+    if 'additions' in df.columns and 'deletions' in df.columns:
+        df['total_lines'] = df['additions'] + df['deletions']
+        author_code_lines_df = df.groupby('author')['total_lines'].sum().reset_index()
+        author_code_lines_df.columns = ['name', 'code_lines']
+        author_code_lines = author_code_lines_df.to_dict(orient='records')
+
+    return {
+        'project_counts': project_counts.to_dict(orient='records'),
+        'project_scores': project_scores.to_dict(orient='records'),
+        'author_counts': author_counts.to_dict(orient='records'),
+        'author_scores': author_scores.to_dict(orient='records'),
+        'author_code_lines': author_code_lines
+    }
+
+
+def generate_daily_report(push_review_enabled: bool):
+    """
+    生成当天的代码提交日报并发送通知
+    :return: 日报内容；当天没有数据时返回 None
+    """
+    # 获取当前日期0点和23点59分59秒的时间戳
+    start_time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    end_time = datetime.now().replace(hour=23, minute=59, second=59, microsecond=0).timestamp()
+
+    if push_review_enabled:
+        df = ReviewService().get_push_review_logs(updated_at_gte=start_time, updated_at_lte=end_time)
+    else:
+        df = ReviewService().get_mr_review_logs(updated_at_gte=start_time, updated_at_lte=end_time)
+
+    if df.empty:
+        logger.info("No data to process.")
+        return None
+    # 去重：基于 (author, message) 组合
+    df_unique = df.drop_duplicates(subset=["author", "commit_messages"])
+    # 按照 author 排序
+    df_sorted = df_unique.sort_values(by="author")
+    # 转换为适合生成日报的格式
+    commits = df_sorted.to_dict(orient="records")
+    # 生成日报内容
+    report_txt = Reporter().generate_report(json.dumps(commits))
+    # 发送钉钉通知
+    notifier.send_notification(content=report_txt, msg_type="markdown", title="代码提交日报")
+    return report_txt
+
+
+def setup_scheduler(push_review_enabled: bool):
+    """
+    配置并启动定时任务调度器
+    """
+    try:
+        scheduler = BackgroundScheduler()
+        crontab_expression = os.getenv('REPORT_CRONTAB_EXPRESSION', '0 18 * * 1-5')
+        cron_parts = crontab_expression.split()
+        cron_minute, cron_hour, cron_day, cron_month, cron_day_of_week = cron_parts
+
+        # Schedule the task based on the crontab expression
+        scheduler.add_job(
+            generate_daily_report,
+            args=[push_review_enabled],
+            trigger=CronTrigger(
+                minute=cron_minute,
+                hour=cron_hour,
+                day=cron_day,
+                month=cron_month,
+                day_of_week=cron_day_of_week
+            )
+        )
+
+        # Start the scheduler
+        scheduler.start()
+        logger.info("Scheduler started successfully.")
+
+        # Shut down the scheduler when exiting the app
+        atexit.register(lambda: scheduler.shutdown())
+    except Exception as e:
+        logger.error(f"Error setting up scheduler: {e}")
+        logger.error(traceback.format_exc())
@@ -0,0 +1,415 @@
+import json
+import os
+from fnmatch import fnmatch
+from urllib.parse import urlparse
+
+from src.bitbucket.webhook_handler import PullRequestHandler as BitbucketPullRequestHandler
+from src.entity.review_event import ReviewEvent
+from src.gitea.webhook_handler import PullRequestHandler as GiteaPullRequestHandler
+from src.github.webhook_handler import PullRequestHandler as GithubPullRequestHandler
+from src.gitlab.webhook_handler import slugify_url, MergeRequestHandler
+from src.queue.worker import handle_merge_request_event, handle_push_event, handle_github_pull_request_event, \
+    handle_github_push_event, handle_gitea_push_event, handle_gitea_pull_request_event, \
+    handle_bitbucket_push_event, handle_bitbucket_pull_request_event
+from src.utils.admission import admission_limits, check_admission
+from src.utils.log import logger
+from src.utils.payload_log import log_webhook_payload
+from src.utils.payload_store import delete_payload
+from src.utils.protected_branches import invalidate_protected_branches, protected_branches_cache_key
+from src.utils.queue import handle_queue, ENQUEUE_ACCEPTED, ENQUEUE_REJECTED, ENQUEUE_DUPLICATE, PRIORITY_MR, \
+    PRIORITY_MR_PROTECTED, PRIORITY_PUSH
+from src.utils.review_supersede import build_review_key
+
+
+class WebhookResponse:
+    """
+    与 Web 框架无关的 webhook 响应，由 Flask（api.py）和 ASGI（api_asgi.py）入口分别转换为各自的响应对象
+    """
+
+    def __init__(self, body, status_code: int = 200, headers: dict = None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def retry_later(message: str, status_code: int) -> WebhookResponse:
+    """拒绝 webhook 并通过 Retry-After 告诉代码托管平台稍后重试"""
+    return WebhookResponse({'message': message}, status_code,
+                           {'Retry-After': str(admission_limits()['retry_after_seconds'])})
+
+
+def parse_webhook_body(body: bytes):
+    """
+    解析 webhook 请求体
+    :return: (data, None)；解析失败或为空时返回 (None, 错误响应)
+    """
+    data = None
+    try:
+        if body:
+            data = json.loads(body)
+    except Exception as e:
+        logger.error(f'Failed to parse JSON: {str(e)}')
+        return None, WebhookResponse({"error": f"Invalid JSON format: {str(e)}"}, 400)
+    if not data:
+        logger.error('No data found in request')
+        return None, WebhookResponse({"error": "Invalid JSON or empty data"}, 400)
+    return data, None
+
+
+def resolve_project(data: dict) -> str:
+    """
+    从 webhook payload 中解析项目标识（例如 group/repo），用于队列按项目公平调度
+    """
+    # GitLab
+    project = data.get('project')
+    if isinstance(project, dict) and project.get('path_with_namespace'):
+        return project['path_with_namespace']
+    pull_request = data.get('pullRequest') or {}
+    repository = data.get('repository') or (pull_request.get('toRef') or {}).get('repository') or {}
+    # GitHub / Gitea
+    if repository.get('full_name'):
+        return repository['full_name']
+    # Bitbucket
+    repo_project = repository.get('project')
+    project_key = repo_project.get('key', '') if isinstance(repo_project, dict) else (repo_project or '')
+    return '/'.join(part for part in [project_key, repository.get('slug', '')] if part)
+
+
+# 各平台的投递 ID 请求头，平台超时重试时保持不变
+# GitLab: Idempotency-Key（17.4+）/ X-Gitlab-Event-UUID，GitHub: X-GitHub-Delivery，Gitea: X-Gitea-Delivery
+DELIVERY_ID_HEADERS = ['Idempotency-Key', 'X-Gitlab-Event-UUID', 'X-GitHub-Delivery', 'X-Gitea-Delivery']
+# Bitbucket Server 的投递 ID。反向代理、Ingress 经常为每个请求注入新的 X-Request-Id，
+# 只有确认是 Bitbucket 的 webhook（与 dispatch_webhook 的判断相同）时才使用，否则会让重复投递无法识别
+BITBUCKET_DELIVERY_ID_HEADER = 'X-Request-Id'
+
+
+def _is_bitbucket_webhook(headers) -> bool:
+    return bool(headers.get('X-Event-Key')) and not headers.get('X-Gitea-Event') and not headers.get('X-GitHub-Event')
+
+
+def resolve_delivery_key(url_slug: str, data: dict, headers, review_key: str = None) -> str:
+    """
+    生成 webhook 投递的唯一标识，用于丢弃平台超时重试造成的重复投递：
+    优先使用平台的投递 ID 请求头，否则 MR/PR 使用 MR 编号 + head SHA，Push 使用 before/after SHA
+    :return: 无法确定时返回 None，不做去重
+    """
+    header_names = DELIVERY_ID_HEADERS + ([BITBUCKET_DELIVERY_ID_HEADER] if _is_bitbucket_webhook(headers) else [])
+    for header in header_names:
+        delivery_id = headers.get(header)
+        if delivery_id:
+            return f'{url_slug}:{delivery_id}'
+
+    if review_key:
+        attributes = data.get('object_attributes') or {}
+        pull_request = data.get('pull_request') or data.get('pullRequest') or {}
+        head_sha = ((attributes.get('last_commit') or {}).get('id')
+                    or (pull_request.get('head') or {}).get('sha')
+                    or (pull_request.get('fromRef') or {}).get('latestCommit'))
+        return f'{review_key}:{head_sha}' if head_sha else None
+
+    before, after = data.get('before'), data.get('after')
+    if not (before and after) and data.get('changes'):
+        # Bitbucket refs_changed
+        change = data['changes'][0] or {}
+        before, after = change.get('fromHash'), change.get('toHash')
+    if before and after:
+        return f'{url_slug}:{resolve_project(data)}:{before}..{after}'
+    return None
+
+
+def merge_request_priority(target_branch: str, default_branch: str = None) -> int:
+    """
+    MR/PR 的队列优先级：目标分支为默认分支或匹配 QUEUE_PRIORITY_TARGET_BRANCHES 时优先级最高。
+    这里只根据 payload 判断，不调用平台 API 查询保护分支，避免拖慢 webhook 响应
+    """
+    patterns = [pattern.strip() for pattern in os.getenv('QUEUE_PRIORITY_TARGET_BRANCHES', '').split(',')
+                if pattern.strip()]
+    if target_branch and (target_branch == default_branch or any(fnmatch(target_branch, p) for p in patterns)):
+        return PRIORITY_MR_PROTECTED
+    return PRIORITY_MR
+
+
+def enqueue_review(function: callable, data: dict, headers, token: str, url: str, url_slug: str,
+                   accepted_message: str, review_key: str = None, priority: int = PRIORITY_PUSH) -> WebhookResponse:
+    """
+    将 review 任务放入队列并生成响应；队列已满时返回 503，让代码托管平台稍后重试
+    :param review_key: MR/PR 的唯一标识，同一 MR/PR 的新任务会替代尚未完成的旧任务
+    :param priority: 队列优先级，MR/PR 任务优先于 Push 任务执行
+    """
+    rejection = check_admission(priority)
+    if rejection:
+        status_code, reason = rejection
+        return retry_later(f'Review queue is overloaded ({reason}), please retry later.', status_code)
+
+    # 队列中只传递精简后的事件，去重、分项目调度所需的信息仍从原始 payload 中提取
+    event = ReviewEvent.from_webhook(data)
+    status = handle_queue(function, event.to_webhook_data(), token, url, url_slug, review_key=review_key,
+                          project=resolve_project(data), priority=priority,
+                          delivery_key=resolve_delivery_key(url_slug, data, headers, review_key))
+    if status != ENQUEUE_ACCEPTED:
+        delete_payload(event.raw_payload_id)
+    if status == ENQUEUE_REJECTED:
+        return retry_later('Review queue is full, please retry later.', 503)
+    if status == ENQUEUE_DUPLICATE:
+        return WebhookResponse({'message': 'Duplicate delivery, already queued.'}, 200)
+    return WebhookResponse({'message': accepted_message}, 200)
+
+
+def dispatch_webhook(data: dict, headers, content_length: int = None) -> WebhookResponse:
+    """
+    根据请求头判断 webhook 来源并分发到对应平台的处理函数
+    :param headers: 大小写不敏感的请求头（Flask / Starlette 的 Headers 对象）
+    """
+    # 判断 webhook 来源
+    # 注意：Gitea 为了兼容性会同时发送 X-GitHub-Event 和 X-Gitea-Event
+    # 所以需要优先检查 X-Gitea-Event（如果存在，一定是 Gitea）
+    github_event = headers.get('X-GitHub-Event')
+    gitea_event = headers.get('X-Gitea-Event')
+    # Bitbucket Server / Data Center 使用 `X-Event-Key` header
+    bitbucket_event = headers.get('X-Event-Key')
+
+    logger.debug(f'GitHub event: {github_event}, Gitea event: {gitea_event}')
+
+    # 优先识别 Gitea（因为 Gitea 会同时发送两种 header，但 GitHub 不会发送 Gitea header）
+    if gitea_event:  # Gitea webhook（优先）
+        return handle_gitea_webhook(gitea_event, data, headers, content_length)
+    elif github_event:  # GitHub webhook
+        return handle_github_webhook(github_event, data, headers, content_length)
+    elif bitbucket_event:
+        return handle_bitbucket_webhook(bitbucket_event, data, headers, content_length)
+    else:  # GitLab webhook（默认）
+        return handle_gitlab_webhook(data, headers, content_length)
+
+
+def handle_github_webhook(event_type, data, headers, content_length: int = None) -> WebhookResponse:
+    # 获取GitHub配置
+    github_token = os.getenv('GITHUB_ACCESS_TOKEN') or headers.get('X-GitHub-Token')
+    if not github_token:
+        return WebhookResponse({'message': 'Missing GitHub access token'}, 400)
+
+    github_url = os.getenv('GITHUB_URL') or 'https://github.com'
+    github_url_slug = slugify_url(github_url)
+
+    log_webhook_payload('GitHub', event_type, data, resolve_project(data), headers, content_length)
+
+    if event_type == "pull_request":
+        review_key = None
+        handler = GithubPullRequestHandler(data, github_token, github_url)
+        if handler.action in ['opened', 'synchronize']:
+            review_key = build_review_key('github', github_url_slug, handler.repo_full_name, handler.pull_request_number)
+        # 使用handle_queue进行异步处理，并立马返回响应
+        return enqueue_review(handle_github_pull_request_event, data, headers, github_token, github_url,
+                              github_url_slug,
+                              f'GitHub request received(event_type={event_type}), will process asynchronously.',
+                              review_key=review_key,
+                              priority=merge_request_priority(data.get('pull_request', {}).get('base', {}).get('ref'),
+                                                              data.get('repository', {}).get('default_branch')))
+    elif event_type == "push":
+        # 使用handle_queue进行异步处理，并立马返回响应
+        return enqueue_review(handle_github_push_event, data, headers, github_token, github_url, github_url_slug,
+                              f'GitHub request received(event_type={event_type}), will process asynchronously.')
+    elif event_type == "branch_protection_rule":
+        # 保护规则变更后清除该仓库的受保护分支缓存
+        repo_full_name = data.get('repository', {}).get('full_name')
+        invalidate_protected_branches(protected_branches_cache_key('github', github_url, repo_full_name))
+        return WebhookResponse({'message': f'Protected branches cache of {repo_full_name} invalidated.'}, 200)
+    else:
+        error_message = f'Only pull_request and push events are supported for GitHub webhook, but received: {event_type}.'
+        logger.error(error_message)
+        return WebhookResponse(error_message, 400)
+
+
+def handle_gitlab_webhook(data, headers, content_length: int = None) -> WebhookResponse:
+    object_kind = data.get("object_kind")
+
+    # 优先从请求头获取，如果没有，则从环境变量获取，如果没有，则从推送事件中获取
+    gitlab_url = os.getenv('GITLAB_URL') or headers.get('X-Gitlab-Instance')
+    if not gitlab_url:
+        repository = data.get('repository')
+        if not repository:
+            return WebhookResponse({'message': 'Missing GitLab URL'}, 400)
+        homepage = repository.get("homepage")
+        if not homepage:
+            return WebhookResponse({'message': 'Missing GitLab URL'}, 400)
+        try:
+            parsed_url = urlparse(homepage)
+            gitlab_url = f"{parsed_url.scheme}://{parsed_url.netloc}/"
+        except Exception as e:
+            return WebhookResponse({"error": f"Failed to parse homepage URL: {str(e)}"}, 400)
+
+    # 优先从环境变量获取，如果没有，则从请求头获取
+    gitlab_token = os.getenv('GITLAB_ACCESS_TOKEN') or headers.get('X-Gitlab-Token')
+    # 如果gitlab_token为空，返回错误
+    if not gitlab_token:
+        return WebhookResponse({'message': 'Missing GitLab access token'}, 400)
+
+    gitlab_url_slug = slugify_url(gitlab_url)
+
+    log_webhook_payload('GitLab', object_kind, data, resolve_project(data), headers, content_length)
+
+    # 处理Merge Request Hook
+    if object_kind == "merge_request":
+        # 只有会触发 review 的 action 才替代同一 MR 的旧任务，approved 等事件不影响正在进行的 review
+        review_key = None
+        handler = MergeRequestHandler(data, gitlab_token, gitlab_url)
+        if handler.action in ['open', 'update']:
+            review_key = build_review_key('gitlab', gitlab_url_slug, handler.project_id, handler.merge_request_iid)
+        # 放入队列进行异步处理，并立马返回响应
+        return enqueue_review(handle_merge_request_event, data, headers, gitlab_token, gitlab_url, gitlab_url_slug,
+                              f'Request received(object_kind={object_kind}), will process asynchronously.',
+                              review_key=review_key,
+                              priority=merge_request_priority(data.get('object_attributes', {}).get('target_branch'),
+                                                              data.get('project', {}).get('default_branch')))
+    elif object_kind == "push":
+        # 放入队列进行异步处理，并立马返回响应
+        # TODO check if PUSH_REVIEW_ENABLED is needed here
+        return enqueue_review(handle_push_event, data, headers, gitlab_token, gitlab_url, gitlab_url_slug,
+                              f'Request received(object_kind={object_kind}), will process asynchronously.')
+    else:
+        error_message = f'Only merge_request and push events are supported (both Webhook and System Hook), but received: {object_kind}.'
+        logger.error(error_message)
+        return WebhookResponse(error_message, 400)
+
+
+def handle_bitbucket_webhook(event_key: str, data: dict, headers, content_length: int = None) -> WebhookResponse:
+    """
+    处理 Bitbucket Server / Data Center 的 webhook，基于 `X-Event-Key`。
+    常见 event_key: repo:refs_changed (push), pr:opened, pr:from_ref_updated 等
+    """
+    log_webhook_payload('Bitbucket', event_key, data, resolve_project(data), headers, content_length)
+
+    # 获取 Bitbucket URL
+    bitbucket_url = os.getenv('BITBUCKET_URL') or headers.get('X-Bitbucket-Instance')
+    if not bitbucket_url:
+        # 从 payload 中提取 repository 链接
+        repository = data.get('repository', {})
+        links = repository.get('links', {})
+        self_links = links.get('self', []) if isinstance(links, dict) else []
+        html_url = ''
+        if self_links and isinstance(self_links, list):
+            html_url = self_links[0].get('href', '')
+        # 备用字段
+        if not html_url:
+            html_url = repository.get('links', {}).get('clone', [{}])[0].get('href', '') if repository.get('links') else ''
+
+        if not html_url:
+            return WebhookResponse({'message': 'Missing Bitbucket URL'}, 400)
+        try:
+            parsed_url = urlparse(html_url)
+            bitbucket_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        except Exception as e:
+            return WebhookResponse({"error": f"Failed to parse repository URL: {str(e)}"}, 400)
+
+    # 获取 Token
+    bitbucket_token = os.getenv('BITBUCKET_ACCESS_TOKEN') or headers.get('X-Bitbucket-Token')
+    if not bitbucket_token:
+        return WebhookResponse({'message': 'Missing Bitbucket access token'}, 400)
+
+    bitbucket_url_slug = slugify_url(bitbucket_url)
+
+    # 处理 push / refs_changed
+    if event_key and event_key.startswith('repo:') and ('refs_changed' in event_key or 'push' in event_key):
+        return enqueue_review(handle_bitbucket_push_event, data, headers, bitbucket_token, bitbucket_url,
+                              bitbucket_url_slug, f'Request received(event_key={event_key}), will process asynchronously.')
+
+    # 处理 PR 相关事件，Bitbucket 的 event_key 通常以 pr: 开头
+    if event_key and event_key.startswith('pr:'):
+        # Map Bitbucket PR event keys to action
+        action_map = {
+            'pr:opened': 'opened',
+            'pr:from_ref_updated': 'synchronize',
+            'pr:edited': 'update',
+            'pr:declined': 'closed',
+            'pr:merged': 'merged'
+        }
+        action = action_map.get(event_key, '')
+        # 将 action 放入 payload 中以便 handler 使用（兼容现有逻辑）
+        if isinstance(data, dict):
+            data.setdefault('action', action)
+
+        review_key = None
+        pull_request = data.get('pullRequest') or data.get('pull_request') or {}
+        handler = BitbucketPullRequestHandler(data, bitbucket_token, bitbucket_url)
+        if handler.action in ['opened', 'synchronize', 'update']:
+            review_key = build_review_key('bitbucket', bitbucket_url_slug, handler.repo_full_name,
+                                          handler.pull_request_id)
+        return enqueue_review(handle_bitbucket_pull_request_event, data, headers, bitbucket_token, bitbucket_url,
+                              bitbucket_url_slug, f'Request received(event_key={event_key}), will process asynchronously.',
+                              review_key=review_key,
+                              priority=merge_request_priority((pull_request.get('toRef') or {}).get('displayId')))
+
+    error_message = f'Only pull request and push events are supported for Bitbucket webhook, but received: {event_key}.'
+    logger.error(error_message)
+    return WebhookResponse(error_message, 400)
+
+
+def handle_gitea_webhook(event_type, data, headers, content_length: int = None) -> WebhookResponse:
+    logger.info(f'Processing Gitea webhook, event_type: {event_type}')
+
+    # 获取 Gitea 配置
+    gitea_token = os.getenv('GITEA_ACCESS_TOKEN') or headers.get('X-Gitea-Token')
+    if not gitea_token:
+        error_msg = 'Missing Gitea access token. Please set GITEA_ACCESS_TOKEN environment variable or provide X-Gitea-Token header.'
+        logger.error(error_msg)
+        return WebhookResponse({'message': error_msg}, 400)
+
+    # 获取 Gitea URL
+    gitea_url = os.getenv('GITEA_URL') or headers.get('X-Gitea-Instance')
+    if not gitea_url:
+        # 从 payload 中提取
+        repository = data.get('repository', {})
+        logger.debug(f'Repository data: {repository}')
+        if repository:
+            html_url = repository.get('html_url', '')
+            logger.debug(f'HTML URL from repository: {html_url}')
+            if html_url:
+                try:
+                    parsed_url = urlparse(html_url)
+                    gitea_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+                    logger.info(f'Extracted Gitea URL from payload: {gitea_url}')
+                except Exception as e:
+                    error_msg = f"Failed to parse repository URL: {str(e)}"
+                    logger.error(error_msg)
+                    return WebhookResponse({"error": error_msg}, 400)
+        if not gitea_url:
+            error_msg = 'Missing Gitea URL. Please set GITEA_URL environment variable, provide X-Gitea-Instance header, or ensure repository.html_url is present in payload.'
+            logger.error(error_msg)
+            logger.debug(f'Payload keys: {list(data.keys())}')
+            return WebhookResponse({'message': error_msg}, 400)
+
+    # URL Slug 用于队列隔离和日志标识
+    gitea_url_slug = slugify_url(gitea_url)
+
+    log_webhook_payload('Gitea', event_type, data, resolve_project(data), headers, content_length)
+    logger.info(f'Gitea URL: {gitea_url}')
+
+    # Push 事件优先级更高，先处理 Push
+    if event_type == "push":
+        return enqueue_review(handle_gitea_push_event, data, headers, gitea_token, gitea_url, gitea_url_slug,
+                              f'Gitea request received(event_type={event_type}), will process asynchronously.')
+    elif event_type == "pull_request":
+        # 只处理 opened 和 synchronize action
+        action = data.get('action', '')
+        logger.debug(f'Pull Request action: {action}')
+        if action not in ['opened', 'synchronize']:
+            logger.info(f"Gitea Pull Request event, action={action}, ignored.")
+            return WebhookResponse(
+                {'message': f'Gitea Pull Request event with action={action} is ignored, only opened and synchronize are supported.'}, 200)
+        handler = GiteaPullRequestHandler(data, gitea_token, gitea_url)
+        review_key = build_review_key('gitea', gitea_url_slug, handler.repo_full_name, handler.pull_request_number)
+        return enqueue_review(handle_gitea_pull_request_event, data, headers, gitea_token, gitea_url, gitea_url_slug,
+                              f'Gitea request received(event_type={event_type}), will process asynchronously.',
+                              review_key=review_key,
+                              priority=merge_request_priority(data.get('pull_request', {}).get('base', {}).get('ref'),
+                                                              data.get('repository', {}).get('default_branch')))
+    elif event_type == "issue_comment":
+        # issue_comment 事件：当 Issue 或 PR 上添加评论时触发
+        # 由于我们的系统会自动在 Issue 上添加评论，Gitea 会发送这个 webhook
+        # 我们不需要处理这个事件，静默忽略即可
+        logger.debug(f'Gitea issue_comment event received, ignored (auto-generated by our system).')
+        return WebhookResponse(
+            {'message': f'Gitea issue_comment event received and ignored (auto-generated by review system).'}, 200)
+    else:
+        error_message = f'Only pull_request, push, and issue_comment events are supported for Gitea webhook, but received: {event_type}.'
+        logger.error(error_message)
+        return WebhookResponse(error_message, 400)
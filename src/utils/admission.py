@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import Counter
+
+from src.utils.llm_inflight import count_llm_calls
+from src.utils.log import logger
+from src.utils.queue import get_queue_depth, PRIORITY_MR, PRIORITY_NAMES
+
+_shed = Counter()
+_shed_lock = threading.Lock()
+
+
+def admission_limits() -> dict:
+    return {
+        'max_queue_depth': int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', 0)),
+        'max_llm_in_flight': int(os.getenv('ADMISSION_MAX_LLM_IN_FLIGHT', 0)),
+        'low_priority_ratio': float(os.getenv('ADMISSION_LOW_PRIORITY_RATIO', 0.5)),
+        'retry_after_seconds': int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', 60)),
+    }
+
+
+def _over(value: int, limit: int, ratio: float = 1.0) -> bool:
+    return limit > 0 and value is not None and value >= limit * ratio
+
+
+def _rejection(priority: int, queue_depth: int, llm_in_flight: int, limits: dict):
+    """
+    :return: (状态码, 原因)，允许入队时返回 None
+    """
+    # MR/PR 只在超过上限时拒绝；Push、批量任务在达到上限的 low_priority_ratio 时就开始拒绝
+    ratio = 1.0 if priority <= PRIORITY_MR else limits['low_priority_ratio']
+    status_code = 503 if priority <= PRIORITY_MR else 429
+    if _over(queue_depth, limits['max_queue_depth'], ratio):
+        return status_code, f'queue_depth={queue_depth}'
+    if _over(llm_in_flight, limits['max_llm_in_flight'], ratio):
+        return status_code, f'llm_in_flight={llm_in_flight}'
+    return None
+
+
+def _current_load(limits: dict):
+    queue_depth = llm_in_flight = None
+    try:
+        if limits['max_queue_depth'] > 0:
+            queue_depth = get_queue_depth()
+        if limits['max_llm_in_flight'] > 0:
+            llm_in_flight = count_llm_calls()
+    except Exception as e:
+        # 无法获取负载时放行，准入控制不能成为 webhook 的单点故障
+        logger.warn(f'Failed to get queue load for admission control: {e}')
+    return queue_depth, llm_in_flight
+
+
+def check_admission(priority: int):
+    """
+    webhook 入队前的准入检查，队列积压或 LLM 并发超过高水位时拒绝，低优先级任务先被拒绝
+    :return: (状态码, 原因)，允许入队时返回 None
+    """
+    limits = admission_limits()
+    if limits['max_queue_depth'] <= 0 and limits['max_llm_in_flight'] <= 0:
+        return None
+    rejection = _rejection(priority, *_current_load(limits), limits)
+    if rejection:
+        with _shed_lock:
+            _shed[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        logger.warning(f'Admission rejected {PRIORITY_NAMES.get(priority, priority)} job: {rejection[1]}')
+    return rejection
+
+
+def get_admission_state() -> dict:
+    """返回当前准入状态：负载、高水位配置、各优先级是否接受新任务、被拒绝次数"""
+    limits = admission_limits()
+    queue_depth, llm_in_flight = _current_load({**limits, 'max_queue_depth': 1, 'max_llm_in_flight': 1})
+    with _shed_lock:
+        shed = dict(_shed)
+    return {
+        'queue_depth': queue_depth,
+        'llm_in_flight': llm_in_flight,
+        **limits,
+        'accepting': {name: _rejection(priority, queue_depth, llm_in_flight, limits) is None
+                      for priority, name in PRIORITY_NAMES.items()},
+        'shed': shed,
+    }
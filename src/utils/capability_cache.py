@@ -0,0 +1,150 @@
+import os
+import threading
+import time
+
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 所有候选接口都不可用时记录的值；该结论可能由个别资源不存在导致，只缓存较短的时间
+UNSUPPORTED = 'unsupported'
+UNSUPPORTED_TTL_SECONDS = 3600
+
+# probe_endpoint 中 classify 的返回值：接口可用 / 换下一个候选接口 / 接口存在但请求失败，不再尝试
+PROBE_OK = 'ok'
+PROBE_NEXT = 'next'
+PROBE_STOP = 'stop'
+# 表示候选接口（路由）不存在的状态码，只有这些状态码才换下一个候选接口；5xx 等错误可能只是暂时故障，不能据此换接口
+ENDPOINT_MISSING_STATUS = (404, 405)
+
+
+class SqliteCapabilityStore(SqliteStore):
+    """记录各代码托管平台实例可用的 API 形式，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS scm_capabilities (
+            instance TEXT NOT NULL,
+            capability TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (instance, capability)
+        )
+    ''',)
+
+    def get(self, instance: str, capability: str):
+        row = self._connect().execute('SELECT value FROM scm_capabilities WHERE instance = ? AND capability = ? '
+                                      'AND expires_at >= ?', (instance, capability, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, instance: str, capability: str, value: str, ttl_seconds: int):
+        self._connect().execute('INSERT OR REPLACE INTO scm_capabilities (instance, capability, value, expires_at) '
+                                'VALUES (?, ?, ?, ?)', (instance, capability, value, time.time() + ttl_seconds))
+
+    def delete(self, instance: str, capability: str):
+        self._connect().execute('DELETE FROM scm_capabilities WHERE instance = ? AND capability = ?',
+                                (instance, capability))
+
+
+class RedisCapabilityStore(RedisStore):
+    """rq 驱动使用 Redis 记录各代码托管平台实例可用的 API 形式"""
+
+    KEY_PREFIX = 'scm_capability:'
+
+    def get(self, instance: str, capability: str):
+        value = self.redis.get(f'{self.KEY_PREFIX}{instance}:{capability}')
+        return value.decode('utf-8') if value else None
+
+    def set(self, instance: str, capability: str, value: str, ttl_seconds: int):
+        self.redis.set(f'{self.KEY_PREFIX}{instance}:{capability}', value, ex=ttl_seconds)
+
+    def delete(self, instance: str, capability: str):
+        self.redis.delete(f'{self.KEY_PREFIX}{instance}:{capability}')
+
+
+# 进程内的缓存，避免同一个任务中的每次调用都访问 SQLite / Redis：{(instance, capability): (value, expires_at)}
+_local = {}
+_local_lock = threading.Lock()
+
+
+get_capability_store = driver_store(SqliteCapabilityStore, RedisCapabilityStore)
+
+
+def capability_ttl_seconds() -> int:
+    return int(os.getenv('SCM_CAPABILITY_TTL_SECONDS', 86400))
+
+
+def get_capability(instance: str, capability: str):
+    """
+    :return: 之前探测到的可用形式；未探测过、已过期或缓存关闭时返回 None
+    """
+    if capability_ttl_seconds() <= 0:
+        return None
+    with _local_lock:
+        value, expires_at = _local.get((instance, capability), (None, 0))
+    if value is not None and expires_at >= time.time():
+        return value
+    try:
+        value = get_capability_store().get(instance, capability)
+    except Exception as e:
+        logger.warn(f'Failed to read API capability {capability} of {instance}: {e}')
+        return None
+    if value is not None:
+        with _local_lock:
+            # 持久化存储中的剩余有效期未知，进程内只保留较短的时间
+            _local[(instance, capability)] = (value, time.time() + min(capability_ttl_seconds(), 300))
+    return value
+
+
+def set_capability(instance: str, capability: str, value: str):
+    ttl_seconds = capability_ttl_seconds()
+    if ttl_seconds <= 0:
+        return
+    if value == UNSUPPORTED:
+        ttl_seconds = min(ttl_seconds, UNSUPPORTED_TTL_SECONDS)
+    with _local_lock:
+        _local[(instance, capability)] = (value, time.time() + ttl_seconds)
+    try:
+        get_capability_store().set(instance, capability, value, ttl_seconds)
+    except Exception as e:
+        logger.warn(f'Failed to save API capability {capability} of {instance}: {e}')
+
+
+def probe_endpoint(instance: str, capability: str, variants: dict, classify: callable, cache_unsupported: bool = True):
+    """
+    按顺序尝试同一功能的多个候选接口，记住第一个可用的接口，之后直接使用它。
+    缓存的接口返回 PROBE_NEXT 时（例如平台升级）探测其余候选接口，其他接口可用时才替换缓存，
+    避免个别资源不存在导致缓存被清除
+    :param variants: {名称: 发起请求并返回 response 的函数}，按优先级排列
+    :param classify: 根据 response 返回 PROBE_OK / PROBE_NEXT / PROBE_STOP
+    :param cache_unsupported: 所有候选接口都失败时是否记录为不支持；失败可能只是请求的资源不存在时应传 False
+    :return: (可用接口的名称, response)；没有可用接口时名称为 None，response 为最后一次请求的响应（可能为 None）
+    """
+    cached = get_capability(instance, capability)
+    if cached == UNSUPPORTED:
+        logger.debug(f'{capability} is not supported by {instance} (cached), skipped.')
+        return None, None
+
+    response = None
+    if cached in variants:
+        response = variants[cached]()
+        outcome = classify(response)
+        if outcome == PROBE_OK:
+            return cached, response
+        if outcome == PROBE_STOP:
+            return None, response
+        logger.info(f'Cached {capability} endpoint "{cached}" failed on {instance}, probing the other endpoints.')
+
+    for name, call in variants.items():
+        if name == cached:
+            continue
+        response = call()
+        outcome = classify(response)
+        if outcome == PROBE_OK:
+            set_capability(instance, capability, name)
+            logger.info(f'{instance} supports {capability} via "{name}".')
+            return name, response
+        if outcome == PROBE_STOP:
+            return None, response
+
+    if cache_unsupported:
+        set_capability(instance, capability, UNSUPPORTED)
+    return None, response
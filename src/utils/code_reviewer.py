@@ -7,7 +7,10 @@ import yaml
 from jinja2 import Template
 
 from src.llm.factory import Factory
+from src.utils.diff_readiness import stop_rescheduling
+from src.utils.llm_inflight import track_llm_call
 from src.utils.log import logger
+from src.utils.payload_log import BoundedRepr
 from src.utils.token_util import count_tokens, truncate_text_by_tokens
 
 
@@ -43,9 +46,13 @@ class BaseReviewer(abc.ABC):
 
     def call_llm(self, messages: List[Dict[str, Any]]) -> str:
         """调用 LLM 进行代码审核"""
-        logger.info(f"向 AI 发送代码 Review 请求, messages: {messages}")
-        review_result = self.client.completions(messages=messages)
-        logger.info(f"收到 AI 返回结果: {review_result}")
+        logger.info("向 AI 发送代码 Review 请求, messages: %s", BoundedRepr(messages))
+        # 之后发布评论、查找 issue 等请求遇到限流时不再延迟任务，避免重复调用大模型
+        stop_rescheduling()
+        with track_llm_call():
+            review_result = self.client.completions(messages=messages)
+        logger.info('收到 AI 返回结果: %d 个字符', len(review_result or ''))
+        logger.debug('AI 返回结果: %s', BoundedRepr(review_result))
         return review_result
 
     @abc.abstractmethod
@@ -0,0 +1,134 @@
+import itertools
+import re
+
+_DIFF_HEADER = re.compile(r'^diff --git ', re.MULTILINE)
+_FILE_MARKER = re.compile(r'^(?:--- a/|\+\+\+ b/|rename from |rename to )(.+?)\s*$', re.MULTILINE)
+# diff 的结构行：文件头（diff --git 到第一个 hunk 之前，或紧接 hunk 头的 ---/+++ 两行）、hunk 头、二进制标记
+_STRUCTURE = (r'(?:(?P<header>diff --git [^\n]*(?:\n(?!@@|diff --git )[^\n]*)*|--- [^\n]*\n\+\+\+ [^\n]*(?=\n@@))'
+              r'|(?P<hunk>@@ -(?P<old_start>\d+)(?:,(?P<old_lines>\d+))? \+(?P<new_start>\d+)(?:,(?P<new_lines>\d+))? @@)'
+              r'|(?P<binary>Binary files |GIT binary patch))')
+# 以换行符开头的字面量前缀让正则引擎只在行首尝试匹配，增删行和上下文行由 C 实现的 str.count 统计
+_STRUCTURE_LINE = re.compile(r'\n' + _STRUCTURE)
+_STRUCTURE_FIRST_LINE = re.compile(_STRUCTURE)
+
+
+def _header_paths(header: str) -> list:
+    """
+    解析 `diff --git a/<old> b/<new>` 中的路径；路径中含空格时无法直接按空格切分，
+    新旧路径相同（最常见的情况）时按长度从中间切分
+    """
+    rest = header[len('diff --git '):].strip()
+    if not rest.startswith('a/'):
+        return []
+    half = (len(rest) - 1) // 2
+    if len(rest) % 2 == 1 and rest[half] == ' ' and rest[half + 1:].startswith('b/') \
+            and rest[2:half] == rest[half + 3:]:
+        return [rest[2:half]]
+    old_path, separator, new_path = rest[2:].partition(' b/')
+    return [path for path in [old_path, new_path] if path] if separator else []
+
+
+def split_unified_diff(full_diff: str) -> dict:
+    """
+    一次遍历把整个 commit / PR 的 diff 拆分为 {文件路径: 该文件的 diff}，
+    每个文件的 diff 从 `diff --git` 行开始，到下一个文件的 `diff --git` 行之前结束；新旧路径都会作为 key
+    """
+    patches = {}
+    if not full_diff:
+        return patches
+    starts = [match.start() for match in _DIFF_HEADER.finditer(full_diff)]
+    for i, start in enumerate(starts):
+        end = starts[i + 1] if i + 1 < len(starts) else len(full_diff)
+        section = full_diff[start:end].rstrip('\n')
+        header, _, body = section.partition('\n')
+        # 文件头部分（第一个 hunk 之前）的 ---/+++/rename 行比 diff --git 行更可靠
+        preamble = body.split('\n@@', 1)[0]
+        paths = _header_paths(header) + [path for path in _FILE_MARKER.findall(preamble) if path != '/dev/null']
+        for path in paths:
+            patches.setdefault(path, section)
+    return patches
+
+
+class DiffIndex:
+    """
+    整个 commit / PR diff 的 {路径: patch} 索引，每个 review 任务只下载、拆分一次，之后所有文件都从索引中读取
+    """
+
+    def __init__(self, full_diff: str):
+        self.full_diff = full_diff or ''
+        self.patches = split_unified_diff(self.full_diff)
+
+    def __len__(self):
+        return len(self.patches)
+
+    def get(self, filename: str) -> str:
+        """
+        :return: 文件的 diff；精确匹配不到时按路径后缀匹配（与原来按文件名查找的行为一致），找不到返回空字符串
+        """
+        patch = self.patches.get(filename)
+        if patch:
+            return patch
+        suffix = f'/{filename}'
+        for path, patch in self.patches.items():
+            if path.endswith(suffix):
+                return patch
+        return ''
+
+
+class DiffStats:
+    """scan_diff 的结果：增删行数、hunk 数量与每个 hunk 头在 diff 中的偏移，以及新增 / 删除 / 重命名 / 二进制标记"""
+    __slots__ = ('additions', 'deletions', 'hunk_offsets', 'new_file', 'deleted_file', 'renamed_file', 'binary')
+
+    def __init__(self):
+        self.additions = 0
+        self.deletions = 0
+        self.hunk_offsets = []
+        self.new_file = False
+        self.deleted_file = False
+        self.renamed_file = False
+        self.binary = False
+
+    @property
+    def hunks(self) -> int:
+        return len(self.hunk_offsets)
+
+
+def scan_diff(diff: str) -> DiffStats:
+    """
+    一次扫描统计 diff 的增删行数、hunk 位置和文件状态，支持只有 hunk 的 diff（各平台 API 的 diff / patch 字段）
+    和带文件头的 unified diff。文件头中的 ---/+++ 行不计入增删行数，hunk 中以 ++ / -- 开头的内容行正常计入；
+    没有文件头时，所有 hunk 的新文件一侧都为空（+0,0）视为删除文件，旧文件一侧都为空（-0,0）视为新增文件
+    """
+    stats = DiffStats()
+    if not diff:
+        return stats
+    # 第一行前面没有换行符，单独匹配，之后从它的结尾继续查找
+    first = _STRUCTURE_FIRST_LINE.match(diff)
+    matches = itertools.chain([first], _STRUCTURE_LINE.finditer(diff, first.end())) if first \
+        else _STRUCTURE_LINE.finditer(diff)
+    header_additions = header_deletions = 0
+    empty_new = empty_old = True
+    for match in matches:
+        kind = match.lastgroup
+        if kind == 'hunk':
+            stats.hunk_offsets.append(match.start('hunk'))
+            empty_new = empty_new and match.group('new_start') == '0' and match.group('new_lines') == '0'
+            empty_old = empty_old and match.group('old_start') == '0' and match.group('old_lines') == '0'
+        elif kind == 'binary':
+            stats.binary = True
+        else:
+            header = match.group()
+            header_additions += header.count('\n+')
+            header_deletions += header.count('\n-') + header.startswith('-')
+            stats.deleted_file = stats.deleted_file or 'deleted file mode ' in header or '+++ /dev/null' in header
+            stats.new_file = stats.new_file or 'new file mode ' in header or '--- /dev/null' in header
+            stats.renamed_file = stats.renamed_file or '\nrename from ' in header
+            stats.binary = stats.binary or '\nBinary files ' in header or '\nGIT binary patch' in header
+    # 文件头中的 ---/+++ 行已在上面单独统计，从全部以 +/- 开头的行中减去
+    stats.additions = diff.count('\n+') + diff.startswith('+') - header_additions
+    stats.deletions = diff.count('\n-') + diff.startswith('-') - header_deletions
+    if stats.hunk_offsets and stats.additions == 0 and empty_new:
+        stats.deleted_file = True
+    if stats.hunk_offsets and stats.deletions == 0 and empty_old:
+        stats.new_file = True
+    return stats
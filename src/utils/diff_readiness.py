@@ -0,0 +1,249 @@
+import contextvars
+import os
+import random
+import sqlite3
+import time
+from datetime import timedelta
+
+from rq import Queue, get_current_job
+
+from src.utils.log import logger
+from src.utils.sqlite_queue import resolve_function
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 当前进程中正在执行的 MR/PR 任务的 diff 就绪重试状态：(已重试次数, 第一次尝试的时间)
+_current_attempt = contextvars.ContextVar('diff_readiness_attempt', default=None)
+
+
+def readiness_options() -> dict:
+    return {
+        # 第一次重试前的等待时间，之后每次翻倍，实际等待时间在 [delay/2, delay] 之间随机（抖动）
+        'base_delay': float(os.getenv('DIFF_READY_BASE_DELAY_SECONDS', 0.5)),
+        'max_delay': float(os.getenv('DIFF_READY_MAX_DELAY_SECONDS', 60)),
+        'max_attempts': int(os.getenv('DIFF_READY_MAX_ATTEMPTS', 8)),
+        # 不超过该时间的等待直接在 worker 中 sleep，更长的等待通过队列延迟重试，释放 worker
+        'inline_max_delay': float(os.getenv('DIFF_READY_INLINE_MAX_SECONDS', 2)),
+    }
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """第 attempt 次重试（从 0 开始）前的等待时间：指数增长，上限 max_delay，带随机抖动避免多个任务同时重试"""
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+
+class RescheduleJob(BaseException):
+    """
+    任务需要等待 delay 秒后通过队列重新执行，由 run_readiness_job 处理。
+    继承 BaseException：handler 中大量 except Exception 的兜底处理不会把它当作普通错误吞掉，
+    一直传到任务入口 run_readiness_job
+    :param attempt: 重新执行时的 diff 就绪重试次数，None 表示保持不变
+    """
+
+    def __init__(self, message: str, delay: float, attempt: int = None):
+        super().__init__(message)
+        self.delay = delay
+        self.attempt = attempt
+
+
+class ChangesNotReady(RescheduleJob):
+    """MR/PR 的 diff 尚未生成，需要等待 delay 秒后通过队列重新执行任务"""
+
+    def __init__(self, platform: str, attempt: int, delay: float):
+        super().__init__(f'{platform} changes not ready yet, retry #{attempt} in {delay:.2f}s', delay, attempt)
+        self.platform = platform
+
+
+class RetryLater:
+    """
+    run_readiness_job 的返回值：async、sqlite 驱动据此把任务放回队列，delay 秒后以 args 重新执行；
+    rq 驱动由 run_readiness_job 直接调用 enqueue_in，不返回该对象
+    """
+    __slots__ = ('delay', 'args')
+
+    def __init__(self, delay: float, args: tuple):
+        self.delay = delay
+        self.args = args
+
+
+class SqliteReadinessStats(SqliteStore):
+    """按平台统计 diff 从 webhook 到可获取所用的时间，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS diff_readiness (
+            platform TEXT PRIMARY KEY,
+            ready INTEGER NOT NULL DEFAULT 0,
+            ready_first_try INTEGER NOT NULL DEFAULT 0,
+            gave_up INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            total_wait REAL NOT NULL DEFAULT 0,
+            max_wait REAL NOT NULL DEFAULT 0
+        )
+    ''',)
+
+    def record(self, platform: str, ready: bool, attempts: int, wait: float):
+        self._connect().execute('''
+            INSERT INTO diff_readiness (platform, ready, ready_first_try, gave_up, retries, total_wait, max_wait)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(platform) DO UPDATE SET
+                ready = ready + excluded.ready,
+                ready_first_try = ready_first_try + excluded.ready_first_try,
+                gave_up = gave_up + excluded.gave_up,
+                retries = retries + excluded.retries,
+                total_wait = total_wait + excluded.total_wait,
+                max_wait = MAX(max_wait, excluded.max_wait)
+        ''', (platform, int(ready), int(ready and attempts == 0), int(not ready), attempts,
+              wait if ready else 0, wait if ready else 0))
+
+    def stats(self) -> dict:
+        # 连接由多个存储共用，只在这个游标上按列名返回行
+        cursor = self._connect().cursor()
+        cursor.row_factory = sqlite3.Row
+        return {row['platform']: dict(row) for row in cursor.execute('SELECT * FROM diff_readiness')}
+
+
+class RedisReadinessStats(RedisStore):
+    """rq 驱动使用 Redis 哈希按平台记录 diff 就绪时间统计"""
+
+    KEY_PREFIX = 'diff_readiness:'
+
+    def record(self, platform: str, ready: bool, attempts: int, wait: float):
+        key = self.KEY_PREFIX + platform
+        pipe = self.redis.pipeline()
+        pipe.hincrby(key, 'ready' if ready else 'gave_up', 1)
+        pipe.hincrby(key, 'retries', attempts)
+        if ready:
+            pipe.hincrby(key, 'ready_first_try', int(attempts == 0))
+            pipe.hincrbyfloat(key, 'total_wait', wait)
+        pipe.execute()
+        # 最大值不需要严格准确，并发更新时允许偶尔被较小的值覆盖
+        if ready and wait > float(self.redis.hget(key, 'max_wait') or 0):
+            self.redis.hset(key, 'max_wait', wait)
+
+    def stats(self) -> dict:
+        stats = {}
+        for key in self.redis.scan_iter(f'{self.KEY_PREFIX}*'):
+            platform = key.decode('utf-8')[len(self.KEY_PREFIX):]
+            values = {field.decode('utf-8'): float(value) for field, value in self.redis.hgetall(key).items()}
+            stats[platform] = {
+                'platform': platform,
+                **{field: int(values.get(field, 0)) for field in ('ready', 'ready_first_try', 'gave_up', 'retries')},
+                'total_wait': values.get('total_wait', 0.0),
+                'max_wait': values.get('max_wait', 0.0),
+            }
+        return stats
+
+
+get_readiness_stats_store = driver_store(SqliteReadinessStats, RedisReadinessStats)
+
+
+def _record(platform: str, ready: bool, attempts: int, wait: float):
+    try:
+        get_readiness_stats_store().record(platform, ready, attempts, wait)
+    except Exception as e:
+        logger.warn(f'Failed to record diff readiness of {platform}: {e}')
+
+
+def get_readiness_stats() -> dict:
+    """
+    各平台 diff 就绪情况：第一次就拿到 diff 的比例、平均 / 最大等待时间（从任务第一次执行开始计算）、
+    重试次数和放弃次数，用于调整 DIFF_READY_* 配置
+    """
+    try:
+        rows = get_readiness_stats_store().stats()
+    except Exception as e:
+        logger.warn(f'Failed to read diff readiness stats: {e}')
+        return {}
+    stats = {}
+    for platform, row in rows.items():
+        ready = row['ready']
+        stats[platform] = {
+            'ready': ready,
+            'ready_first_try': row['ready_first_try'],
+            'gave_up': row['gave_up'],
+            'retries': row['retries'],
+            'avg_wait_seconds': round(row['total_wait'] / ready, 2) if ready else 0,
+            'max_wait_seconds': round(row['max_wait'], 2),
+        }
+    return stats
+
+
+def in_reschedulable_job() -> bool:
+    """当前是否在 run_readiness_job 中执行，即抛出 RescheduleJob 后任务会被延迟重试"""
+    return _current_attempt.get() is not None
+
+
+def stop_rescheduling():
+    """
+    当前任务之后不再通过队列延迟重试：调用大模型之后再抛出 RescheduleJob 会重新执行整个任务（包括再次调用大模型），
+    之后的请求遇到限流时只在当前进程中等待。run_readiness_job 结束时恢复
+    """
+    _current_attempt.set(None)
+
+
+class FilteredChanges(list):
+    """
+    分页获取时逐页过滤后的 changes，total 为平台返回的文件总数（过滤前）。
+    文件都被过滤掉时列表为空，但 total > 0 说明 diff 已经生成，wait_for_changes 不再重试
+    """
+
+    def __init__(self, changes: list, total: int):
+        super().__init__(changes)
+        self.total = total
+
+
+def wait_for_changes(platform: str, fetch: callable, description: str = '') -> list:
+    """
+    获取 MR/PR 的 changes，平台尚未生成 diff（返回空列表）时按带抖动的指数退避重试：
+    较短的等待直接在当前进程中 sleep；更长的等待抛出 ChangesNotReady，由 run_readiness_job 通过队列延迟重试，
+    不在等待期间占用 worker。不在 run_readiness_job 中执行时（例如直接调用）全部在当前进程中等待。
+    :param fetch: 请求一次 changes，返回 changes 列表（或 FilteredChanges）；请求失败、不需要重试时返回 None
+    :return: changes，请求失败或重试次数用完时返回空列表
+    """
+    options = readiness_options()
+    state = _current_attempt.get()
+    attempt, first_attempt_at = state if state is not None else (0, time.time())
+    while True:
+        changes = fetch()
+        if changes is None:
+            return []
+        if changes or getattr(changes, 'total', 0):
+            wait = time.time() - first_attempt_at
+            if attempt:
+                logger.info(f'{platform} changes ready after {wait:.2f}s ({attempt} retries). {description}')
+            _record(platform, True, attempt, wait)
+            return changes
+        if attempt + 1 >= options['max_attempts']:
+            logger.warning(f'Max retries ({options["max_attempts"]}) reached. Changes is still empty. {description}')
+            _record(platform, False, attempt, time.time() - first_attempt_at)
+            return []
+        delay = backoff_delay(attempt, options['base_delay'], options['max_delay'])
+        attempt += 1
+        if state is not None and delay > options['inline_max_delay']:
+            raise ChangesNotReady(platform, attempt, delay)
+        logger.info(f'Changes is empty, retrying in {delay:.2f} seconds... '
+                    f'(attempt {attempt}/{options["max_attempts"]}) {description}')
+        time.sleep(delay)
+
+
+def run_readiness_job(function: str, attempt: int, first_attempt_at: float, *args):
+    """
+    任务的入口：任务中抛出 RescheduleJob 时延迟重新入队，例如 wait_for_changes 抛出的 ChangesNotReady（重试次数递增）、
+    代码托管平台限流时抛出的 RateLimited（src/utils/rate_limit.py，重试次数不变）。
+    rq 驱动直接调用 enqueue_in（worker 需要以 --with-scheduler 启动），async、sqlite 驱动返回 RetryLater 由队列处理
+    :param function: 任务函数引用，例如 src.utils.review_supersede:run_review_job
+    """
+    token = _current_attempt.set((attempt, first_attempt_at))
+    try:
+        return resolve_function(function)(*args)
+    except RescheduleJob as e:
+        retry_args = (function, attempt if e.attempt is None else e.attempt, first_attempt_at) + tuple(args)
+        logger.info(f'{e}, job rescheduled through the queue.')
+        job = get_current_job()
+        if job is not None:
+            Queue(job.origin, connection=job.connection).enqueue_in(timedelta(seconds=e.delay), run_readiness_job,
+                                                                    *retry_args)
+            return None
+        return RetryLater(e.delay, retry_args)
+    finally:
+        _current_attempt.reset(token)
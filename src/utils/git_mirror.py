@@ -0,0 +1,206 @@
+import base64
+import contextlib
+import fnmatch
+import os
+import re
+import shutil
+import subprocess
+
+from src.utils.diff_index import scan_diff, split_unified_diff
+from src.utils.log import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能依靠 git 自身的锁
+    fcntl = None
+
+_SHA = re.compile(r'^[0-9a-f]{40}$')
+_EMPTY_SHA = re.compile(r'^0+$')
+
+
+def git_mirror_options() -> dict:
+    return {
+        'enabled': os.getenv('GIT_MIRROR_ENABLED', '0') == '1',
+        'dir': os.getenv('GIT_MIRROR_DIR', 'data/mirrors'),
+        # 使用本地镜像的项目，逗号分隔，支持通配符，例如 group/*,org/repo
+        'repos': [item.strip() for item in os.getenv('GIT_MIRROR_REPOS', '').split(',') if item.strip()],
+        'fetch_timeout': int(os.getenv('GIT_MIRROR_FETCH_TIMEOUT_SECONDS', 300)),
+        'diff_timeout': int(os.getenv('GIT_MIRROR_DIFF_TIMEOUT_SECONDS', 60)),
+    }
+
+
+def default_clone_url(platform: str, base_url: str, project: str) -> str:
+    """webhook payload 中没有克隆地址时，按平台的默认规则拼接 HTTP 克隆地址"""
+    base_url = (base_url or '').rstrip('/')
+    if platform == 'github':
+        return f'https://github.com/{project}.git'
+    if platform == 'bitbucket':
+        return f'{base_url}/scm/{project}.git'
+    return f'{base_url}/{project}.git'
+
+
+def _auth_header(platform: str, token: str) -> str:
+    """通过 HTTP 头传递 token，不写入镜像的配置文件和 remote 地址"""
+    if platform == 'bitbucket':
+        return f'Authorization: Bearer {token}'
+    user = {'gitlab': 'oauth2', 'github': 'x-access-token'}.get(platform)
+    credentials = f'{user}:{token}' if user else f'{token}:x-oauth-basic'
+    return f'Authorization: Basic {base64.b64encode(credentials.encode("utf-8")).decode("ascii")}'
+
+
+def _hunks(section: str) -> str:
+    """去掉 diff --git / index / ---/+++ 等文件头，只保留 @@ 开始的部分，与各平台 API 返回的 diff 字段一致"""
+    if section.startswith('@@'):
+        return section
+    index = section.find('\n@@')
+    return section[index + 1:] if index >= 0 else ''
+
+
+def _parse_raw(output: str) -> list:
+    """
+    解析 git diff --raw -z 的输出：
+    :<旧 mode> <新 mode> <旧 sha> <新 sha> <状态>\0<路径>\0[重命名 / 复制后的路径\0]
+    """
+    entries = []
+    fields = output.split('\0')
+    i = 0
+    while i < len(fields) - 1:
+        meta = fields[i]
+        if not meta.startswith(':'):
+            i += 1
+            continue
+        status = meta.split()[-1]
+        if status[0] in 'RC':
+            entries.append((status[0], fields[i + 1], fields[i + 2]))
+            i += 3
+        else:
+            entries.append((status[0], fields[i + 1], fields[i + 1]))
+            i += 2
+    return entries
+
+
+class GitMirror:
+    """
+    一个仓库在本地的 bare 镜像（git clone --mirror），增量 fetch 后在本地计算 diff，
+    多个 worker 进程通过文件锁串行 fetch
+    """
+
+    def __init__(self, platform: str, url_slug: str, project: str, clone_url: str, token: str, options: dict):
+        self.platform = platform
+        self.project = project
+        self.clone_url = clone_url
+        self.token = token
+        self.options = options
+        safe_project = '/'.join(part for part in str(project).split('/') if part not in ('', '.', '..'))
+        self.path = os.path.join(options['dir'], platform, url_slug, f'{safe_project}.git')
+
+    def _env(self) -> dict:
+        env = {**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+        if self.token:
+            env.update({
+                'GIT_CONFIG_COUNT': '1',
+                'GIT_CONFIG_KEY_0': 'http.extraHeader',
+                'GIT_CONFIG_VALUE_0': _auth_header(self.platform, self.token),
+            })
+        return env
+
+    def _git(self, *args, timeout: int, check: bool = True) -> subprocess.CompletedProcess:
+        return subprocess.run(['git', '-c', 'core.quotePath=false', *args], env=self._env(), timeout=timeout, check=check,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def has_commit(self, sha: str) -> bool:
+        return self._git('-C', self.path, 'cat-file', '-e', f'{sha}^{{commit}}',
+                         timeout=self.options['diff_timeout'], check=False).returncode == 0
+
+    def sync(self, revisions: list) -> bool:
+        """
+        保证镜像中包含 revisions：首次使用时完整克隆，之后只在缺少提交或需要解析分支名时增量 fetch
+        :return: 所有提交都已存在时返回 True
+        """
+        with self._lock():
+            if not os.path.isdir(self.path):
+                logger.info(f'Cloning mirror of {self.platform}:{self.project} into {self.path}')
+                self._git('clone', '--mirror', '--quiet', self.clone_url, self.path,
+                          timeout=self.options['fetch_timeout'])
+            elif not all(_SHA.match(rev) and self.has_commit(rev) for rev in revisions):
+                self._git('-C', self.path, 'fetch', '--prune', '--quiet', 'origin',
+                          timeout=self.options['fetch_timeout'])
+            return all(self.has_commit(rev) for rev in revisions if _SHA.match(rev))
+
+    def changes(self, base: str, head: str, merge_base: bool = False) -> list:
+        """
+        计算 base 与 head 之间的变更，返回与平台 API 相同结构的 changes
+        :param merge_base: 为 True 时与 MR/PR 一致，比较 head 与两者的共同祖先
+        """
+        revision_range = f'{base}...{head}' if merge_base else f'{base}..{head}'
+        options = ['--no-color', '--no-ext-diff', '--find-renames']
+        raw = self._git('-C', self.path, 'diff', '--raw', '-z', *options, revision_range,
+                        timeout=self.options['diff_timeout']).stdout.decode('utf-8', errors='replace')
+        patch = self._git('-C', self.path, 'diff', *options, revision_range,
+                          timeout=self.options['diff_timeout']).stdout.decode('utf-8', errors='replace')
+        patches = split_unified_diff(patch)
+
+        changes = []
+        for status, old_path, new_path in _parse_raw(raw):
+            diff = _hunks(patches.get(new_path) or patches.get(old_path) or '')
+            stats = scan_diff(diff)
+            changes.append({
+                'old_path': old_path,
+                'new_path': new_path,
+                'diff': diff,
+                'new_file': status == 'A',
+                'renamed_file': status == 'R',
+                'deleted_file': status == 'D',
+                'status': {'A': 'added', 'D': 'removed', 'R': 'renamed'}.get(status, 'modified'),
+                'additions': stats.additions,
+                'deletions': stats.deletions,
+            })
+        return changes
+
+
+def mirror_changes(platform: str, base_url: str, url_slug: str, project: str, token: str, base: str, head: str,
+                   clone_url: str = None, merge_base: bool = False):
+    """
+    GIT_MIRROR_ENABLED=1 且项目匹配 GIT_MIRROR_REPOS 时，从本地镜像计算 base 与 head 之间的 changes，
+    不调用平台的 compare / diff API，不受分页、截断和限流影响
+    :param base: 提交 SHA 或分支名（MR 的目标分支）
+    :return: changes 列表；未启用、项目未配置或本地计算失败时返回 None，调用方继续使用 REST API
+    """
+    options = git_mirror_options()
+    if not options['enabled'] or not project or not base or not head:
+        return None
+    if not any(fnmatch.fnmatch(str(project), pattern) for pattern in options['repos']):
+        return None
+    if _EMPTY_SHA.match(base) or _EMPTY_SHA.match(head):
+        return None
+    if shutil.which('git') is None:
+        logger.warn('GIT_MIRROR_ENABLED=1 but git is not installed, falling back to the REST API.')
+        return None
+
+    mirror = GitMirror(platform, url_slug, project, clone_url or default_clone_url(platform, base_url, project),
+                       token, options)
+    try:
+        if not mirror.sync([base, head]):
+            logger.warn(f'Mirror of {platform}:{project} does not contain {base} / {head}, '
+                        f'falling back to the REST API.')
+            return None
+        changes = mirror.changes(base, head, merge_base)
+    except (subprocess.SubprocessError, OSError) as e:
+        stderr = getattr(e, 'stderr', None)
+        logger.warn(f'Failed to diff {platform}:{project} {base}..{head} from mirror, falling back to the REST API: '
+                    f'{e} {stderr.decode("utf-8", errors="replace")[:500] if stderr else ""}')
+        return None
+    logger.info(f'Computed {len(changes)} file changes of {platform}:{project} {base}..{head} from local mirror.')
+    return changes
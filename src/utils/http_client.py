@@ -0,0 +1,191 @@
+import functools
+import os
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.utils.log import logger
+from src.utils import rate_limit, response_cache
+
+# 每个进程按 (scheme, host) 复用一个 Session；进程池子进程 fork 后重新创建，避免共用父进程的连接
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+def http_client_options() -> dict:
+    return {
+        'connect_timeout': float(os.getenv('SCM_HTTP_CONNECT_TIMEOUT', 5)),
+        'read_timeout': float(os.getenv('SCM_HTTP_READ_TIMEOUT', 60)),
+        # 每个代码托管平台保持的长连接数
+        'pool_size': int(os.getenv('SCM_HTTP_POOL_SIZE', 10)),
+        # GET 请求在连接失败、502 / 503 / 504 时的重试次数，POST 不重试，避免重复发布评论；
+        # 429 不在这里重试，由 rate_limit 记录 Retry-After 并延迟任务，不在 urllib3 中按 Retry-After 阻塞 worker
+        'max_retries': int(os.getenv('SCM_HTTP_MAX_RETRIES', 3)),
+        'backoff_factor': float(os.getenv('SCM_HTTP_RETRY_BACKOFF', 0.5)),
+    }
+
+
+class HostSession:
+    """单个代码托管平台的连接池，记录请求数用于计算连接复用情况"""
+
+    def __init__(self, host: str, options: dict):
+        self.host = host
+        self.session = requests.Session()
+        retry = Retry(
+            total=options['max_retries'],
+            connect=options['max_retries'],
+            read=options['max_retries'],
+            status=options['max_retries'],
+            backoff_factor=options['backoff_factor'],
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=options['pool_size'], max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.adapter = adapter
+        # 同一个 Session 会被并发拉取 diff 的多个线程共用
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        # 条件请求：304 由缓存返回（命中），其余视为未命中
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def connections(self) -> int:
+        """已建立的 TCP 连接数（含重连），来自 urllib3 连接池的计数"""
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            return sum(pool.num_connections for pool in pools._container.values())
+
+    def stats(self) -> dict:
+        connections = self.connections()
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'connections': connections,
+            'reused': max(self.requests - connections, 0),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+
+def get_session(url: str) -> HostSession:
+    global _sessions_pid
+    parsed = urlparse(url)
+    key = f'{parsed.scheme}://{parsed.netloc}'
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        host_session = _sessions.get(key)
+        if host_session is None:
+            host_session = _sessions[key] = HostSession(key, http_client_options())
+        return host_session
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    通过共享连接池发送请求，参数与 requests.request 相同；未指定 timeout 时使用 (连接超时, 读取超时) 的默认值。
+    发送前按 token 的剩余额度限速，额度用完或 GET 被平台限流（429）时可能抛出 RateLimited（见 src/utils/rate_limit.py）
+    """
+    options = http_client_options()
+    kwargs.setdefault('timeout', (options['connect_timeout'], options['read_timeout']))
+    budget = rate_limit.before_request(method, url, kwargs.get('headers'))
+    host_session = get_session(url)
+    with host_session.lock:
+        host_session.requests += 1
+    try:
+        response = host_session.session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        with host_session.lock:
+            host_session.errors += 1
+        raise
+    try:
+        rate_limit.after_response(method, budget, response)
+    except rate_limit.RateLimited:
+        response.close()
+        raise
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def conditional_get(url: str, **kwargs) -> requests.Response:
+    """
+    带缓存的 GET：响应带有 ETag / Last-Modified 时保存校验值和响应体（src/utils/response_cache.py），
+    之后的请求带上 If-None-Match / If-Modified-Since，平台返回 304 时直接用缓存的响应体构造 200 响应，
+    调用方的处理逻辑不变。用于 commits、受保护分支等重复获取且很少变化的接口；GitHub 的 304 不计入限流
+    """
+    if not response_cache.response_cache_options()['enabled']:
+        return get(url, **kwargs)
+    headers = dict(kwargs.pop('headers', None) or {})
+    cache_key = response_cache.response_cache_key(url, kwargs.get('params'), headers)
+    cached = response_cache.load_response(cache_key)
+    if cached is not None:
+        headers.update(response_cache.validator_headers(cached[0]))
+    response = get(url, headers=headers, **kwargs)
+
+    host_session = get_session(url)
+    if response.status_code == 304 and cached is not None:
+        with host_session.lock:
+            host_session.cache_hits += 1
+        response_cache.touch_response(cache_key)
+        return response_cache.build_cached_response(*cached, response)
+    with host_session.lock:
+        host_session.cache_misses += 1
+    if response.status_code == 200:
+        response_cache.save_response(cache_key, response)
+    return response
+
+
+def get_connection_stats() -> dict:
+    """当前进程内各代码托管平台的请求数、建立的连接数和复用次数"""
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            return {}
+        host_sessions = list(_sessions.values())
+    return {host_session.host: host_session.stats() for host_session in host_sessions}
+
+
+def log_connection_stats(before: dict):
+    """输出 before 之后新增的请求数与连接复用情况，用于确认每个 review 任务节省的握手次数"""
+    for host, stats in get_connection_stats().items():
+        previous = before.get(host, {})
+        requests_made = stats['requests'] - previous.get('requests', 0)
+        if requests_made <= 0:
+            continue
+        connections = stats['connections'] - previous.get('connections', 0)
+        cache_hits = stats['cache_hits'] - previous.get('cache_hits', 0)
+        cache_lookups = cache_hits + stats['cache_misses'] - previous.get('cache_misses', 0)
+        logger.info('SCM HTTP %s: %s requests, %s new connections, %s reused, %s errors, '
+                    'response cache %s/%s hits', host, requests_made, connections,
+                    max(requests_made - connections, 0), stats['errors'] - previous.get('errors', 0),
+                    cache_hits, cache_lookups)
+
+
+def track_connection_stats(function: callable) -> callable:
+    """装饰 review 任务函数，任务结束时输出本次任务的 API 请求数与连接复用情况，并写入限流计数"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        before = get_connection_stats()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            log_connection_stats(before)
+            rate_limit.flush_counters()
+
+    return wrapper
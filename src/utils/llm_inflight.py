@@ -0,0 +1,81 @@
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 超过该时间仍未结束的调用视为进程已崩溃，不再计入
+LLM_CALL_STALE_SECONDS = 1800
+
+
+class SqliteInFlightTracker(SqliteStore):
+    """记录正在进行的 LLM 调用，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS llm_calls (
+            call_id TEXT PRIMARY KEY,
+            started_at REAL NOT NULL
+        )
+    ''',)
+
+    def begin(self, call_id: str):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('DELETE FROM llm_calls WHERE started_at < ?', (now - LLM_CALL_STALE_SECONDS,))
+        conn.execute('INSERT INTO llm_calls (call_id, started_at) VALUES (?, ?)', (call_id, now))
+
+    def end(self, call_id: str):
+        self._connect().execute('DELETE FROM llm_calls WHERE call_id = ?', (call_id,))
+
+    def count(self) -> int:
+        return self._connect().execute('SELECT COUNT(*) FROM llm_calls WHERE started_at >= ?',
+                                       (time.time() - LLM_CALL_STALE_SECONDS,)).fetchone()[0]
+
+
+class RedisInFlightTracker(RedisStore):
+    """rq 驱动使用 Redis 有序集合记录正在进行的 LLM 调用，score 为开始时间"""
+
+    KEY = 'llm_calls_in_flight'
+
+    def begin(self, call_id: str):
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(self.KEY, 0, now - LLM_CALL_STALE_SECONDS)
+        pipe.zadd(self.KEY, {call_id: now})
+        pipe.execute()
+
+    def end(self, call_id: str):
+        self.redis.zrem(self.KEY, call_id)
+
+    def count(self) -> int:
+        return self.redis.zcount(self.KEY, time.time() - LLM_CALL_STALE_SECONDS, '+inf')
+
+
+get_inflight_tracker = driver_store(SqliteInFlightTracker, RedisInFlightTracker)
+
+
+@contextmanager
+def track_llm_call():
+    """
+    统计正在进行的 LLM 调用数，webhook 入口据此做准入控制；统计失败不影响 LLM 调用本身
+    """
+    call_id = f'{os.getpid()}:{uuid.uuid4().hex}'
+    try:
+        get_inflight_tracker().begin(call_id)
+    except Exception as e:
+        logger.warn(f'Failed to record LLM call: {e}')
+        call_id = None
+    try:
+        yield
+    finally:
+        if call_id:
+            try:
+                get_inflight_tracker().end(call_id)
+            except Exception as e:
+                logger.warn(f'Failed to record LLM call end: {e}')
+
+
+def count_llm_calls() -> int:
+    return get_inflight_tracker().count()
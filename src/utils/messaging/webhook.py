@@ -1,5 +1,7 @@
 import os
+from src.entity.review_event import RAW_PAYLOAD_ID_KEY
 from src.utils.log import logger
+from src.utils.payload_store import load_payload
 import requests
 
 
@@ -11,18 +13,22 @@ class ExtraWebhookNotifier:
         """
         self.default_webhook_url = webhook_url or os.environ.get('EXTRA_WEBHOOK_URL', '')
         self.enabled = os.environ.get('EXTRA_WEBHOOK_ENABLED', '0') == '1'
+        # 默认推送精简后的事件数据；开启后如果保存了原始 payload，则推送原始数据
+        self.full_payload = os.environ.get('EXTRA_WEBHOOK_FULL_PAYLOAD', '0') == '1'
 
     def send_message(self, system_data: dict, webhook_data: dict):
         """
         发送额外自定义webhook消息
         :param system_data: 系统消息内容
-        :param webhook_data: github、gitlab的push event、merge event的原始数据
+        :param webhook_data: github、gitlab的push event、merge event的数据（精简后的事件）
         """
         if not self.enabled:
             logger.info("ExtraWebhook推送未启用")
             return
 
         try:
+            if self.full_payload and webhook_data.get(RAW_PAYLOAD_ID_KEY):
+                webhook_data = load_payload(webhook_data[RAW_PAYLOAD_ID_KEY]) or webhook_data
             data = {
                 "ai_codereview_data": system_data,
                 "webhook_data": webhook_data
@@ -0,0 +1,44 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OnceCache:
+    """
+    单个任务内的请求结果缓存：同一个 key 只获取一次，多个线程同时请求同一个 key 时只有一个线程真正发起请求，
+    其余线程等待并复用结果（获取失败返回的 None 同样会被缓存）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._key_locks = {}
+
+    def get(self, key, fetch: callable):
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._values:
+                    return self._values[key]
+            value = fetch()
+            with self._lock:
+                self._values[key] = value
+            return value
+
+
+def map_ordered(function: callable, items: list, max_workers: int) -> list:
+    """
+    在线程池中并发执行 function(item)，按 items 的顺序返回结果，用于并发调用代码托管平台的 API。
+    max_workers <= 1 或只有一个元素时直接串行执行；function 抛出的异常会在取结果时原样抛出。
+    线程池不会继承调用方的 contextvars，每个元素在调用方上下文的副本中执行，
+    使限流和 diff 就绪的延迟重试（RescheduleJob）在线程中与串行执行时一致
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix='scm-fetch') as executor:
+        futures = [executor.submit(contextvars.copy_context().run, function, item) for item in items]
+        return [future.result() for future in futures]
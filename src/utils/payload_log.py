@@ -0,0 +1,102 @@
+import hmac
+import json
+import logging
+import os
+import random
+import reprlib
+import time
+from fnmatch import fnmatch
+from logging.handlers import RotatingFileHandler
+
+from src.utils.log import logger, log_backup_count, log_max_bytes
+
+# 请求头中携带与 PAYLOAD_CAPTURE_TOKEN 相同的值时，完整保存本次请求的 payload
+PAYLOAD_CAPTURE_HEADER = 'X-Payload-Capture'
+# 名称中包含这些关键字的请求头（令牌、签名、Cookie 等凭据，以及捕获口令）在日志中只输出 ***
+SENSITIVE_HEADER_KEYWORDS = ('authorization', 'token', 'signature', 'secret', 'cookie', PAYLOAD_CAPTURE_HEADER.lower())
+
+_capture_logger = None
+
+
+class BoundedRepr:
+    """
+    延迟格式化的日志参数：只在日志真正输出时才格式化，并限制嵌套层数、列表长度、字符串长度和总长度，
+    格式化开销与原始数据大小无关。使用方式：logger.info('changes: %s', BoundedRepr(changes))
+    """
+
+    def __init__(self, value, max_chars: int = None):
+        self.value = value
+        self.max_chars = max_chars or int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 2000))
+
+    def __str__(self):
+        limiter = reprlib.Repr()
+        limiter.maxlevel = 4
+        limiter.maxdict = limiter.maxlist = limiter.maxtuple = 20
+        limiter.maxstring = limiter.maxother = min(200, self.max_chars)
+        text = limiter.repr(self.value)
+        if len(text) > self.max_chars:
+            text = f'{text[:self.max_chars]}...({len(text)} chars)'
+        return text
+
+
+class HeadersRepr(BoundedRepr):
+    """请求头的延迟格式化日志参数：在 BoundedRepr 的基础上隐藏凭据类请求头的值，例如 logger.debug('headers: %s', HeadersRepr(request.headers))"""
+
+    def __str__(self):
+        headers = {
+            name: '***' if any(keyword in name.lower() for keyword in SENSITIVE_HEADER_KEYWORDS) else value
+            for name, value in self.value.items()
+        }
+        return str(BoundedRepr(headers, self.max_chars))
+
+
+def _get_capture_logger() -> logging.Logger:
+    global _capture_logger
+    if _capture_logger is None:
+        capture_file = os.getenv('PAYLOAD_CAPTURE_FILE', 'logs/payload_capture.log')
+        os.makedirs(os.path.dirname(capture_file) or '.', exist_ok=True)
+        handler = RotatingFileHandler(capture_file, maxBytes=log_max_bytes, backupCount=log_backup_count,
+                                      encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _capture_logger = logging.getLogger('payload_capture')
+        _capture_logger.setLevel(logging.INFO)
+        _capture_logger.propagate = False
+        _capture_logger.addHandler(handler)
+    return _capture_logger
+
+
+def _capture_requested(project: str, headers) -> bool:
+    patterns = [p.strip() for p in os.getenv('PAYLOAD_CAPTURE_PROJECTS', '').split(',') if p.strip()]
+    if project and any(fnmatch(project, pattern) for pattern in patterns):
+        return True
+    token = os.getenv('PAYLOAD_CAPTURE_TOKEN', '')
+    header_value = headers.get(PAYLOAD_CAPTURE_HEADER, '') if headers is not None else ''
+    return bool(token) and hmac.compare_digest(header_value, token)
+
+
+def log_webhook_payload(platform: str, event: str, data: dict, project: str = '', headers=None,
+                        content_length: int = None):
+    """
+    记录 webhook payload：每个请求只输出一行摘要；按 LOG_PAYLOAD_SAMPLE_RATE 抽样输出截断后的 payload；
+    项目匹配 PAYLOAD_CAPTURE_PROJECTS 或请求头携带捕获口令时，完整 payload 写入单独的 PAYLOAD_CAPTURE_FILE
+    """
+    logger.info('Received %s event: %s, project: %s, size: %s bytes', platform, event, project or '-',
+                content_length if content_length is not None else '-')
+    if _capture_requested(project, headers):
+        try:
+            _get_capture_logger().info(json.dumps({
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'platform': platform,
+                'event': event,
+                'project': project,
+                'payload': data,
+            }, ensure_ascii=False))
+            logger.info('Full %s payload captured for project %s', platform, project or '-')
+        except Exception as e:
+            logger.warn(f'Failed to capture webhook payload: {e}')
+        return
+    sample_rate = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+    if sample_rate > 0 and random.random() < sample_rate:
+        logger.info('Payload (sampled): %s', BoundedRepr(data))
+    else:
+        logger.debug('Payload: %s', BoundedRepr(data))
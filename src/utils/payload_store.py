@@ -0,0 +1,71 @@
+import gzip
+import json
+import os
+import time
+import uuid
+
+from src.utils.log import logger
+
+
+def payload_store_enabled() -> bool:
+    return os.getenv('RAW_PAYLOAD_STORE_ENABLED', '0') == '1'
+
+
+def _store_dir() -> str:
+    return os.getenv('RAW_PAYLOAD_STORE_DIR', 'data/payloads')
+
+
+def _payload_path(payload_id: str) -> str:
+    return os.path.join(_store_dir(), f'{payload_id}.json.gz')
+
+
+def _purge_expired():
+    retention_seconds = int(os.getenv('RAW_PAYLOAD_RETENTION_DAYS', 7)) * 86400
+    expire_before = time.time() - retention_seconds
+    for entry in os.scandir(_store_dir()):
+        if entry.name.endswith('.json.gz') and entry.stat().st_mtime < expire_before:
+            os.remove(entry.path)
+
+
+def save_payload(data: dict) -> str:
+    """
+    将原始 webhook payload 压缩保存为单独的文件，返回 payload ID；保存失败返回 None
+    """
+    payload_id = uuid.uuid4().hex
+    try:
+        os.makedirs(_store_dir(), exist_ok=True)
+        with gzip.open(_payload_path(payload_id), 'wt', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        # 以很低的频率顺带清理过期文件，避免单独的定时任务
+        if payload_id.endswith('00'):
+            _purge_expired()
+        return payload_id
+    except Exception as e:
+        logger.error(f'Failed to save raw webhook payload: {e}')
+        return None
+
+
+def load_payload(payload_id: str) -> dict:
+    """读取原始 webhook payload，不存在或已过期时返回 None"""
+    if not payload_id or not all(c in '0123456789abcdef' for c in payload_id):
+        return None
+    try:
+        with gzip.open(_payload_path(payload_id), 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f'Failed to load raw webhook payload {payload_id}: {e}')
+        return None
+
+
+def delete_payload(payload_id: str):
+    """任务未能入队时删除已保存的原始 payload"""
+    if not payload_id:
+        return
+    try:
+        os.remove(_payload_path(payload_id))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f'Failed to delete raw webhook payload {payload_id}: {e}')
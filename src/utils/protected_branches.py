@@ -0,0 +1,120 @@
+import fnmatch
+import functools
+import json
+import os
+import re
+import time
+from urllib.parse import urlparse
+
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+
+class BranchMatcher:
+    """把受保护分支的名称 / 通配符编译为一个正则，匹配结果与逐个调用 fnmatch.fnmatch 相同"""
+
+    def __init__(self, patterns: tuple):
+        self.patterns = patterns
+        self._regex = re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None
+
+    def matches(self, branch: str) -> bool:
+        return bool(self._regex and branch is not None and self._regex.match(os.path.normcase(branch)))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_branch_matcher(patterns: tuple) -> BranchMatcher:
+    return BranchMatcher(tuple(os.path.normcase(pattern) for pattern in patterns))
+
+
+class SqliteProtectedBranchStore(SqliteStore):
+    """缓存各项目的受保护分支列表，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS protected_branches (
+            cache_key TEXT PRIMARY KEY,
+            patterns TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''',)
+
+    def get(self, cache_key: str):
+        row = self._connect().execute('SELECT patterns FROM protected_branches WHERE cache_key = ? AND expires_at >= ?',
+                                      (cache_key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, cache_key: str, patterns: list, ttl_seconds: int):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('DELETE FROM protected_branches WHERE expires_at < ?', (now,))
+        conn.execute('INSERT OR REPLACE INTO protected_branches (cache_key, patterns, expires_at) VALUES (?, ?, ?)',
+                     (cache_key, json.dumps(patterns, ensure_ascii=False), now + ttl_seconds))
+
+    def delete(self, cache_key: str):
+        self._connect().execute('DELETE FROM protected_branches WHERE cache_key = ?', (cache_key,))
+
+
+class RedisProtectedBranchStore(RedisStore):
+    """rq 驱动使用 Redis 缓存受保护分支列表，API 进程与所有 rq worker 共享"""
+
+    KEY_PREFIX = 'protected_branches:'
+
+    def get(self, cache_key: str):
+        value = self.redis.get(self.KEY_PREFIX + cache_key)
+        return json.loads(value) if value else None
+
+    def set(self, cache_key: str, patterns: list, ttl_seconds: int):
+        self.redis.set(self.KEY_PREFIX + cache_key, json.dumps(patterns, ensure_ascii=False), ex=ttl_seconds)
+
+    def delete(self, cache_key: str):
+        self.redis.delete(self.KEY_PREFIX + cache_key)
+
+
+get_protected_branch_store = driver_store(SqliteProtectedBranchStore, RedisProtectedBranchStore)
+
+
+def protected_branches_ttl_seconds() -> int:
+    return int(os.getenv('PROTECTED_BRANCHES_CACHE_TTL_SECONDS', 600))
+
+
+def protected_branches_cache_key(platform: str, base_url: str, project) -> str:
+    """
+    缓存的 key：平台 + 实例地址 + 项目（GitLab 为 project_id，GitHub / Gitea 为 full_name）
+    """
+    return f'{platform}:{urlparse(base_url).netloc or base_url}:{project}'
+
+
+def get_protected_branch_matcher(cache_key: str, fetch: callable):
+    """
+    获取项目受保护分支的匹配器，缓存未命中时调用 fetch 从平台 API 获取并缓存 PROTECTED_BRANCHES_CACHE_TTL_SECONDS 秒；
+    缓存读写失败时直接请求平台 API
+    :param fetch: 返回受保护分支名称 / 通配符列表，请求失败时返回 None（不缓存）
+    :return: BranchMatcher，获取失败时返回 None
+    """
+    ttl_seconds = protected_branches_ttl_seconds()
+    patterns = None
+    if ttl_seconds > 0:
+        try:
+            patterns = get_protected_branch_store().get(cache_key)
+        except Exception as e:
+            logger.warn(f'Failed to read protected branches cache of {cache_key}: {e}')
+    if patterns is None:
+        patterns = fetch()
+        if patterns is None:
+            return None
+        if ttl_seconds > 0:
+            try:
+                get_protected_branch_store().set(cache_key, patterns, ttl_seconds)
+            except Exception as e:
+                logger.warn(f'Failed to save protected branches cache of {cache_key}: {e}')
+    else:
+        logger.debug(f'Protected branches of {cache_key} served from cache.')
+    return compile_branch_matcher(tuple(patterns))
+
+
+def invalidate_protected_branches(cache_key: str):
+    """受保护分支设置变更时清除缓存，下一个 MR/PR 会重新从平台 API 获取"""
+    try:
+        get_protected_branch_store().delete(cache_key)
+        logger.info(f'Protected branches cache of {cache_key} invalidated.')
+    except Exception as e:
+        logger.warn(f'Failed to invalidate protected branches cache of {cache_key}: {e}')
@@ -1,25 +1,575 @@
+import functools
 import os
-from multiprocessing import Process
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from redis import Redis
 from rq import Queue
 
+from src.utils.diff_readiness import RetryLater, get_readiness_stats, run_readiness_job
 from src.utils.log import logger
+from src.utils.rate_limit import get_rate_limit_stats
+from src.utils.review_supersede import get_generation_store, run_review_job
+from src.utils.sqlite_queue import SqliteJobQueue, function_ref
+from src.utils.store import redis_connection
+from src.utils.webhook_dedupe import claim_delivery, release_delivery
 
 queue_driver = os.getenv('QUEUE_DRIVER', 'async')
 
 if queue_driver == 'rq':
     queues = {}
 
+# 本应用使用的 rq 队列名，所有 API 进程共享，统计积压时只统计这些队列（同一个 Redis 中可能还有其他应用的队列）
+RQ_QUEUE_REGISTRY_KEY = 'ai_codereview:rq_queues'
+# 从 Redis 同步其他进程登记的队列名的间隔
+RQ_QUEUE_REGISTRY_SYNC_SECONDS = 60
 
-def handle_queue(function: callable, data: any, token: str, url: str, url_slug: str):
+_rq_registry_synced_at = 0
+_sqlite_queue = None
+
+# handle_queue 的返回值
+ENQUEUE_ACCEPTED = 'accepted'
+ENQUEUE_REJECTED = 'rejected'
+ENQUEUE_DUPLICATE = 'duplicate'
+
+# 任务优先级，数值越小越优先：目标为保护分支的 MR > 其他 MR > Push > 批量 / 回溯任务
+PRIORITY_MR_PROTECTED = 0
+PRIORITY_MR = 1
+PRIORITY_PUSH = 2
+PRIORITY_BATCH = 3
+PRIORITY_NAMES = {
+    PRIORITY_MR_PROTECTED: 'mr_protected',
+    PRIORITY_MR: 'mr',
+    PRIORITY_PUSH: 'push',
+    PRIORITY_BATCH: 'batch',
+}
+
+
+def _warm_up_worker():
+    """
+    进程池子进程的初始化函数：提前导入 worker 模块（各平台 handler、LLM 客户端等），
+    避免每个任务都重新导入一遍
+    """
+    import src.queue.worker  # noqa: F401
+
+
+def _noop():
+    return None
+
+
+def parse_project_weights(value: str) -> dict:
+    """
+    解析项目权重配置，例如 group/monorepo:1,group/core:3
+    """
+    weights = {}
+    for item in (value or '').split(','):
+        project, _, weight = item.strip().rpartition(':')
+        if project and weight.strip().isdigit():
+            weights[project.strip()] = max(1, int(weight))
+    return weights
+
+
+def fair_scheduling_options() -> dict:
+    """从环境变量读取调度配置，async 与 sqlite 驱动共用"""
+    return {
+        'project_weights': parse_project_weights(os.getenv('QUEUE_PROJECT_WEIGHTS', '')),
+        'max_per_project': int(os.getenv('QUEUE_PROJECT_MAX_CONCURRENCY', 0)),
+        'max_per_host': int(os.getenv('QUEUE_HOST_MAX_CONCURRENCY', 0)),
+        'aging_seconds': int(os.getenv('QUEUE_PRIORITY_AGING_SECONDS', 300)),
+    }
+
+
+def effective_priority(priority: int, waited_seconds: float, aging_seconds: int) -> int:
+    """老化：每等待 aging_seconds 秒提升一个优先级，低优先级任务的等待时间因此有上限"""
+    if aging_seconds <= 0:
+        return priority
+    return max(PRIORITY_MR_PROTECTED, priority - int(waited_seconds // aging_seconds))
+
+
+class QueuedJob:
+    __slots__ = ('function', 'args', 'review_key', 'host', 'project', 'priority', 'enqueued_at')
+
+    def __init__(self, function: callable, args: tuple, review_key: str, host: str, project: str,
+                 priority: int = PRIORITY_PUSH):
+        self.function = function
+        self.args = args
+        self.review_key = review_key
+        self.host = host
+        self.project = project
+        self.priority = priority
+        self.enqueued_at = time.time()
+
+
+class FairScheduler:
+    """
+    按优先级和项目调度积压任务：
+    - 每个优先级一条通道，总是先执行优先级高的通道，通道中最早的任务每等待 aging_seconds 秒提升一级（老化），
+      提升后与高优先级通道同级时按排队时间先后执行；
+    - 同一通道内每个项目一个 FIFO 队列，轮到某个项目时最多连续取出 weight 个任务，然后轮到下一个项目；
+    - 项目或平台（host）正在执行的任务数达到上限时跳过，等有任务完成后再调度；
+    - 记录每个项目、每个优先级的排队等待时间，用于观察调度是否公平。
+    不是线程安全的，由调用方加锁。
+    """
+
+    def __init__(self, project_weights: dict = None, max_per_project: int = 0, max_per_host: int = 0,
+                 aging_seconds: int = 0):
+        self.project_weights = project_weights or {}
+        self.max_per_project = max(0, max_per_project)
+        self.max_per_host = max(0, max_per_host)
+        self.aging_seconds = max(0, aging_seconds)
+        # priority -> OrderedDict((host, project) -> deque)，按轮询顺序排列
+        self._lanes = {}
+        self._credits = {}
+        self._running_projects = Counter()
+        self._running_hosts = Counter()
+        self._metrics = {}
+        self._lane_metrics = {}
+
+    def __len__(self):
+        return sum(len(jobs) for lane in self._lanes.values() for jobs in lane.values())
+
+    def weight(self, project: str) -> int:
+        return self.project_weights.get(project, 1)
+
+    def push(self, job: QueuedJob):
+        lane = self._lanes.setdefault(job.priority, OrderedDict())
+        key = (job.host, job.project)
+        if key not in lane:
+            lane[key] = deque()
+            self._credits[(job.priority, key)] = self.weight(job.project)
+        lane[key].append(job)
+
+    def push_front(self, job: QueuedJob):
+        self.push(job)
+        self._lanes[job.priority][(job.host, job.project)].rotate(1)
+
+    def count_review(self, review_key: str) -> int:
+        """同一 MR/PR 尚未执行的任务数"""
+        return sum(job.review_key == review_key for lane in self._lanes.values() for jobs in lane.values()
+                   for job in jobs)
+
+    def remove_review(self, review_key: str) -> int:
+        """移除同一 MR/PR 尚未执行的任务，返回移除数量"""
+        removed = 0
+        for priority, lane in list(self._lanes.items()):
+            for key in list(lane):
+                jobs = lane[key]
+                kept = deque(job for job in jobs if job.review_key != review_key)
+                removed += len(jobs) - len(kept)
+                if kept:
+                    lane[key] = kept
+                else:
+                    self._drop_project(priority, key)
+        return removed
+
+    def _drop_project(self, priority: int, key):
+        lane = self._lanes[priority]
+        del lane[key]
+        del self._credits[(priority, key)]
+        if not lane:
+            del self._lanes[priority]
+
+    def runnable(self, host: str, project: str) -> bool:
+        """项目和平台正在执行的任务数都未达到上限"""
+        if self.max_per_project and self._running_projects[(host, project)] >= self.max_per_project:
+            return False
+        if self.max_per_host and self._running_hosts[host] >= self.max_per_host:
+            return False
+        return True
+
+    def _lane_order(self, now: float) -> list:
+        order = []
+        for priority, lane in self._lanes.items():
+            oldest = min(jobs[0].enqueued_at for jobs in lane.values())
+            order.append((effective_priority(priority, now - oldest, self.aging_seconds), oldest, priority))
+        return [(priority, effective < priority) for effective, _, priority in sorted(order)]
+
+    def pop(self) -> QueuedJob:
+        """取出下一个可执行的任务，所有项目都达到并发上限时返回 None"""
+        for priority, promoted in self._lane_order(time.time()):
+            lane = self._lanes[priority]
+            keys = list(lane)
+            if promoted:
+                # 因老化被提升的通道先执行等待最久的任务，而不是让同通道的新任务一起插队
+                keys.sort(key=lambda k: lane[k][0].enqueued_at)
+            for key in keys:
+                if not self.runnable(*key):
+                    continue
+                jobs = lane[key]
+                job = jobs.popleft()
+                self._credits[(priority, key)] -= 1
+                if not jobs:
+                    self._drop_project(priority, key)
+                elif self._credits[(priority, key)] <= 0:
+                    # 本轮额度用完，排到队尾
+                    self._credits[(priority, key)] = self.weight(key[1])
+                    lane.move_to_end(key)
+                self._running_projects[key] += 1
+                self._running_hosts[job.host] += 1
+                self._record_wait(job)
+                return job
+        return None
+
+    def release(self, job: QueuedJob):
+        key = (job.host, job.project)
+        self._running_projects[key] -= 1
+        if self._running_projects[key] <= 0:
+            del self._running_projects[key]
+        self._running_hosts[job.host] -= 1
+        if self._running_hosts[job.host] <= 0:
+            del self._running_hosts[job.host]
+
+    def _record_wait(self, job: QueuedJob):
+        wait = time.time() - job.enqueued_at
+        for metrics in (self._metrics.setdefault((job.host, job.project), {}),
+                        self._lane_metrics.setdefault(job.priority, {})):
+            metrics['dispatched'] = metrics.get('dispatched', 0) + 1
+            metrics['total_wait'] = metrics.get('total_wait', 0.0) + wait
+            metrics['max_wait'] = max(metrics.get('max_wait', 0.0), wait)
+
+    @staticmethod
+    def _wait_stats(metrics: dict, jobs: list, now: float) -> dict:
+        dispatched = metrics.get('dispatched', 0)
+        return {
+            'queued': len(jobs),
+            'dispatched': dispatched,
+            'avg_wait_seconds': round(metrics['total_wait'] / dispatched, 2) if dispatched else 0,
+            'max_wait_seconds': round(metrics.get('max_wait', 0.0), 2),
+            'oldest_queued_seconds': round(now - min(job.enqueued_at for job in jobs), 2) if jobs else 0,
+        }
+
+    def project_stats(self) -> dict:
+        now = time.time()
+        queued = {}
+        for lane in self._lanes.values():
+            for key, jobs in lane.items():
+                queued.setdefault(key, []).extend(jobs)
+        stats = {}
+        for key in set(self._metrics) | set(queued) | set(self._running_projects):
+            host, project = key
+            stats[f'{host}/{project}' if project else host] = {
+                'weight': self.weight(project),
+                'running': self._running_projects.get(key, 0),
+                **self._wait_stats(self._metrics.get(key, {}), queued.get(key, []), now),
+            }
+        return stats
+
+    def priority_stats(self) -> dict:
+        now = time.time()
+        stats = {}
+        for priority in sorted(set(self._lane_metrics) | set(self._lanes)):
+            jobs = [job for jobs in self._lanes.get(priority, {}).values() for job in jobs]
+            stats[PRIORITY_NAMES.get(priority, str(priority))] = self._wait_stats(
+                self._lane_metrics.get(priority, {}), jobs, now)
+        return stats
+
+
+class AsyncWorkerPool:
+    """
+    async 驱动使用的常驻进程池：
+    - 子进程数量固定（ASYNC_WORKER_POOL_SIZE），启动时预热；
+    - 同一时间最多 pool_size 个任务交给进程池执行，其余任务在父进程的积压队列中等待，
+      积压队列由 FairScheduler 按优先级和项目加权轮询调度；
+    - 积压队列已满（ASYNC_QUEUE_MAX_SIZE）时拒绝新任务，由调用方决定如何响应；
+    - 同一个 MR/PR（review_key）的新任务入队时，积压队列中尚未执行的旧任务会被直接移除。
+    """
+
+    def __init__(self, pool_size: int, max_backlog: int, scheduler: FairScheduler = None):
+        self.pool_size = max(1, pool_size)
+        self.max_backlog = max(0, max_backlog)
+        # 任务完成回调可能在持有锁的线程中同步触发，所以使用可重入锁
+        self._lock = threading.RLock()
+        self._executor = None
+        self._scheduler = scheduler or FairScheduler()
+        self._in_flight = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._superseded = 0
+        self._rescheduled = 0
+
+    def start(self):
+        with self._lock:
+            self._ensure_executor()
+
+    def _ensure_executor(self):
+        if self._executor is not None:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.pool_size, initializer=_warm_up_worker)
+        # 预热：提前拉起所有子进程并完成模块导入，避免第一批 webhook 承担启动开销
+        for _ in range(self.pool_size):
+            self._executor.submit(_noop)
+        logger.info(f'Async worker pool started, pool_size={self.pool_size}, max_backlog={self.max_backlog}')
+
+    def _reset_executor(self):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, function: callable, *args, review_key: str = None, host: str = '', project: str = '',
+               priority: int = PRIORITY_PUSH, prepare: callable = None) -> str:
+        """
+        :param prepare: 确定接受任务后调用 prepare(function, args)，返回实际执行的 (function, args)；
+                        被拒绝的任务不会调用，用于在接受之后才登记 MR/PR 的新代次
+        """
+        with self._lock:
+            if not self._has_room(host, project, review_key):
+                self._rejected += 1
+                logger.warning(f'Async queue is full (backlog={len(self._scheduler)}, in_flight={self._in_flight}), '
+                               f'rejected job {function.__name__}')
+                return ENQUEUE_REJECTED
+            if prepare is not None:
+                function, args = prepare(function, args)
+            # 确定接受后才移除同一 MR/PR 的旧任务，被拒绝的新任务不能让旧任务也被丢弃
+            if review_key:
+                self._superseded += self._scheduler.remove_review(review_key)
+            self._scheduler.push(QueuedJob(function, args, review_key, host, project, priority))
+            self._dispatch()
+        return ENQUEUE_ACCEPTED
+
+    def _has_room(self, host: str, project: str, review_key: str) -> bool:
+        """
+        能立即执行的任务不占用积压额度（分发之后积压队列中只剩无法执行的任务，有空闲子进程时新任务能否执行只取决于
+        项目和平台的并发上限）；否则积压（不含将被替代的同一 MR/PR 任务）未达到上限时接受
+        """
+        if self._in_flight < self.pool_size and self._scheduler.runnable(host, project):
+            return True
+        backlog = len(self._scheduler) - (self._scheduler.count_review(review_key) if review_key else 0)
+        return backlog < self.max_backlog
+
+    def _submit_to_executor(self, job: QueuedJob):
+        self._ensure_executor()
+        try:
+            return self._executor.submit(job.function, *job.args)
+        except BrokenProcessPool:
+            # 子进程异常退出会导致整个进程池不可用，重建后重试一次
+            logger.error('Async worker pool is broken, recreating it.')
+            self._reset_executor()
+            self._ensure_executor()
+            return self._executor.submit(job.function, *job.args)
+
+    def _dispatch(self):
+        while self._in_flight < self.pool_size:
+            job = self._scheduler.pop()
+            if job is None:
+                return
+            try:
+                future = self._submit_to_executor(job)
+            except RuntimeError:
+                # 解释器退出时进程池已关闭，任务放回积压队列，不再分发
+                self._scheduler.release(job)
+                self._scheduler.push_front(job)
+                return
+            self._in_flight += 1
+            self._submitted += 1
+            future.add_done_callback(functools.partial(self._on_done, job))
+
+    def _on_done(self, job: QueuedJob, future):
+        with self._lock:
+            self._in_flight -= 1
+            self._scheduler.release(job)
+            error = future.exception()
+            if error is None and isinstance(future.result(), RetryLater):
+                self._retry_later(job, future.result())
+            elif error is None:
+                self._completed += 1
+            else:
+                self._failed += 1
+                logger.error(f'Async job failed: {error!r}')
+                if isinstance(error, BrokenProcessPool):
+                    self._reset_executor()
+            self._dispatch()
+
+    def _retry_later(self, job: QueuedJob, retry: RetryLater):
+        """diff 尚未就绪的任务在父进程中计时，到时间后重新放入积压队列，等待期间不占用子进程"""
+        self._rescheduled += 1
+        retry_job = QueuedJob(job.function, retry.args, job.review_key, job.host, job.project, job.priority)
+        timer = threading.Timer(retry.delay, self._requeue, args=(retry_job,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, job: QueuedJob):
+        with self._lock:
+            # 不经过 submit：重试的任务不应替代期间新入队的同一 MR/PR 任务，是否已被替代由 run_review_job 判断
+            job.enqueued_at = time.time()
+            self._scheduler.push(job)
+            self._dispatch()
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._scheduler)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'driver': 'async',
+                'pool_size': self.pool_size,
+                'max_backlog': self.max_backlog,
+                'queue_depth': len(self._scheduler),
+                'in_flight': self._in_flight,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'superseded': self._superseded,
+                'rescheduled': self._rescheduled,
+                'priorities': self._scheduler.priority_stats(),
+                'projects': self._scheduler.project_stats(),
+            }
+
+
+_async_pool = None
+_async_pool_lock = threading.Lock()
+
+
+def get_async_pool() -> AsyncWorkerPool:
+    global _async_pool
+    with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = AsyncWorkerPool(
+                pool_size=int(os.getenv('ASYNC_WORKER_POOL_SIZE', 4)),
+                max_backlog=int(os.getenv('ASYNC_QUEUE_MAX_SIZE', 100)),
+                scheduler=FairScheduler(**fair_scheduling_options()),
+            )
+        return _async_pool
+
+
+def get_sqlite_queue() -> SqliteJobQueue:
+    global _sqlite_queue
+    if _sqlite_queue is None:
+        _sqlite_queue = SqliteJobQueue(**fair_scheduling_options())
+    return _sqlite_queue
+
+
+def init_queue():
+    """
+    服务启动时调用：async 驱动下预先拉起进程池，sqlite 驱动下初始化队列文件
+    """
+    if queue_driver == 'sqlite':
+        get_sqlite_queue()
+    elif queue_driver != 'rq':
+        get_async_pool().start()
+
+
+def rq_queue_name(url_slug: str, priority: int) -> str:
+    """
+    rq 驱动每个优先级一个队列，Push 任务沿用原来的队列名 url_slug。
+    worker 需要按优先级从高到低监听：rq worker {slug}_mr_protected {slug}_mr {slug} {slug}_batch
+    """
+    if priority == PRIORITY_PUSH:
+        return url_slug
+    return f'{url_slug}_{PRIORITY_NAMES.get(priority, "batch")}'
+
+
+def _get_rq_queue(queue_name: str) -> Queue:
+    if queue_name not in queues:
+        redis_connection().sadd(RQ_QUEUE_REGISTRY_KEY, queue_name)
+        queues[queue_name] = Queue(queue_name, connection=redis_connection())
+    return queues[queue_name]
+
+
+def _rq_app_queues() -> dict:
+    """本应用的 rq 队列：当前进程入队过的队列，以及其他 API 进程（或重启前）登记的队列"""
+    global _rq_registry_synced_at
+    if time.time() - _rq_registry_synced_at >= RQ_QUEUE_REGISTRY_SYNC_SECONDS:
+        for name in redis_connection().smembers(RQ_QUEUE_REGISTRY_KEY):
+            name = name.decode('utf-8')
+            queues.setdefault(name, Queue(name, connection=redis_connection()))
+        _rq_registry_synced_at = time.time()
+    return queues
+
+
+def handle_queue(function: callable, data: any, token: str, url: str, url_slug: str, review_key: str = None,
+                 project: str = '', priority: int = PRIORITY_PUSH, delivery_key: str = None) -> str:
+    """
+    :param review_key: MR/PR 的唯一标识，传入后同一 MR/PR 的旧任务会被新任务替代：
+                       尚未执行的旧任务直接丢弃，执行中的旧任务在调用 LLM 和发布评论前退出
+    :param project: 项目标识（例如 group/repo），async、sqlite 驱动按项目公平调度并限制并发
+    :param priority: 任务优先级（PRIORITY_*），高优先级任务总是先执行，低优先级任务按等待时间逐步提升优先级
+    :param delivery_key: webhook 投递的唯一标识，去重窗口内重复投递的任务不再入队，返回 ENQUEUE_DUPLICATE
+    """
+    # 先去重再登记代次，否则重复投递会把原任务当作旧任务替代掉
+    if not claim_delivery(delivery_key):
+        logger.info(f'Duplicate webhook delivery {delivery_key}, ignored.')
+        return ENQUEUE_DUPLICATE
+
+    try:
+        status = _enqueue(function, data, token, url, url_slug, review_key, project, priority)
+    except Exception:
+        release_delivery(delivery_key)
+        raise
+    # 因队列已满被拒绝时撤销登记，平台重试时可以正常入队
+    if status == ENQUEUE_REJECTED:
+        release_delivery(delivery_key)
+    return status
+
+
+def _wrap_job(function: callable, args: tuple, review_key: str = None):
+    """
+    包装实际入队的任务：登记 MR/PR 的新代次（同一 MR/PR 执行中的旧任务会在调用 LLM 和发布评论前退出），
+    并让任务可以通过队列延迟重试。只能在确定接受任务之后调用
+    """
+    if review_key:
+        generation = get_generation_store().bump(review_key)
+        function, args = run_review_job, (function_ref(function), review_key, generation) + args
+    # MR/PR 的 diff 可能尚未生成、代码托管平台可能限流，任务可以通过队列延迟重试（见 src/utils/diff_readiness.py）
+    return run_readiness_job, (function_ref(function), 0, time.time()) + args
+
+
+def _enqueue(function: callable, data: any, token: str, url: str, url_slug: str, review_key: str, project: str,
+             priority: int) -> str:
+    args = (data, token, url, url_slug)
     if queue_driver == 'rq':
-        if url_slug not in queues:
-            logger.info(f'REDIS_HOST: {os.getenv("REDIS_HOST", "127.0.0.1")}，REDIS_PORT: {os.getenv("REDIS_PORT", 6379)}')
-            queues[url_slug] = Queue(url_slug, connection=Redis(os.getenv('REDIS_HOST', '127.0.0.1'),
-                                                                              os.getenv('REDIS_PORT', 6379)))
+        function, args = _wrap_job(function, args, review_key)
+        _get_rq_queue(rq_queue_name(url_slug, priority)).enqueue(function, *args)
+        return ENQUEUE_ACCEPTED
+    elif queue_driver == 'sqlite':
+        # 任务由独立的 worker 进程（python -m src.queue.sqlite_worker）消费
+        function, args = _wrap_job(function, args, review_key)
+        get_sqlite_queue().enqueue(function, args, queue_name=url_slug, review_key=review_key, project=project,
+                                   priority=priority)
+        return ENQUEUE_ACCEPTED
+    else:
+        # 积压队列已满时拒绝，被拒绝的任务不登记代次，同一 MR/PR 正在执行或排队的旧任务照常完成
+        return get_async_pool().submit(function, *args, review_key=review_key, host=url_slug, project=project,
+                                       priority=priority, prepare=functools.partial(_wrap_job, review_key=review_key))
+
 
-        queues[url_slug].enqueue(function, data, token, url, url_slug)
+def get_queue_depth() -> int:
+    """
+    返回等待执行的任务总数，供 webhook 入口做准入控制，比 get_queue_stats 开销小
+    """
+    if queue_driver == 'rq':
+        # 一次 pipeline 读取本应用各优先级队列的长度，不统计同一个 Redis 中其他应用的队列
+        pipe = redis_connection().pipeline(transaction=False)
+        for queue in _rq_app_queues().values():
+            pipe.llen(queue.key)
+        return sum(pipe.execute())
+    if queue_driver == 'sqlite':
+        return get_sqlite_queue().depth()
+    return get_async_pool().depth()
+
+
+def get_queue_stats() -> dict:
+    """
+    返回当前队列状态（积压深度、执行中任务数、拒绝次数等）
+    """
+    if queue_driver == 'rq':
+        counts = {name: queue.count for name, queue in _rq_app_queues().items()}
+        stats = {
+            'driver': 'rq',
+            'queues': counts,
+            'queue_depth': sum(counts.values()),
+        }
+    elif queue_driver == 'sqlite':
+        stats = get_sqlite_queue().stats()
+        stats['priorities'] = {PRIORITY_NAMES.get(priority, str(priority)): value
+                               for priority, value in stats['priorities'].items()}
     else:
-        process = Process(target=function, args=(data, token, url, url_slug))
-        process.start()
+        stats = get_async_pool().stats()
+    stats['diff_readiness'] = get_readiness_stats()
+    stats['rate_limits'] = get_rate_limit_stats()
+    return stats
@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from requests.structures import CaseInsensitiveDict
+
+from src.utils.diff_readiness import RescheduleJob, in_reschedulable_job
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 携带 token 的请求头，同一个 token 共用一份限流额度
+_TOKEN_HEADERS = ('Authorization', 'Private-Token')
+# GitHub / Gitea / Bitbucket 使用 X-RateLimit-*，GitLab 使用 RateLimit-*
+_HEADER_PREFIXES = ('X-RateLimit-', 'RateLimit-')
+
+
+def rate_limit_options() -> dict:
+    return {
+        'enabled': os.getenv('SCM_RATE_LIMIT_ENABLED', '1') == '1',
+        # 剩余额度低于总额度的该比例时开始限速：把剩余额度平均分配到重置前的时间内
+        'pace_below': float(os.getenv('SCM_RATE_LIMIT_PACE_BELOW', 0.1)),
+        # 不超过该时间的等待直接在当前进程中 sleep，更长的等待让任务通过队列延迟到额度重置后再执行
+        'inline_max_wait': float(os.getenv('SCM_RATE_LIMIT_INLINE_MAX_SECONDS', 5)),
+        # 等待时间超过该值时不再延迟任务，直接发出请求（由平台返回限流错误）
+        'max_park': float(os.getenv('SCM_RATE_LIMIT_MAX_PARK_SECONDS', 3600)),
+    }
+
+
+class RateLimited(RescheduleJob):
+    """token 的额度已用完，任务需要等待 delay 秒（额度重置）后通过队列重新执行，不计入 diff 就绪的重试次数"""
+
+    def __init__(self, budget: str, delay: float):
+        super().__init__(f'SCM rate limit of {budget} exhausted, retry in {delay:.2f}s', delay)
+        self.budget = budget
+
+
+def budget_key(url: str, headers) -> str:
+    """限流额度的 key：平台实例 + token 的摘要（不保存 token 本身）"""
+    headers = CaseInsensitiveDict(headers or {})
+    token = '\n'.join(headers.get(name, '') for name in _TOKEN_HEADERS)
+    fingerprint = hashlib.sha256(token.encode('utf-8')).hexdigest()[:12] if token.strip() else 'anonymous'
+    return f'{urlparse(url).netloc}:{fingerprint}'
+
+
+def _retry_after_seconds(value: str, now: float):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit(headers, status_code: int, now: float = None):
+    """
+    从响应头解析限流状态：limit / remaining / reset_at（额度重置的时间戳），
+    429 或带 Retry-After 的 403 记录 blocked_until；没有任何限流信息时返回 None
+    """
+    now = now or time.time()
+    state = {}
+    for prefix in _HEADER_PREFIXES:
+        remaining = headers.get(f'{prefix}Remaining')
+        if remaining is None:
+            continue
+        try:
+            state['remaining'] = int(float(remaining))
+            state['limit'] = int(float(headers.get(f'{prefix}Limit') or 0)) or None
+            reset = float(headers.get(f'{prefix}Reset') or 0)
+        except ValueError:
+            state = {}
+            continue
+        if reset:
+            # 大多数平台返回时间戳，个别返回距离重置的秒数
+            state['reset_at'] = reset if reset > 1e9 else now + reset
+        break
+
+    retry_after = _retry_after_seconds(headers.get('Retry-After'), now)
+    if status_code in (403, 429) and retry_after is not None:
+        state['blocked_until'] = now + retry_after
+    elif status_code in (403, 429) and state.get('remaining') == 0 and state.get('reset_at'):
+        state['blocked_until'] = state['reset_at']
+    if not state:
+        return None
+    state['updated_at'] = now
+    return state
+
+
+def wait_seconds(state: dict, options: dict, now: float = None) -> float:
+    """根据已知的限流状态计算下一个请求前需要等待的时间"""
+    now = now or time.time()
+    if not state:
+        return 0
+    if state.get('blocked_until', 0) > now:
+        return state['blocked_until'] - now
+    reset_at, remaining, limit = state.get('reset_at'), state.get('remaining'), state.get('limit')
+    if reset_at is None or remaining is None or reset_at <= now:
+        return 0
+    if remaining <= 0:
+        return reset_at - now
+    if limit and remaining < limit * options['pace_below']:
+        return (reset_at - now) / remaining
+    return 0
+
+
+class SqliteRateLimitStore(SqliteStore):
+    """async / sqlite 驱动使用本地 SQLite 记录各 token 的限流状态和计数，所有 worker 进程共享（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = (
+        '''
+        CREATE TABLE IF NOT EXISTS scm_rate_limits (
+            budget_key TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scm_rate_limit_counters (
+            budget_key TEXT NOT NULL,
+            field TEXT NOT NULL,
+            value REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (budget_key, field)
+        )
+        ''',
+    )
+
+    def get(self, key: str):
+        row = self._connect().execute('SELECT state FROM scm_rate_limits WHERE budget_key = ? AND expires_at >= ?',
+                                      (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, state: dict, ttl_seconds: float):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('DELETE FROM scm_rate_limits WHERE expires_at < ?', (now,))
+        conn.execute('INSERT OR REPLACE INTO scm_rate_limits (budget_key, state, expires_at) VALUES (?, ?, ?)',
+                     (key, json.dumps(state), now + ttl_seconds))
+
+    def all(self) -> dict:
+        rows = self._connect().execute('SELECT budget_key, state FROM scm_rate_limits WHERE expires_at >= ?',
+                                       (time.time(),))
+        return {key: json.loads(state) for key, state in rows}
+
+    def add_counters(self, counters: dict):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM scm_rate_limit_counters WHERE updated_at < ?', (now - COUNTER_TTL_SECONDS,))
+            conn.executemany('''
+                INSERT INTO scm_rate_limit_counters (budget_key, field, value, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(budget_key, field) DO UPDATE SET
+                    value = value + excluded.value, updated_at = excluded.updated_at
+            ''', [(key, field, value, now) for key, fields in counters.items() for field, value in fields.items()])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def counters(self) -> dict:
+        counters = {}
+        rows = self._connect().execute('SELECT budget_key, field, value FROM scm_rate_limit_counters')
+        for key, field, value in rows:
+            counters.setdefault(key, {})[field] = value
+        return counters
+
+
+class RedisRateLimitStore(RedisStore):
+    """rq 驱动使用 Redis 记录各 token 的限流状态和计数，所有 rq worker 共享"""
+
+    KEY_PREFIX = 'scm_rate_limit:'
+    COUNTERS_PREFIX = 'scm_rate_limit_counters:'
+
+    def get(self, key: str):
+        value = self.redis.get(self.KEY_PREFIX + key)
+        return json.loads(value) if value else None
+
+    def set(self, key: str, state: dict, ttl_seconds: float):
+        self.redis.set(self.KEY_PREFIX + key, json.dumps(state), ex=max(int(ttl_seconds), 1))
+
+    def all(self) -> dict:
+        states = {}
+        for redis_key in self.redis.scan_iter(f'{self.KEY_PREFIX}*'):
+            value = self.redis.get(redis_key)
+            if value:
+                states[redis_key.decode('utf-8')[len(self.KEY_PREFIX):]] = json.loads(value)
+        return states
+
+    def add_counters(self, counters: dict):
+        pipe = self.redis.pipeline(transaction=False)
+        for key, fields in counters.items():
+            for field, value in fields.items():
+                pipe.hincrbyfloat(self.COUNTERS_PREFIX + key, field, value)
+            pipe.expire(self.COUNTERS_PREFIX + key, COUNTER_TTL_SECONDS)
+        pipe.execute()
+
+    def counters(self) -> dict:
+        counters = {}
+        for redis_key in self.redis.scan_iter(f'{self.COUNTERS_PREFIX}*'):
+            counters[redis_key.decode('utf-8')[len(self.COUNTERS_PREFIX):]] = {
+                field.decode('utf-8'): float(value) for field, value in self.redis.hgetall(redis_key).items()}
+        return counters
+
+
+# 额度充足时，进程内的限流状态在这段时间内直接使用，不读写共享存储：响应头中的剩余额度来自平台，
+# 本身就反映了所有 worker 的用量；接近限速或已被限流时每次请求都与共享存储同步
+STATE_SYNC_SECONDS = 5
+# 计数在进程内累加，最多每隔这段时间（以及每个任务结束时）批量写入共享存储一次
+COUNTER_FLUSH_SECONDS = 10
+# 超过该时间没有更新的 token 计数会被清理
+COUNTER_TTL_SECONDS = 7 * 24 * 3600
+COUNTER_FIELDS = ('requests', 'paced', 'paced_seconds', 'parked')
+
+# 进程内的限流状态：{key: (state, 最近一次与共享存储同步的时间)}
+_states = {}
+_states_lock = threading.Lock()
+# 尚未写入共享存储的计数：{key: {field: value}}
+_counters = {}
+_counters_lock = threading.Lock()
+_counters_flushed_at = time.time()
+# 进程池 fork 出的子进程不能再写一遍父进程尚未写入的计数
+os.register_at_fork(after_in_child=_counters.clear)
+
+
+get_rate_limit_store = driver_store(SqliteRateLimitStore, RedisRateLimitStore)
+
+
+def _count(key: str, field: str, value: float = 1):
+    with _counters_lock:
+        counters = _counters.setdefault(key, {})
+        counters[field] = counters.get(field, 0) + value
+        due = time.time() - _counters_flushed_at >= COUNTER_FLUSH_SECONDS
+    if due:
+        flush_counters()
+
+
+def flush_counters():
+    """把进程内累加的计数写入共享存储，API 进程的统计接口因此能看到所有 worker 的计数"""
+    global _counters_flushed_at
+    with _counters_lock:
+        pending = {key: fields for key, fields in _counters.items() if fields}
+        _counters.clear()
+        _counters_flushed_at = time.time()
+    if not pending:
+        return
+    try:
+        get_rate_limit_store().add_counters(pending)
+    except Exception as e:
+        logger.warn(f'Failed to save SCM rate limit counters: {e}')
+        # 写入失败的计数留到下一次再写
+        with _counters_lock:
+            for key, fields in pending.items():
+                counters = _counters.setdefault(key, {})
+                for field, value in fields.items():
+                    counters[field] = counters.get(field, 0) + value
+
+
+def _constrained(state: dict, options: dict, now: float) -> bool:
+    """已被限流、需要限速或剩余额度接近限速阈值，此时不能使用进程内缓存的状态"""
+    if not state:
+        return False
+    if state.get('blocked_until', 0) > now or wait_seconds(state, options, now) > 0:
+        return True
+    remaining, limit = state.get('remaining'), state.get('limit')
+    return remaining is not None and limit is not None and remaining < limit * options['pace_below'] * 2
+
+
+def _load_state(key: str, options: dict, now: float):
+    with _states_lock:
+        state, synced_at = _states.get(key, (None, 0))
+    if now - synced_at < STATE_SYNC_SECONDS and not _constrained(state, options, now):
+        return state
+    state = get_rate_limit_store().get(key)
+    with _states_lock:
+        _states[key] = (state, now)
+    return state
+
+
+def before_request(method: str, url: str, headers) -> str:
+    """
+    发送请求前检查 token 的限流状态：额度即将用完时按剩余额度均匀限速；GET 请求需要等待较长时间时，
+    在可以延迟重试的任务中抛出 RateLimited，让任务在额度重置后重新执行，而不是继续请求导致任务失败。
+    POST（发布评论，通常在调用大模型之后）不延迟任务，避免重新执行整个 review
+    :return: 限流额度的 key，传给 after_response；未启用时返回 None
+    """
+    options = rate_limit_options()
+    if not options['enabled']:
+        return None
+    key = budget_key(url, headers)
+    _count(key, 'requests')
+    try:
+        state = _load_state(key, options, time.time())
+    except Exception as e:
+        logger.warn(f'Failed to read SCM rate limit state of {key}: {e}')
+        return key
+    delay = wait_seconds(state, options)
+    if delay <= 0:
+        return key
+    if method == 'GET' and options['inline_max_wait'] < delay <= options['max_park'] and in_reschedulable_job():
+        _count(key, 'parked')
+        raise RateLimited(key, delay)
+    delay = min(delay, options['inline_max_wait'])
+    logger.info(f'SCM rate limit of {key} nearly exhausted (remaining {state.get("remaining")}), '
+                f'waiting {delay:.2f}s before the next request.')
+    _count(key, 'paced')
+    _count(key, 'paced_seconds', delay)
+    time.sleep(delay)
+    return key
+
+
+def after_response(method: str, key: str, response):
+    """
+    根据响应头更新 token 的限流状态：额度充足时只更新进程内的状态，接近限速、已被限流或距离上次同步超过
+    STATE_SYNC_SECONDS 时保存到共享存储（保存到额度重置之后）。
+    GET 被平台限流（429 / 带 Retry-After 的 403）时，与 before_request 一样在可以延迟重试的任务中抛出 RateLimited
+    """
+    if key is None:
+        return
+    now = time.time()
+    state = parse_rate_limit(response.headers, response.status_code, now)
+    if state is None:
+        return
+    options = rate_limit_options()
+    with _states_lock:
+        synced_at = _states.get(key, (None, 0))[1]
+        sync = now - synced_at >= STATE_SYNC_SECONDS or _constrained(state, options, now)
+        _states[key] = (state, now if sync else synced_at)
+    if sync:
+        expires_at = max(state.get('reset_at') or 0, state.get('blocked_until') or 0, now + 60)
+        try:
+            get_rate_limit_store().set(key, state, expires_at - now + 60)
+        except Exception as e:
+            logger.warn(f'Failed to save SCM rate limit state of {key}: {e}')
+    if not state.get('blocked_until'):
+        return
+    delay = state['blocked_until'] - now
+    logger.warn(f'SCM rate limit of {key} hit ({response.status_code}), blocked for {delay:.0f}s.')
+    if method == 'GET' and 0 < delay <= options['max_park'] and in_reschedulable_job():
+        _count(key, 'parked')
+        raise RateLimited(key, delay)
+
+
+def _counter_value(field: str, value: float):
+    return round(value, 2) if field.endswith('_seconds') else int(value)
+
+
+def get_rate_limit_stats() -> dict:
+    """
+    各 token（实例 + token 摘要）最近一次同步的剩余额度、重置时间，以及所有进程累计的请求数、限速等待和延迟的任务数
+    （各进程最多每 COUNTER_FLUSH_SECONDS 秒以及每个任务结束时写入一次）
+    """
+    flush_counters()
+    store = get_rate_limit_store()
+    try:
+        states = store.all()
+    except Exception as e:
+        logger.warn(f'Failed to read SCM rate limit stats: {e}')
+        states = {}
+    try:
+        counters = store.counters()
+    except Exception as e:
+        logger.warn(f'Failed to read SCM rate limit counters: {e}')
+        counters = {}
+    now = time.time()
+    stats = {}
+    for key in sorted(set(states) | set(counters)):
+        state = states.get(key) or {}
+        stats[key] = {
+            'limit': state.get('limit'),
+            'remaining': state.get('remaining'),
+            'reset_in_seconds': round(max(state['reset_at'] - now, 0), 1) if state.get('reset_at') else None,
+            'blocked_for_seconds': round(max(state.get('blocked_until', 0) - now, 0), 1),
+            **{field: _counter_value(field, counters.get(key, {}).get(field, 0)) for field in COUNTER_FIELDS},
+        }
+    return stats
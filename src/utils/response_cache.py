@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import random
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 参与缓存 key 计算的请求头：不同 token 看到的数据可能不同，Accept 不同返回的格式不同
+_KEY_HEADERS = ('Authorization', 'Private-Token', 'Accept')
+# 不随缓存的响应体一起保存的响应头
+_SKIPPED_HEADERS = {'content-length', 'content-encoding', 'transfer-encoding', 'connection', 'set-cookie'}
+
+
+def response_cache_options() -> dict:
+    return {
+        'enabled': os.getenv('SCM_RESPONSE_CACHE_ENABLED', '1') == '1',
+        'db_file': os.getenv('SCM_RESPONSE_CACHE_DB', 'data/scm_response_cache.db'),
+        # 超过该大小的响应体不缓存
+        'max_body_bytes': int(os.getenv('SCM_RESPONSE_CACHE_MAX_BODY_BYTES', 2 * 1024 * 1024)),
+        # sqlite 存储保留的最大条目数（按最近使用时间淘汰）；Redis 存储的过期时间
+        'max_entries': int(os.getenv('SCM_RESPONSE_CACHE_MAX_ENTRIES', 5000)),
+        'ttl_seconds': int(os.getenv('SCM_RESPONSE_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+    }
+
+
+class SqliteResponseStore(SqliteStore):
+    """async / sqlite 驱动使用本地 SQLite 文件保存响应的校验值（ETag / Last-Modified）和响应体"""
+
+    SCHEMA = (
+        'PRAGMA journal_mode = WAL',
+        '''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            meta TEXT NOT NULL,
+            body BLOB NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_response_cache_accessed_at ON response_cache (accessed_at)',
+    )
+
+    def __init__(self, db_file: str, max_entries: int):
+        self.max_entries = max_entries
+        super().__init__(db_file)
+
+    def get(self, cache_key: str):
+        row = self._connect().execute('SELECT meta, body FROM response_cache WHERE cache_key = ?',
+                                      (cache_key,)).fetchone()
+        return (json.loads(row[0]), bytes(row[1])) if row else None
+
+    def set(self, cache_key: str, meta: dict, body: bytes):
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO response_cache (cache_key, meta, body, accessed_at) VALUES (?, ?, ?, ?)',
+                     (cache_key, json.dumps(meta, ensure_ascii=False), body, time.time()))
+        # 淘汰不需要每次写入都执行
+        if random.random() < 0.05:
+            conn.execute('''
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+
+    def touch(self, cache_key: str):
+        self._connect().execute('UPDATE response_cache SET accessed_at = ? WHERE cache_key = ?',
+                                (time.time(), cache_key))
+
+
+class RedisResponseStore(RedisStore):
+    """rq 驱动使用 Redis 保存响应的校验值和响应体，所有 rq worker 共享"""
+
+    KEY_PREFIX = 'scm_response:'
+
+    def __init__(self, ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        super().__init__()
+
+    def get(self, cache_key: str):
+        meta, body = self.redis.hmget(self.KEY_PREFIX + cache_key, 'meta', 'body')
+        return (json.loads(meta), body) if meta is not None and body is not None else None
+
+    def set(self, cache_key: str, meta: dict, body: bytes):
+        key = self.KEY_PREFIX + cache_key
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={'meta': json.dumps(meta, ensure_ascii=False), 'body': body})
+        pipe.expire(key, self.ttl_seconds)
+        pipe.execute()
+
+    def touch(self, cache_key: str):
+        self.redis.expire(self.KEY_PREFIX + cache_key, self.ttl_seconds)
+
+
+def _sqlite_response_store() -> SqliteResponseStore:
+    options = response_cache_options()
+    return SqliteResponseStore(options['db_file'], options['max_entries'])
+
+
+get_response_store = driver_store(_sqlite_response_store,
+                                  lambda: RedisResponseStore(response_cache_options()['ttl_seconds']))
+
+
+def response_cache_key(url: str, params, headers: dict) -> str:
+    request = requests.models.PreparedRequest()
+    request.prepare_url(url, params)
+    headers = CaseInsensitiveDict(headers)
+    parts = [request.url] + [f'{name}={headers.get(name, "")}' for name in _KEY_HEADERS]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def load_response(cache_key: str):
+    """
+    :return: (meta, body)，meta 中包含 etag / last_modified / encoding / headers；没有缓存或读取失败时返回 None
+    """
+    try:
+        return get_response_store().get(cache_key)
+    except Exception as e:
+        logger.warn(f'Failed to read SCM response cache: {e}')
+        return None
+
+
+def save_response(cache_key: str, response: requests.Response):
+    """保存带有 ETag 或 Last-Modified 的 200 响应，之后的请求可以带上校验值发起条件请求"""
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        return
+    if len(response.content) > response_cache_options()['max_body_bytes']:
+        return
+    meta = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'encoding': response.encoding,
+        'headers': {name: value for name, value in response.headers.items()
+                    if name.lower() not in _SKIPPED_HEADERS},
+    }
+    try:
+        get_response_store().set(cache_key, meta, response.content)
+    except Exception as e:
+        logger.warn(f'Failed to save SCM response cache: {e}')
+
+
+def touch_response(cache_key: str):
+    try:
+        get_response_store().touch(cache_key)
+    except Exception as e:
+        logger.warn(f'Failed to refresh SCM response cache: {e}')
+
+
+def validator_headers(meta: dict) -> dict:
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def build_cached_response(meta: dict, body: bytes, not_modified: requests.Response) -> requests.Response:
+    """用缓存的响应体构造 200 响应，响应头以缓存的为准，304 中更新的头（例如限流信息）覆盖缓存的值"""
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response._content = body
+    response.headers = CaseInsensitiveDict(meta.get('headers') or {})
+    response.headers.update({name: value for name, value in not_modified.headers.items()
+                             if name.lower() not in _SKIPPED_HEADERS})
+    response.encoding = meta.get('encoding')
+    response.url = not_modified.url
+    response.request = not_modified.request
+    response.elapsed = not_modified.elapsed
+    response.from_cache = True
+    return response
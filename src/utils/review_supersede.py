@@ -0,0 +1,111 @@
+import contextvars
+import time
+
+from src.utils.log import logger
+from src.utils.sqlite_queue import resolve_function
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+# 代次记录的保留时间，超过该时间未更新的 MR/PR 记录会被清理
+GENERATION_TTL_SECONDS = 7 * 24 * 3600
+
+# 当前进程中正在执行的 review 任务：(review_key, generation)
+_current_review = contextvars.ContextVar('current_review', default=None)
+
+
+def build_review_key(platform: str, url_slug: str, project, number) -> str:
+    """
+    生成 MR/PR 的唯一标识 (platform, project, MR number)，同一个 MR/PR 的新任务会替代旧任务
+    :return: 缺少项目或编号时返回 None，表示不参与替代
+    """
+    if project in (None, '') or number in (None, ''):
+        return None
+    return f'{platform}:{url_slug}:{project}:{number}'
+
+
+class SqliteGenerationStore(SqliteStore):
+    """记录每个 MR/PR 最新的任务代次，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS review_generations (
+            review_key TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''',)
+
+    def bump(self, review_key: str) -> int:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM review_generations WHERE updated_at < ?', (now - GENERATION_TTL_SECONDS,))
+            conn.execute('''
+                INSERT INTO review_generations (review_key, generation, updated_at) VALUES (?, 1, ?)
+                ON CONFLICT(review_key) DO UPDATE SET generation = generation + 1, updated_at = excluded.updated_at
+            ''', (review_key, now))
+            generation = conn.execute('SELECT generation FROM review_generations WHERE review_key = ?',
+                                      (review_key,)).fetchone()[0]
+            conn.execute('COMMIT')
+            return generation
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def current(self, review_key: str) -> int:
+        row = self._connect().execute('SELECT generation FROM review_generations WHERE review_key = ?',
+                                      (review_key,)).fetchone()
+        return row[0] if row else 0
+
+
+class RedisGenerationStore(RedisStore):
+    """rq 驱动使用 Redis 记录代次，API 进程与所有 rq worker 共享"""
+
+    KEY_PREFIX = 'review_generation:'
+
+    def bump(self, review_key: str) -> int:
+        key = self.KEY_PREFIX + review_key
+        pipe = self.redis.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, GENERATION_TTL_SECONDS)
+        return int(pipe.execute()[0])
+
+    def current(self, review_key: str) -> int:
+        value = self.redis.get(self.KEY_PREFIX + review_key)
+        return int(value) if value else 0
+
+
+get_generation_store = driver_store(SqliteGenerationStore, RedisGenerationStore)
+
+
+def is_superseded(review_key: str, generation: int) -> bool:
+    try:
+        return get_generation_store().current(review_key) > generation
+    except Exception as e:
+        # 代次存储不可用时按未被替代处理，宁可多 review 一次也不要漏掉
+        logger.warn(f'Failed to check review generation for {review_key}: {e}')
+        return False
+
+
+def is_current_review_superseded() -> bool:
+    """
+    当前执行的 review 任务是否已被同一 MR/PR 的新任务替代，在调用 LLM 和发布评论前检查
+    """
+    current = _current_review.get()
+    if current is None:
+        return False
+    return is_superseded(*current)
+
+
+def run_review_job(function: str, review_key: str, generation: int, *args):
+    """
+    队列实际执行的入口：执行前检查任务是否已被替代，并记录当前任务代次供 worker 中途检查
+    :param function: 任务函数引用，例如 src.queue.worker:handle_merge_request_event
+    """
+    if is_superseded(review_key, generation):
+        logger.info(f'Review job for {review_key} (generation {generation}) superseded by a newer update, skipped.')
+        return None
+    token = _current_review.set((review_key, generation))
+    try:
+        return resolve_function(function)(*args)
+    finally:
+        _current_review.reset(token)
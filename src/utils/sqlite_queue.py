@@ -0,0 +1,318 @@
+import importlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+
+from src.utils.log import logger
+
+
+def function_ref(function: callable) -> str:
+    """将函数转换为可持久化的引用，例如 src.queue.worker:handle_push_event"""
+    return f'{function.__module__}:{function.__qualname__}'
+
+
+def resolve_function(ref: str) -> callable:
+    module_name, _, qualname = ref.partition(':')
+    target = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        target = getattr(target, attr)
+    return target
+
+
+class SqliteJobQueue:
+    """
+    基于 SQLite 的持久化任务队列（QUEUE_DRIVER=sqlite）：
+    - 任务写入本地 SQLite 文件，API 进程重启不会丢失；
+    - worker 通过租约（lease）领取任务，租约到期未续约的任务会被其他 worker 重新领取（可见性超时）；
+    - 执行失败的任务按指数退避重试，超过最大次数后标记为 failed；
+    - 多个 worker 进程可以同时从同一个文件领取任务，领取操作在 BEGIN IMMEDIATE 事务中完成；
+    - 带 review_key 的任务入队时，会删除同一 MR/PR 尚未执行的旧任务；
+    - 领取时先按优先级（含老化）选择，同优先级内优先选择 正在执行数/权重 最小的项目，
+      并遵守项目、平台（队列）的并发上限；每个项目只有排在最前面的任务参与比较，积压的项目不会挤占其他项目。
+    """
+
+    def __init__(self, db_file: str = None, lease_seconds: int = None, max_attempts: int = None,
+                 retry_backoff_seconds: int = None, project_weights: dict = None, max_per_project: int = 0,
+                 max_per_host: int = 0, aging_seconds: int = 0):
+        self.db_file = db_file or os.getenv('SQLITE_QUEUE_DB', 'data/queue.db')
+        self.lease_seconds = lease_seconds or int(os.getenv('SQLITE_QUEUE_LEASE_SECONDS', 600))
+        self.max_attempts = max_attempts or int(os.getenv('SQLITE_QUEUE_MAX_ATTEMPTS', 3))
+        self.retry_backoff_seconds = retry_backoff_seconds or int(os.getenv('SQLITE_QUEUE_RETRY_BACKOFF_SECONDS', 30))
+        self.project_weights = project_weights or {}
+        self.max_per_project = max(0, max_per_project)
+        self.max_per_host = max(0, max_per_host)
+        self.aging_seconds = max(0, aging_seconds)
+        self.init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None：事务完全由下面的 BEGIN/COMMIT 显式控制
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA busy_timeout = 30000')
+        return conn
+
+    def init_db(self):
+        """初始化队列表结构"""
+        os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            # WAL 模式下读写互不阻塞，适合多个 worker 进程并发访问
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS queue_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    queue TEXT NOT NULL,
+                    function TEXT NOT NULL,
+                    args TEXT NOT NULL,
+                    review_key TEXT,
+                    project TEXT NOT NULL DEFAULT '',
+                    priority INTEGER NOT NULL DEFAULT 2,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL DEFAULT 3,
+                    available_at REAL NOT NULL,
+                    lease_until REAL,
+                    worker_id TEXT,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_queue_jobs_status ON queue_jobs (status, available_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_queue_jobs_review_key ON queue_jobs (review_key)')
+        finally:
+            conn.close()
+
+    def enqueue(self, function: callable, args: tuple, queue_name: str = 'default', delay: float = 0,
+                review_key: str = None, project: str = '', priority: int = 2) -> int:
+        """
+        :param priority: 任务优先级，取值见 src.utils.queue 中的 PRIORITY_*，默认为 Push 任务的优先级
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if review_key:
+                superseded = conn.execute("DELETE FROM queue_jobs WHERE review_key = ? AND status = 'queued'",
+                                          (review_key,)).rowcount
+                if superseded:
+                    logger.info(f'Dropped {superseded} queued job(s) superseded by a newer update of {review_key}.')
+            cursor = conn.execute('''
+                INSERT INTO queue_jobs (queue, function, args, review_key, project, priority, max_attempts,
+                    available_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (queue_name, function_ref(function), json.dumps(list(args), ensure_ascii=False), review_key,
+                  project or '', priority, self.max_attempts, now + delay, now, now))
+            conn.execute('COMMIT')
+            return cursor.lastrowid
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def claim(self, worker_id: str, queue_names: list = None) -> dict:
+        """
+        领取一个可执行的任务：状态为 queued 且已到可执行时间，或状态为 running 但租约已过期（worker 崩溃）
+        :return: 任务字典，没有可执行任务时返回 None
+        """
+        now = time.time()
+        queue_filter = f" AND queue IN ({','.join('?' for _ in queue_names)})" if queue_names else ''
+        # 老化：每等待 aging_seconds 秒提升一个优先级，最高提升到 0。
+        # 每个（队列, 项目）只取排在最前面的任务参与调度，某个项目积压再多任务也不会挤掉其他项目
+        sql = f'''
+            SELECT * FROM (
+                SELECT *, ROW_NUMBER() OVER (
+                    PARTITION BY queue, project ORDER BY effective_priority, created_at, id) AS project_rank
+                FROM (
+                    SELECT *, {self._effective_priority_sql()} AS effective_priority FROM queue_jobs
+                    WHERE ((status = 'queued' AND available_at <= ?) OR (status = 'running' AND lease_until < ?))
+                    {queue_filter}
+                )
+            ) WHERE project_rank = 1
+            ORDER BY effective_priority, created_at, id
+        '''
+        params = ([now] if self.aging_seconds else []) + [now, now] + list(queue_names or [])
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # 租约过期且重试次数已用完的任务直接标记为 failed，不参与调度
+            expired = conn.execute(f'''
+                UPDATE queue_jobs SET status = 'failed', lease_until = NULL, updated_at = ?,
+                    last_error = COALESCE(last_error, 'lease expired')
+                WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts {queue_filter}
+            ''', [now, now] + list(queue_names or [])).rowcount
+            if expired:
+                logger.warning(f'{expired} SQLite queue job(s) failed after their lease expired on the last attempt.')
+            running_projects, running_hosts = self._running_counts(conn, now)
+            candidates = []
+            for row in conn.execute(sql, params).fetchall():
+                key = (row['queue'], row['project'])
+                if self.max_per_project and running_projects[key] >= self.max_per_project:
+                    continue
+                if self.max_per_host and running_hosts[row['queue']] >= self.max_per_host:
+                    continue
+                candidates.append(row)
+            # 候选（各项目排在最前面的任务）已按优先级、入队时间排序，min 在优先级和负载都相同的项目之间保持先进先出
+            row = min(candidates, key=lambda r: (r['effective_priority'],
+                                                 running_projects[(r['queue'], r['project'])] /
+                                                 self.project_weights.get(r['project'], 1)), default=None)
+            if row is not None:
+                if row['status'] == 'running':
+                    logger.warning(f"SQLite queue job {row['id']} lease expired (worker={row['worker_id']}), reclaiming.")
+                conn.execute('''
+                    UPDATE queue_jobs SET status = 'running', attempts = attempts + 1, lease_until = ?,
+                        worker_id = ?, started_at = ?, updated_at = ?
+                    WHERE id = ?
+                ''', (now + self.lease_seconds, worker_id, now, now, row['id']))
+                conn.execute('COMMIT')
+                job = dict(row)
+                job['attempts'] += 1
+                job['args'] = json.loads(job['args'])
+                return job
+            conn.execute('COMMIT')
+            return None
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _effective_priority_sql(self) -> str:
+        if not self.aging_seconds:
+            return 'priority'
+        return f'MAX(0, priority - CAST((? - created_at) / {self.aging_seconds} AS INTEGER))'
+
+    @staticmethod
+    def _running_counts(conn: sqlite3.Connection, now: float):
+        running_projects, running_hosts = Counter(), Counter()
+        for row in conn.execute('''
+            SELECT queue, project, COUNT(*) AS total FROM queue_jobs
+            WHERE status = 'running' AND lease_until >= ? GROUP BY queue, project
+        ''', (now,)):
+            running_projects[(row['queue'], row['project'])] += row['total']
+            running_hosts[row['queue']] += row['total']
+        return running_projects, running_hosts
+
+    def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """续约，返回 False 表示任务已被其他 worker 接管"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute('''
+                UPDATE queue_jobs SET lease_until = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'running'
+            ''', (now + self.lease_seconds, now, job_id, worker_id))
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def complete(self, job_id: int, worker_id: str):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM queue_jobs WHERE id = ? AND worker_id = ? AND status = 'running'",
+                         (job_id, worker_id))
+        finally:
+            conn.close()
+
+    def reschedule(self, job_id: int, worker_id: str, args: tuple, delay: float):
+        """任务主动要求延迟重试（例如 MR 的 diff 尚未生成）：以新的参数重新排队，不计入失败次数"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('''
+                UPDATE queue_jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), args = ?, lease_until = NULL,
+                    worker_id = NULL, available_at = ?, updated_at = ?
+                WHERE id = ? AND worker_id = ? AND status = 'running'
+            ''', (json.dumps(list(args), ensure_ascii=False), now + delay, now, job_id, worker_id))
+        finally:
+            conn.close()
+
+    def fail(self, job_id: int, worker_id: str, error: str):
+        """任务执行失败：未超过最大次数时按指数退避重新排队，否则标记为 failed"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT attempts, max_attempts FROM queue_jobs WHERE id = ? AND worker_id = ? AND status = 'running'",
+                               (job_id, worker_id)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return
+            if row['attempts'] >= row['max_attempts']:
+                conn.execute('''
+                    UPDATE queue_jobs SET status = 'failed', lease_until = NULL, last_error = ?, updated_at = ?
+                    WHERE id = ?
+                ''', (error, now, job_id))
+                logger.error(f'SQLite queue job {job_id} failed after {row["attempts"]} attempts.')
+            else:
+                delay = self.retry_backoff_seconds * (2 ** (row['attempts'] - 1))
+                conn.execute('''
+                    UPDATE queue_jobs SET status = 'queued', lease_until = NULL, worker_id = NULL, last_error = ?,
+                        available_at = ?, updated_at = ?
+                    WHERE id = ?
+                ''', (error, now + delay, now, job_id))
+                logger.warning(f'SQLite queue job {job_id} failed (attempt {row["attempts"]}), retrying in {delay}s.')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def depth(self) -> int:
+        """等待执行的任务数"""
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM queue_jobs WHERE status = 'queued'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        now = time.time()
+        conn = self._connect()
+        try:
+            counts = {row['status']: row['total'] for row in
+                      conn.execute('SELECT status, COUNT(*) AS total FROM queue_jobs GROUP BY status')}
+            oldest = conn.execute("SELECT MIN(created_at) FROM queue_jobs WHERE status = 'queued'").fetchone()[0]
+            projects = {}
+            for row in conn.execute('''
+                SELECT queue, project,
+                    SUM(status = 'queued') AS queued,
+                    SUM(status = 'running') AS running,
+                    MIN(CASE WHEN status = 'queued' THEN created_at END) AS oldest_queued,
+                    AVG(CASE WHEN status = 'running' THEN started_at - created_at END) AS avg_wait
+                FROM queue_jobs WHERE status IN ('queued', 'running') GROUP BY queue, project
+            '''):
+                name = f"{row['queue']}/{row['project']}" if row['project'] else row['queue']
+                projects[name] = {
+                    'weight': self.project_weights.get(row['project'], 1),
+                    'queued': row['queued'],
+                    'running': row['running'],
+                    'avg_wait_seconds': round(row['avg_wait'], 2) if row['avg_wait'] is not None else 0,
+                    'oldest_queued_seconds': round(now - row['oldest_queued'], 2) if row['oldest_queued'] else 0,
+                }
+            priorities = {}
+            for row in conn.execute('''
+                SELECT priority, COUNT(*) AS queued, MIN(created_at) AS oldest_queued FROM queue_jobs
+                WHERE status = 'queued' GROUP BY priority
+            '''):
+                priorities[row['priority']] = {
+                    'queued': row['queued'],
+                    'oldest_queued_seconds': round(now - row['oldest_queued'], 2),
+                }
+        finally:
+            conn.close()
+        return {
+            'driver': 'sqlite',
+            'queue_depth': counts.get('queued', 0),
+            'in_flight': counts.get('running', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_queued_seconds': round(now - oldest, 1) if oldest else 0,
+            'priorities': priorities,
+            'projects': projects,
+        }
@@ -0,0 +1,87 @@
+import functools
+import os
+import sqlite3
+import threading
+
+from redis import Redis
+
+from src.utils.log import logger
+
+# 当前线程打开的 SQLite 连接：{db_file: connection}，fork 后的子进程重新打开
+_sqlite_local = threading.local()
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def sqlite_connection(db_file: str) -> sqlite3.Connection:
+    """
+    当前进程、当前线程共用的 SQLite 连接，避免每次读写都重新打开数据库文件
+    isolation_level=None：需要事务时由调用方显式 BEGIN / COMMIT
+    """
+    pid = os.getpid()
+    if getattr(_sqlite_local, 'pid', None) != pid:
+        # 连接不能跨 fork 使用，子进程丢弃从父进程继承的连接
+        _sqlite_local.pid = pid
+        _sqlite_local.connections = {}
+    conn = _sqlite_local.connections.get(db_file)
+    if conn is None:
+        conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA busy_timeout = 30000')
+        _sqlite_local.connections[db_file] = conn
+    elif conn.in_transaction:
+        # 上一次使用时异常退出且 ROLLBACK 也失败，未结束的事务不能带到这一次
+        conn.rollback()
+    return conn
+
+
+def redis_connection() -> Redis:
+    """当前进程共用的 Redis 连接（redis-py 内部维护连接池，fork 后会自动重建）"""
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                logger.info(f'REDIS_HOST: {os.getenv("REDIS_HOST", "127.0.0.1")}，'
+                            f'REDIS_PORT: {os.getenv("REDIS_PORT", 6379)}')
+                _redis = Redis(os.getenv('REDIS_HOST', '127.0.0.1'), os.getenv('REDIS_PORT', 6379))
+    return _redis
+
+
+class SqliteStore:
+    """
+    async / sqlite 驱动使用的 SQLite 存储基类，默认与 sqlite 队列共用同一个文件
+    子类在 SCHEMA 中声明建表语句，读写时通过 _connect() 取得当前线程复用的连接，不需要关闭
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, db_file: str = None):
+        self.db_file = db_file or os.getenv('SQLITE_QUEUE_DB', 'data/queue.db')
+        os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+        conn = self._connect()
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite_connection(self.db_file)
+
+
+class RedisStore:
+    """rq 驱动使用的 Redis 存储基类，API 进程与所有 rq worker 共享数据"""
+
+    def __init__(self):
+        self.redis = redis_connection()
+
+
+def driver_store(sqlite_factory: callable, redis_factory: callable) -> callable:
+    """
+    返回按 QUEUE_DRIVER 选择存储实现的 get_*_store 函数：rq 驱动使用 Redis，其他驱动使用 SQLite
+    存储在第一次调用时创建，之后整个进程复用
+    """
+
+    @functools.lru_cache(maxsize=None)
+    def get_store():
+        if os.getenv('QUEUE_DRIVER', 'async') == 'rq':
+            return redis_factory()
+        return sqlite_factory()
+
+    return get_store
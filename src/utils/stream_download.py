@@ -0,0 +1,279 @@
+import codecs
+import contextlib
+import json
+import os
+import re
+import tempfile
+
+from src.utils.log import logger
+
+_WHITESPACE = ' \t\r\n'
+# JSON 字符串内容：普通字符与完整的转义序列
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\(?:u[0-9a-fA-F]{4}|["\\/bfnrt])[^"\\]*)*')
+_LITERAL = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+_LITERAL_END = re.compile(r'[,\]}\s]')
+_CHUNK_SIZE = 64 * 1024
+
+
+def stream_options() -> dict:
+    return {
+        'enabled': os.getenv('SCM_STREAM_DOWNLOAD_ENABLED', '1') == '1',
+        # 下载内容在内存中保留的最大字节数，超过后写入临时文件
+        'spool_memory_bytes': int(os.getenv('SCM_STREAM_SPOOL_MEMORY_BYTES', 1024 * 1024)),
+        # 单个文件 patch 保留的最大字符数，超出部分在解析时直接跳过，不读入内存
+        'max_patch_chars': int(os.getenv('SCM_STREAM_MAX_PATCH_CHARS', 512 * 1024)),
+        # 单个响应最多下载的字节数，超出后停止读取，只使用已解析的部分
+        'max_response_bytes': int(os.getenv('SCM_STREAM_MAX_RESPONSE_BYTES', 200 * 1024 * 1024)),
+    }
+
+
+@contextlib.contextmanager
+def spooled_response(response, max_bytes: int = None):
+    """
+    把 stream=True 的响应分块写入 SpooledTemporaryFile（较小的响应留在内存，较大的写入临时文件），
+    不通过 response.content / response.text 一次性读入内存
+    :return: 定位到开头的二进制文件对象；超过 max_bytes 的部分不下载
+    """
+    options = stream_options()
+    max_bytes = max_bytes or options['max_response_bytes']
+    spool = tempfile.SpooledTemporaryFile(max_size=options['spool_memory_bytes'])
+    try:
+        size = 0
+        for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+            spool.write(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                logger.warn(f'Response of {response.url} exceeds {max_bytes} bytes, only the first part is used.')
+                break
+        spool.seek(0)
+        yield spool
+    finally:
+        response.close()
+        spool.close()
+
+
+class StreamingJsonParser:
+    """
+    从文件对象中增量解析 JSON，缓冲区只保留当前正在解析的元素；
+    超过 max_string_chars 的字符串只保留开头部分（截断在最后一个换行处），其余内容扫描跳过
+    """
+
+    def __init__(self, fp, max_string_chars: int = None):
+        self.fp = fp
+        self.max_string_chars = max_string_chars
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.truncated_strings = 0
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(b'', final=True)
+            self.pos = 0
+            return False
+        # 丢弃已经解析过的内容，缓冲区的大小与单个元素相关，而不是整个响应
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise EOFError('unexpected end of JSON stream')
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f'expected {char!r} at offset {self.pos}, got {self.buffer[self.pos]!r}')
+        self.pos += 1
+
+    def parse_value(self):
+        char = self._peek()
+        if char == '{':
+            return dict(self.iter_object())
+        if char == '[':
+            return list(self.iter_array())
+        if char == '"':
+            return self._parse_string()
+        return self._parse_literal()
+
+    def iter_object(self):
+        """逐个返回对象的 (key, value)"""
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._parse_string()
+            self._expect(':')
+            yield key, self.parse_value()
+            char = self._peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'expected "," or "}}" at offset {self.pos - 1}')
+
+    def iter_array(self):
+        """逐个返回数组的元素，调用方处理完一个元素后才会解析下一个"""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.parse_value()
+            char = self._peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'expected "," or "]" at offset {self.pos - 1}')
+
+    def _parse_literal(self):
+        while not _LITERAL_END.search(self.buffer, self.pos) and self._fill():
+            pass
+        match = _LITERAL.match(self.buffer, self.pos)
+        if not match:
+            raise ValueError(f'invalid JSON value at offset {self.pos}')
+        self.pos = match.end()
+        return json.loads(match.group())
+
+    def _parse_string(self) -> str:
+        self._expect('"')
+        parts = []
+        kept = 0
+        truncated = False
+        while True:
+            # 一次匹配尽可能长的、只包含完整转义序列的字符串内容
+            end = _STRING_BODY.match(self.buffer, self.pos).end()
+            if end > self.pos:
+                if self.max_string_chars is None or kept < self.max_string_chars:
+                    segment = self.buffer[self.pos:end]
+                    if self.max_string_chars is not None and kept + len(segment) > self.max_string_chars:
+                        # 截断后再匹配一次，去掉末尾不完整的转义序列
+                        segment = segment[:_STRING_BODY.match(segment, 0, self.max_string_chars - kept).end()]
+                        truncated = True
+                    parts.append(segment)
+                    kept += len(segment)
+                else:
+                    truncated = True
+                self.pos = end
+            if self.pos < len(self.buffer) and self.buffer[self.pos] == '"':
+                self.pos += 1
+                break
+            if self.pos < len(self.buffer) - 6:
+                raise ValueError(f'invalid escape sequence at offset {self.pos}')
+            # 缓冲区末尾是字符串内容或不完整的转义序列，继续读取
+            if not self._fill():
+                raise EOFError('unexpected end of JSON stream')
+
+        # 保留的片段中只包含完整的转义序列（包括 \uXXXX 形式的代理对），可以直接交给 json 解码
+        value = json.loads('"' + ''.join(parts) + '"', strict=False) if parts else ''
+        if truncated:
+            self.truncated_strings += 1
+            newline = value.rfind('\n')
+            value = value[:newline] if newline > 0 else value
+        return value
+
+
+def iter_json_array(fp, key: str = None, max_string_chars: int = None, description: str = ''):
+    """
+    逐个返回 JSON 响应中数组的元素：key 为 None 时为顶层数组，否则为顶层对象中 key 对应的数组。
+    响应被截断（超过下载上限）时返回已完整解析的元素
+    """
+    parser = StreamingJsonParser(fp, max_string_chars)
+    try:
+        if key is None:
+            yield from parser.iter_array()
+        else:
+            for name, value in _iter_object_until(parser, key):
+                if name == key:
+                    yield from parser.iter_array()
+                    return
+    except EOFError:
+        logger.warn(f'JSON response ends unexpectedly, only the complete items are used. {description}')
+    except ValueError as e:
+        logger.warn(f'Failed to parse JSON response while streaming, only the parsed items are used: {e} {description}')
+    finally:
+        if parser.truncated_strings:
+            logger.info(f'{parser.truncated_strings} oversized patches were truncated to {max_string_chars} '
+                        f'characters while streaming. {description}')
+
+
+def _iter_object_until(parser: StreamingJsonParser, key: str):
+    """解析顶层对象的字段，遇到 key 时停在它的值之前，由调用方增量解析"""
+    parser._expect('{')
+    if parser._peek() == '}':
+        return
+    while True:
+        name = parser._parse_string()
+        parser._expect(':')
+        if name == key:
+            yield name, None
+            return
+        parser.parse_value()
+        char = parser._peek()
+        parser.pos += 1
+        if char == '}':
+            return
+
+
+def iter_diff_sections(fp, max_patch_chars: int = None, description: str = ''):
+    """
+    逐行读取 unified diff，按 `diff --git` 切分后逐个返回每个文件的 diff；
+    单个文件超过 max_patch_chars 的部分不保留
+    """
+    reader = codecs.getreader('utf-8')(fp, errors='replace')
+    lines = []
+    kept = 0
+    truncated = 0
+    for line in reader:
+        if line.startswith('diff --git ') and lines:
+            yield ''.join(lines).strip('\n')
+            lines, kept = [], 0
+        if max_patch_chars is not None and kept + len(line) > max_patch_chars:
+            if kept <= max_patch_chars:
+                truncated += 1
+                kept = max_patch_chars + 1
+            continue
+        lines.append(line)
+        kept += len(line)
+    if lines:
+        yield ''.join(lines).strip('\n')
+    if truncated:
+        logger.info(f'{truncated} oversized file diffs were truncated to {max_patch_chars} characters. {description}')
+
+
+def read_json_array(response, key: str = None, description: str = '') -> list:
+    """
+    读取 stream=True 的响应中的数组（见 iter_json_array），每个元素中过长的 patch 被截断；
+    未启用流式下载时按原来的方式一次性解析
+    """
+    options = stream_options()
+    if not options['enabled']:
+        data = response.json()
+        return data.get(key, []) if key is not None else data
+    with spooled_response(response) as fp:
+        return list(iter_json_array(fp, key, options['max_patch_chars'], description))
+
+
+def read_diff_sections(response, description: str = '') -> list:
+    """读取 stream=True 的 unified diff 响应，按文件切分（见 iter_diff_sections）；未启用流式下载时一次性读取"""
+    options = stream_options()
+    if not options['enabled']:
+        return [part.strip('\n') for part in re.split(r"\n(?=diff --git )", response.text or '') if part.strip('\n')]
+    with spooled_response(response) as fp:
+        return [part for part in iter_diff_sections(fp, options['max_patch_chars'], description) if part]
+
+
+def stream_enabled() -> bool:
+    """请求时是否传 stream=True"""
+    return stream_options()['enabled']
@@ -0,0 +1,73 @@
+import os
+import time
+
+from src.utils.log import logger
+from src.utils.store import RedisStore, SqliteStore, driver_store
+
+
+class SqliteDeliveryStore(SqliteStore):
+    """记录已入队的 webhook 投递，供 async / sqlite 驱动使用（与 sqlite 队列共用同一个文件）"""
+
+    SCHEMA = ('''
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            delivery_key TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+    ''',)
+
+    def claim(self, delivery_key: str, window_seconds: int) -> bool:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM webhook_deliveries WHERE expires_at < ?', (now,))
+            claimed = conn.execute('INSERT OR IGNORE INTO webhook_deliveries (delivery_key, expires_at) VALUES (?, ?)',
+                                   (delivery_key, now + window_seconds)).rowcount == 1
+            conn.execute('COMMIT')
+            return claimed
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def release(self, delivery_key: str):
+        self._connect().execute('DELETE FROM webhook_deliveries WHERE delivery_key = ?', (delivery_key,))
+
+
+class RedisDeliveryStore(RedisStore):
+    """rq 驱动使用 Redis 记录已入队的 webhook 投递"""
+
+    KEY_PREFIX = 'webhook_delivery:'
+
+    def claim(self, delivery_key: str, window_seconds: int) -> bool:
+        return bool(self.redis.set(self.KEY_PREFIX + delivery_key, 1, nx=True, ex=window_seconds))
+
+    def release(self, delivery_key: str):
+        self.redis.delete(self.KEY_PREFIX + delivery_key)
+
+
+get_delivery_store = driver_store(SqliteDeliveryStore, RedisDeliveryStore)
+
+
+def claim_delivery(delivery_key: str) -> bool:
+    """
+    登记一次 webhook 投递，WEBHOOK_DEDUPE_WINDOW_SECONDS 内同一投递再次到达时返回 False
+    """
+    window_seconds = int(os.getenv('WEBHOOK_DEDUPE_WINDOW_SECONDS', 3600))
+    if not delivery_key or window_seconds <= 0:
+        return True
+    try:
+        return get_delivery_store().claim(delivery_key, window_seconds)
+    except Exception as e:
+        # 去重存储不可用时照常入队，宁可重复 review 也不要漏掉
+        logger.warn(f'Failed to check webhook delivery {delivery_key}: {e}')
+        return True
+
+
+def release_delivery(delivery_key: str):
+    """任务未能入队时撤销登记，让平台的重试可以正常入队"""
+    if not delivery_key or int(os.getenv('WEBHOOK_DEDUPE_WINDOW_SECONDS', 3600)) <= 0:
+        return
+    try:
+        get_delivery_store().release(delivery_key)
+    except Exception as e:
+        logger.warn(f'Failed to release webhook delivery {delivery_key}: {e}')